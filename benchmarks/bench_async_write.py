@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   对比同步写入与后台线程写入(queue_size > 0)时，推理与写入是否能够重叠(只统计到checkpoint()为止，不含finish())
+#   负载：每个batch先"推理"(用time.sleep模拟GPU上的耗时，期间不占用GIL)，再把结果写进hdf5暂存的Tiff_writer
+#   缓存很小，写入会不断淘汰chunk并读写hdf5
+#   用法：python benchmarks/bench_async_write.py [--size 16384] [--infer-ms 20] [--queue-size 8]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tif_writer.tifflib import Tiff_writer
+
+
+def run(queue_size, size, tile_size, batch, infer_ms, cache_bytes, workdir, seed=0):
+    rng = np.random.default_rng(seed)
+    grid = np.arange(0, size - tile_size + 1, tile_size)
+    ys, xs = [a.flatten() for a in np.meshgrid(grid, grid, indexing='ij')]
+    #   打乱顺序，让缓存不断淘汰
+    order = rng.permutation(len(xs))
+    xs, ys = xs[order], ys[order]
+    tiles = rng.integers(1, 8, (batch, tile_size, tile_size)).astype(np.uint8)
+    writer = Tiff_writer(os.path.join(workdir, 'async_write.tif'), size, size, store='hdf5',
+                         cache_bytes=cache_bytes, queue_size=queue_size)
+    start = time.perf_counter()
+    for i in range(0, len(xs), batch):
+        time.sleep(infer_ms / 1000.)
+        writer.write_many(xs[i:i + batch], ys[i:i + batch], tiles[:len(xs[i:i + batch])])
+    writer.checkpoint()
+    elapsed = time.perf_counter() - start
+    infer = infer_ms / 1000. * int(np.ceil(len(xs) / batch))
+    writer.finish()
+    return len(xs), elapsed, infer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=16384)
+    parser.add_argument('--tile-size', type=int, default=256)
+    parser.add_argument('--batch', type=int, default=32)
+    parser.add_argument('--infer-ms', type=float, default=20)
+    parser.add_argument('--queue-size', type=int, default=8)
+    parser.add_argument('--cache-mb', type=int, default=16)
+    parser.add_argument('--workdir', default=None)
+    args = parser.parse_args()
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp()
+    print('{:>12s} {:>8s} {:>10s} {:>10s} {:>12s}'.format('queue_size', 'tiles', 'time(s)', 'infer(s)', 'overhead(s)'))
+    for queue_size in (0, args.queue_size):
+        count, elapsed, infer = run(queue_size, args.size, args.tile_size, args.batch, args.infer_ms,
+                                    args.cache_mb * 1024 ** 2, workdir)
+        print('{:>12d} {:>8d} {:>10.3f} {:>10.3f} {:>12.3f}'.format(queue_size, count, elapsed, infer,
+                                                                    elapsed - infer))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   对比不同暂存后端在同一写入负载下的耗时
+#   负载：在画布上随机写入互相重叠的小tile，缓存设置得很小，使得大部分时间花在后端的读写上
+#   用法：python benchmarks/bench_chunk_store.py [--width 16384] [--height 16384] [--tiles 2000]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tif_writer.tifflib import Tiff_writer
+
+
+def run(store, width, height, tiles, tile_size, chunk_size, cache_bytes, workdir, seed=0):
+    rng = np.random.default_rng(seed)
+    xs = rng.integers(0, width - tile_size, tiles)
+    ys = rng.integers(0, height - tile_size, tiles)
+    data = rng.integers(1, 8, (16, tile_size, tile_size)).astype(np.uint8)
+
+    start = time.perf_counter()
+    writer = Tiff_writer(os.path.join(workdir, 'bench_{}.tif'.format(store)), width, height,
+                         chunk_size=chunk_size, cache_bytes=cache_bytes, store=store)
+    init_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(tiles):
+        writer.write(int(xs[i]), int(ys[i]), data[i % len(data)])
+    writer.write(0, 0, data[0], save=True)
+    write_time = time.perf_counter() - start
+
+    #   模拟finish()中把所有chunk读回的过程
+    start = time.perf_counter()
+    for chunk_y, chunk_x in zip(*np.nonzero(writer.accessed)):
+        writer.store.read(chunk_x, chunk_y)
+    read_time = time.perf_counter() - start
+
+    writer.store.close()
+    writer.free()
+    return init_time, write_time, read_time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=16384)
+    parser.add_argument('--height', type=int, default=16384)
+    parser.add_argument('--tiles', type=int, default=2000)
+    parser.add_argument('--tile-size', type=int, default=256)
+    parser.add_argument('--chunk-size', type=int, default=1024)
+    parser.add_argument('--cache-mb', type=float, default=8)
+    parser.add_argument('--stores', default='hdf5,memory,memmap')
+    parser.add_argument('--workdir', default=None)
+    args = parser.parse_args()
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp()
+    print('{:>8s} {:>10s} {:>10s} {:>10s} {:>12s}'.format('store', 'init(s)', 'write(s)', 'read(s)', 'tiles/s'))
+    for store in args.stores.split(','):
+        init_time, write_time, read_time = run(store, args.width, args.height, args.tiles, args.tile_size,
+                                               args.chunk_size, int(args.cache_mb * 1024 ** 2), workdir)
+        print('{:>8s} {:>10.3f} {:>10.3f} {:>10.3f} {:>12.1f}'.format(store, init_time, write_time, read_time,
+                                                                      args.tiles / write_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   finish()的吞吐量与压缩线程/进程数的关系
+#   负载：整张画布都写满了随机的标签(压缩最耗时的情况)，暂存在内存中，只统计finish()的耗时
+#   用法：python benchmarks/bench_finish.py [--size 8192] [--workers 1,2,4,8] [--pool thread]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tif_writer.tifflib import Tiff_writer
+
+
+def run(size, chunk_size, compression, workers, pool, workdir, seed=0):
+    rng = np.random.default_rng(seed)
+    writer = Tiff_writer(os.path.join(workdir, 'finish.tif'), size, size, chunk_size=chunk_size,
+                         store='memory', compression=compression)
+    #   一行一行地写入，每个标签延续一小段，接近真实的分割结果
+    for y in range(0, size, chunk_size):
+        runs = rng.integers(1, 8, (chunk_size, size // 16)).astype(np.uint8)
+        writer.write(0, y, np.repeat(runs, 16, axis=1))
+    start = time.perf_counter()
+    writer.finish(workers=workers, pool=pool)
+    elapsed = time.perf_counter() - start
+    os.remove(os.path.join(workdir, 'finish.tif'))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=8192)
+    parser.add_argument('--chunk-size', type=int, default=1024)
+    parser.add_argument('--compression', default='deflate')
+    parser.add_argument('--workers', default='1,2,4,8')
+    parser.add_argument('--pool', default='thread')
+    parser.add_argument('--workdir', default=None)
+    args = parser.parse_args()
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp()
+    megabytes = args.size * args.size / 1024 ** 2
+    print('{:>8s} {:>10s} {:>10s}'.format('workers', 'finish(s)', 'MB/s'))
+    for workers in [int(w) for w in args.workers.split(',')]:
+        elapsed = run(args.size, args.chunk_size, args.compression, workers, args.pool, workdir)
+        print('{:>8d} {:>10.3f} {:>10.1f}'.format(workers, elapsed, megabytes / elapsed))
+
+
+if __name__ == '__main__':
+    main()
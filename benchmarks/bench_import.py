@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   导入耗时的报告：每个模块都在新的解释器中导入若干次取最快的一次，
+#   与同样方式测得的"import numpy"相比，标出超出--budget-ms(毫秒)的模块；同时列出不应被提前导入的重依赖
+#       tif_writer：不导入numpy/h5py/PIL/ASAP
+#       tif_writer.tifflib/tiffio/chunkstore：不导入h5py/PIL/ASAP(h5py只在使用hdf5暂存时导入)
+#       tif_writer.slidelib：不导入ASAP(第一次打开slide时才导入)与multiprocessing
+#   只用于报告，回归检查(同样的重依赖，较宽松的预算)由tests/test_import.py在pytest中进行
+#   用法：python benchmarks/bench_import.py [--repeat 5] [--budget-ms 30]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+#   模块 -> 导入后不应出现在sys.modules中的模块
+checks = {'numpy': [],
+          'tif_writer': ['numpy', 'h5py', 'PIL', 'multiresolutionimageinterface'],
+          'tif_writer.tifflib': ['h5py', 'PIL', 'multiresolutionimageinterface'],
+          'tif_writer.tiffio': ['h5py', 'PIL', 'multiresolutionimageinterface'],
+          'tif_writer.chunkstore': ['h5py', 'PIL', 'multiresolutionimageinterface'],
+          'tif_writer.files': ['h5py', 'PIL', 'multiresolutionimageinterface'],
+          'tif_writer.slidelib': ['h5py', 'PIL', 'multiresolutionimageinterface', 'multiprocessing'],
+          'tif_writer.mapping': ['h5py', 'PIL', 'multiresolutionimageinterface', 'multiprocessing']}
+
+probe = '''
+import sys, time, json
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'loaded': [name for name in {forbidden!r} if name in sys.modules]}}))
+'''
+
+
+def measure(module, forbidden, repeat):
+    best = None
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', probe.format(root=root, module=module, forbidden=forbidden)],
+                                stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=30., help='allowed import time on top of numpy')
+    args = parser.parse_args()
+
+    numpy_ms = measure('numpy', [], args.repeat)['seconds'] * 1000
+    print('{:<24s} {:>10s} {:>10s}  {}'.format('module', 'time(ms)', 'budget', 'status'))
+    for module, forbidden in checks.items():
+        result = measure(module, forbidden, args.repeat)
+        elapsed = result['seconds'] * 1000
+        #   numpy本身只作为参照；不依赖numpy的模块(tif_writer本身)只有固定的预算
+        if module == 'numpy':
+            budget = float('inf')
+        elif 'numpy' in forbidden:
+            budget = args.budget_ms
+        else:
+            budget = numpy_ms + args.budget_ms
+        status = []
+        if elapsed > budget:
+            status.append('OVER BUDGET')
+        if len(result['loaded']) > 0:
+            status.append('imports ' + ', '.join(result['loaded']))
+        print('{:<24s} {:>10.1f} {:>10.1f}  {}'.format(module, elapsed, budget, '; '.join(status) or 'ok'))
+
+
+if __name__ == '__main__':
+    main()
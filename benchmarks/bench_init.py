@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   构建Tiff_writer的耗时回归测试：构建的耗时应当与画布大小无关
+#   默认在100k x 100k的画布上构建，若任一后端超出预算(秒)，以非0状态退出
+#   用法：python benchmarks/bench_init.py [--size 100000] [--budget 0.5]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tif_writer.tifflib import Tiff_writer
+
+
+def run(store, size, chunk_size, workdir):
+    start = time.perf_counter()
+    writer = Tiff_writer(os.path.join(workdir, 'init_{}.tif'.format(store)), size, size,
+                         chunk_size=chunk_size, store=store)
+    elapsed = time.perf_counter() - start
+    writer.store.close()
+    writer.free()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=100000)
+    parser.add_argument('--chunk-size', type=int, default=1024)
+    parser.add_argument('--budget', type=float, default=0.5)
+    parser.add_argument('--stores', default='hdf5,memory,memmap')
+    parser.add_argument('--workdir', default=None)
+    args = parser.parse_args()
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp()
+    failed = False
+    for store in args.stores.split(','):
+        elapsed = run(store, args.size, args.chunk_size, workdir)
+        over = elapsed > args.budget
+        failed = failed or over
+        print('{:>8s} {}x{} chunk {}: {:.4f}s {}'.format(store, args.size, args.size, args.chunk_size, elapsed,
+                                                          'OVER BUDGET' if over else 'ok'))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
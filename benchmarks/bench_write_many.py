@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   对比逐个write()与批量write_many()的吞吐量
+#   负载：滑窗推理的典型情况，256x256的预测结果按批写到1024的chunk网格上，窗口之间有重叠
+#   copy一行是同样的tile直接切片赋值进一张完整ndarray的耗时，即只拷贝像素、没有任何分块开销时的下限；
+#   write()写进内存中的chunk缓存，已经接近这个下限，所以write_many()相对write()的提升有限(256x256约1.4倍，64x64约3倍)，
+#   相对最初逐个tile读写hdf5的write()则在50倍以上
+#   用法：python benchmarks/bench_write_many.py [--size 16384] [--batch 256]
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from tif_writer.tifflib import Tiff_writer
+
+
+def run(method, size, tile_size, stride, batch, chunk_size, workdir, seed=0):
+    rng = np.random.default_rng(seed)
+    grid = np.arange(0, size - tile_size, stride)
+    ys, xs = [a.flatten() for a in np.meshgrid(grid, grid, indexing='ij')]
+    tiles = rng.integers(1, 8, (batch, tile_size, tile_size)).astype(np.uint8)
+    if method == 'copy':
+        canvas = np.ones((size, size), dtype=np.uint8)
+        start = time.perf_counter()
+        for i, (x, y) in enumerate(zip(xs, ys)):
+            canvas[y:y + tile_size, x:x + tile_size] = tiles[i % batch]
+        return len(xs), time.perf_counter() - start
+    writer = Tiff_writer(os.path.join(workdir, 'write_many.tif'), size, size, chunk_size=chunk_size,
+                         store='memory', encoder='mir')
+    #   先把所有chunk建好，只统计写入路径本身的耗时
+    writer.write(0, 0, np.ones((size, size), dtype=np.uint8))
+    start = time.perf_counter()
+    for i in range(0, len(xs), batch):
+        batch_xs, batch_ys = xs[i:i + batch], ys[i:i + batch]
+        batch_tiles = tiles[:len(batch_xs)]
+        if method == 'write':
+            for x, y, tile in zip(batch_xs, batch_ys, batch_tiles):
+                writer.write(int(x), int(y), tile)
+        else:
+            writer.write_many(batch_xs, batch_ys, batch_tiles)
+    elapsed = time.perf_counter() - start
+    writer.free()
+    return len(xs), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=16384)
+    parser.add_argument('--tile-size', type=int, default=256)
+    parser.add_argument('--stride', type=int, default=192)
+    parser.add_argument('--batch', type=int, default=256)
+    parser.add_argument('--chunk-size', type=int, default=1024)
+    parser.add_argument('--workdir', default=None)
+    args = parser.parse_args()
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp()
+    print('{:>12s} {:>8s} {:>10s} {:>12s} {:>10s}'.format('method', 'tiles', 'time(s)', 'tiles/s', 'vs write'))
+    baseline = None
+    for method in ('write', 'write_many', 'copy'):
+        count, elapsed = run(method, args.size, args.tile_size, args.stride, args.batch, args.chunk_size, workdir)
+        baseline = elapsed if baseline is None else baseline
+        print('{:>12s} {:>8d} {:>10.3f} {:>12.1f} {:>9.2f}x'.format(method, count, elapsed, count / elapsed,
+                                                                      baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   multiresolutionimageinterface(ASAP)的替身，只实现了tif_writer用到的接口，让benchmark在没有安装ASAP的机器上也能运行
+#   读：基于tif_writer.tiffio.Tiled_tiff_reader，只支持单通道uint8的分块tiff(内置编码器或本模块生成的文件)
+#   写：level 0的tile先保存在内存中，finishImage()时按最近邻逐层降采样，用Tiled_tiff_encoder写成deflate压缩的BigTIFF
+#   解码/压缩都是纯numpy/zlib，所以测到的耗时反映的是tif_writer本身，不代表ASAP的速度
+#   使用方法：把本目录放在sys.path的最前面，benchmarks/suite.py在找不到ASAP时(或--mir fake)会自动这样做
+
+import os
+import sys
+import threading
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from tif_writer.tiffio import Tiled_tiff_reader, Tiled_tiff_encoder
+
+#   写入参数的常量，替身中只用来占位
+LZW = 'lzw'
+UChar = 'uchar'
+NearestNeighbor = 'nearest'
+Monochrome = 'monochrome'
+
+
+class vector_double(list):
+    def push_back(self, value):
+        self.append(value)
+
+
+class _Image():
+    def __init__(self, path):
+        self.reader = Tiled_tiff_reader(path)
+        self.levels = self.reader.levels
+        #   iter_patches会在多个线程中调用getUCharPatch，读文件时需要加锁
+        self.lock = threading.Lock()
+
+    def setCacheSize(self, size):
+        pass
+
+    def getNumberOfLevels(self):
+        return len(self.levels)
+
+    def getLevelDownsample(self, level):
+        return float(self.levels[0]['width'] / self.levels[level]['width'])
+
+    def getLevelDimensions(self, level):
+        return self.levels[level]['width'], self.levels[level]['height']
+
+    def getSpacing(self):
+        return ()
+
+    #   与ASAP一样：(x, y)为level 0上的坐标，(w, h)为该层上的尺寸，返回(h, w, 1)的uint8数组，超出图像的部分为0
+    def getUCharPatch(self, x, y, w, h, level):
+        info = self.levels[level]
+        downsample = self.getLevelDownsample(level)
+        x, y = int(x / downsample), int(y / downsample)
+        tile_width, tile_height = info['tile_width'], info['tile_height']
+        patch = np.zeros((h, w, 1), dtype=np.uint8)
+        x_lb, y_lb = max(x, 0), max(y, 0)
+        x_ub, y_ub = min(x + w, info['width']), min(y + h, info['height'])
+        for tile_y in range(y_lb // tile_height, (y_ub - 1) // tile_height + 1 if y_ub > y_lb else 0):
+            for tile_x in range(x_lb // tile_width, (x_ub - 1) // tile_width + 1 if x_ub > x_lb else 0):
+                with self.lock:
+                    tile = self.reader.read_tile(level, tile_x, tile_y)
+                cross_x_lb, cross_x_ub = max(tile_x * tile_width, x_lb), min((tile_x + 1) * tile_width, x_ub)
+                cross_y_lb, cross_y_ub = max(tile_y * tile_height, y_lb), min((tile_y + 1) * tile_height, y_ub)
+                patch[cross_y_lb - y:cross_y_ub - y, cross_x_lb - x:cross_x_ub - x, 0] = \
+                    tile[cross_y_lb - tile_y * tile_height:cross_y_ub - tile_y * tile_height,
+                         cross_x_lb - tile_x * tile_width:cross_x_ub - tile_x * tile_width]
+        return patch
+
+    def close(self):
+        self.reader.close()
+
+
+class MultiResolutionImageReader():
+    def open(self, path):
+        if not os.path.isfile(path):
+            return None
+        return _Image(path)
+
+
+class MultiResolutionImageWriter():
+    def __init__(self):
+        self.path = None
+        self.tile_size = 512
+        self.spacing = None
+        self.width = self.height = 0
+        self.tiles = {}
+
+    def openFile(self, path):
+        self.path = path
+
+    def setTileSize(self, tile_size):
+        self.tile_size = int(tile_size)
+
+    def setCompression(self, compression):
+        pass
+
+    def setDataType(self, data_type):
+        pass
+
+    def setInterpolation(self, interpolation):
+        pass
+
+    def setColorType(self, color_type):
+        pass
+
+    def setSpacing(self, spacing):
+        self.spacing = spacing[0]
+
+    def writeImageInformation(self, width, height):
+        self.width, self.height = int(width), int(height)
+
+    #   data为展平的tile，(x, y)必须对齐到tile的网格
+    def writeBaseImagePartToLocation(self, data, x, y):
+        tile = np.asarray(data, dtype=np.uint8).reshape(self.tile_size, self.tile_size)
+        self.tiles[(int(x) // self.tile_size, int(y) // self.tile_size)] = tile.copy()
+
+    def finishImage(self):
+        encoder = Tiled_tiff_encoder(self.path, self.tile_size, compression='deflate', spacing=self.spacing)
+        width, height, downsample = self.width, self.height, 1
+        tiles = self.tiles
+        while True:
+            level = encoder.add_level(width, height, downsample)
+            for (tile_x, tile_y), tile in sorted(tiles.items(), key=lambda item: (item[0][1], item[0][0])):
+                encoder.write_tile(level, tile_x, tile_y, tile)
+            if max(width, height) <= self.tile_size:
+                break
+            #   下一层：每个tile由上一层2x2个tile最近邻降采样得到，没有写过的tile为0
+            half = self.tile_size // 2
+            parents = {}
+            for (tile_x, tile_y), tile in tiles.items():
+                key = (tile_x // 2, tile_y // 2)
+                if key not in parents:
+                    parents[key] = np.zeros((self.tile_size, self.tile_size), dtype=np.uint8)
+                parents[key][(tile_y % 2) * half:(tile_y % 2 + 1) * half,
+                             (tile_x % 2) * half:(tile_x % 2 + 1) * half] = tile[::2, ::2]
+            tiles = parents
+            downsample *= 2
+            width, height = int(np.ceil(self.width / downsample)), int(np.ceil(self.height / downsample))
+        encoder.close()
+        self.tiles = {}
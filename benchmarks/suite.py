@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#   Tiff_writer.write()/finish()、build_tif_from_image以及mir_based_slide.read_region的综合benchmark
+#   负载(--workloads)：
+#       raster：按行优先的顺序写满整张画布(分割结果逐行输出的情况)
+#       random：随机位置、互相重叠的tile，总面积为画布的两倍(缓存不断淘汰、写回暂存)
+#       sparse：按行优先写满画布，但只有约2%的tile含有前景(大部分是默认值，测试跳过默认块的路径)
+#       dense：每个像素都是随机标签(压缩最耗时的情况)
+#       upscale：build_tif_from_image把1/32大小的mask放大到画布大小
+#       read：随机读取level 0上的patch(大小为tile-size)，报告单次read_region的延迟分位数
+#   对画布大小(--sizes)、写入tile大小(--tile-sizes)、chunk大小(--chunk-sizes)做全组合，
+#   每个组合在单独的子进程中运行，记录耗时、吞吐量(百万像素/秒)以及子进程的峰值内存(RSS)
+#   --save-baseline把结果保存成json，--baseline与之对比，耗时变慢超过--tolerance时标记为REGRESSION并返回非0
+#   没有安装ASAP时(或--mir fake)使用benchmarks/fake_mir中的替身，read负载以及encoder='mir'都可以运行
+#   用法：
+#       python benchmarks/suite.py [--sizes 4096,8192] [--tile-sizes 256,512] [--chunk-sizes 1024]
+#                                  [--workloads raster,random,sparse,dense,upscale,read] [--encoder numpy]
+#                                  [--save-baseline benchmarks/baseline.json | --baseline benchmarks/baseline.json]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+workloads = ['raster', 'random', 'sparse', 'dense', 'upscale', 'read']
+
+
+#   在子进程中导入tif_writer：找不到ASAP或指定了fake时，把替身放在sys.path的最前面
+def setup_imports(mir):
+    sys.path.insert(0, os.path.join(here, '..'))
+    if mir == 'fake':
+        sys.path.insert(0, os.path.join(here, 'fake_mir'))
+    elif mir == 'auto':
+        try:
+            import multiresolutionimageinterface  # noqa: F401
+        except ImportError:
+            sys.path.insert(0, os.path.join(here, 'fake_mir'))
+
+
+#   像分割结果一样的标签：每个标签延续一小段
+def label_tile(rng, height, width, run=16):
+    import numpy as np
+    runs = rng.integers(1, 8, (height, -(-width // run))).astype(np.uint8)
+    return np.repeat(runs, run, axis=1)[:, :width]
+
+
+def raster_positions(size, tile_size):
+    return [(x, y) for y in range(0, size, tile_size) for x in range(0, size, tile_size)]
+
+
+def run_write(workload, size, tile_size, chunk_size, encoder, store, workdir, seed=0):
+    import time
+    import numpy as np
+    from tif_writer.tifflib import Tiff_writer
+    rng = np.random.default_rng(seed)
+    path = os.path.join(workdir, workload + '.tif')
+    writer = Tiff_writer(path, size, size, chunk_size=chunk_size, write_tile_size=min(tile_size, chunk_size),
+                         store=store, encoder=encoder, progress=lambda event: None)
+    if workload == 'random':
+        count = 2 * (size // tile_size) ** 2
+        positions = list(zip(rng.integers(-tile_size // 2, size, count), rng.integers(-tile_size // 2, size, count)))
+    else:
+        positions = raster_positions(size, tile_size)
+    #   数据事先生成好，不计入耗时
+    pool = [label_tile(rng, tile_size, tile_size) for _ in range(8)]
+    if workload == 'dense':
+        pool = [rng.integers(0, 256, (tile_size, tile_size)).astype(np.uint8) for _ in range(8)]
+    empty = np.zeros((tile_size, tile_size), dtype=np.uint8)
+    foreground = rng.random(len(positions)) < 0.02
+
+    start = time.perf_counter()
+    for i, (x, y) in enumerate(positions):
+        if workload == 'sparse' and not foreground[i]:
+            writer.write(int(x), int(y), empty)
+        else:
+            writer.write(int(x), int(y), pool[i % len(pool)])
+    write_seconds = time.perf_counter() - start
+    writer.finish()
+    seconds = time.perf_counter() - start
+    stats = writer.stats()
+    os.remove(path)
+    return {'seconds': seconds, 'write_seconds': write_seconds, 'finish_seconds': seconds - write_seconds,
+            'mpix_per_s': size * size / 1e6 / seconds, 'write_p99_us': stats['histograms']['write']['p99_us']}
+
+
+def run_upscale(size, tile_size, workdir, seed=0):
+    import time
+    import numpy as np
+    from tif_writer.tifflib import build_tif_from_image
+    rng = np.random.default_rng(seed)
+    small = size // 32
+    #   一些随机的矩形前景
+    image = np.zeros((small, small), dtype=np.uint8)
+    for _ in range(max(small // 16, 1)):
+        x, y = rng.integers(0, small, 2)
+        image[y:y + small // 8, x:x + small // 8] = rng.integers(1, 8)
+    path = os.path.join(workdir, 'upscale.tif')
+    start = time.perf_counter()
+    build_tif_from_image(image, path, expand_rate=32, tile_size=tile_size, progress=lambda event: None)
+    seconds = time.perf_counter() - start
+    os.remove(path)
+    return {'seconds': seconds, 'mpix_per_s': size * size / 1e6 / seconds}
+
+
+def run_read(size, tile_size, chunk_size, workdir, seed=0, patches=500):
+    import time
+    import numpy as np
+    from tif_writer.tifflib import Tiff_writer
+    from tif_writer.slidelib import mir_based_slide
+    rng = np.random.default_rng(seed)
+    path = os.path.join(workdir, 'read.tif')
+    writer = Tiff_writer(path, size, size, chunk_size=chunk_size, write_tile_size=min(tile_size, chunk_size),
+                         streaming=True, progress=lambda event: None)
+    for y in range(0, size, chunk_size):
+        writer.write(0, y, label_tile(rng, chunk_size, size))
+    writer.finish()
+
+    slide = mir_based_slide().OpenSlide(path)
+    locations = rng.integers(0, max(size - tile_size, 1), (patches, 2))
+    start = time.perf_counter()
+    for x, y in locations:
+        slide.read_region((int(x), int(y)), 0, tile_size)
+    seconds = time.perf_counter() - start
+    stats = slide.stats()
+    slide.close()
+    os.remove(path)
+    latency = stats['histograms']['read_region']
+    return {'seconds': seconds, 'patches_per_s': patches / seconds, 'p50_us': latency['p50_us'],
+            'p99_us': latency['p99_us'], 'cache_hit_rate': stats['cache']['hit_rate']}
+
+
+#   子进程：运行一个组合，把结果(含峰值内存)以json打印在最后一行
+def run_case(case):
+    import resource
+    setup_imports(case['mir'])
+    workdir = tempfile.mkdtemp(dir=case['workdir'])
+    if case['workload'] == 'upscale':
+        result = run_upscale(case['size'], case['tile_size'], workdir)
+    elif case['workload'] == 'read':
+        result = run_read(case['size'], case['tile_size'], case['chunk_size'], workdir)
+    else:
+        result = run_write(case['workload'], case['size'], case['tile_size'], case['chunk_size'], case['encoder'],
+                           case['store'], workdir)
+    os.rmdir(workdir)
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    print(json.dumps(result))
+
+
+def case_key(case):
+    return '{}/{}/{}/{}/{}'.format(case['workload'], case['size'], case['tile_size'], case['chunk_size'],
+                                   case['encoder'])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='4096')
+    parser.add_argument('--tile-sizes', default='512')
+    parser.add_argument('--chunk-sizes', default='1024')
+    parser.add_argument('--workloads', default=','.join(workloads))
+    parser.add_argument('--encoder', default='numpy')
+    parser.add_argument('--store', default='hdf5')
+    parser.add_argument('--mir', default='auto', choices=['auto', 'fake', 'real'])
+    parser.add_argument('--repeat', type=int, default=1, help='keep the fastest of n runs')
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--save-baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown against the baseline')
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--run-case', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case is not None:
+        run_case(json.loads(args.run_case))
+        return
+
+    workdir = args.workdir if args.workdir is not None else tempfile.mkdtemp()
+    cases = []
+    for workload in args.workloads.split(','):
+        if workload not in workloads:
+            print('unknown workload "{}", should be one of {}'.format(workload, workloads))
+            raise ValueError
+        for size in [int(value) for value in args.sizes.split(',')]:
+            for tile_size in [int(value) for value in args.tile_sizes.split(',')]:
+                #   upscale只与画布和tile大小有关
+                chunk_sizes = [1024] if workload == 'upscale' else [int(value) for value in args.chunk_sizes.split(',')]
+                for chunk_size in chunk_sizes:
+                    cases.append({'workload': workload, 'size': size, 'tile_size': tile_size,
+                                  'chunk_size': chunk_size, 'encoder': args.encoder, 'store': args.store,
+                                  'mir': args.mir, 'workdir': workdir})
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = 0
+    print('{:<36s} {:>9s} {:>9s} {:>10s} {:>9s}  {}'.format('case', 'time(s)', 'MPix/s', 'peak(MB)', 'vs base',
+                                                            'extra'))
+    for case in cases:
+        best = None
+        for _ in range(max(args.repeat, 1)):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-case', json.dumps(case)],
+                                    stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            if best is None or result['seconds'] < best['seconds']:
+                best = result
+        key = case_key(case)
+        results[key] = best
+        comparison = ''
+        if key in baseline:
+            ratio = best['seconds'] / baseline[key]['seconds']
+            comparison = '{:.2f}x'.format(ratio)
+            if ratio > 1 + args.tolerance:
+                comparison += ' REGRESSION'
+                regressions += 1
+        extra = ', '.join('{}={:.4g}'.format(name, value) for name, value in best.items()
+                          if name not in ('seconds', 'mpix_per_s', 'peak_rss_mb'))
+        print('{:<36s} {:>9.3f} {:>9s} {:>10.1f} {:>9s}  {}'.format(
+            key, best['seconds'], '{:.1f}'.format(best['mpix_per_s']) if 'mpix_per_s' in best else '-',
+            best['peak_rss_mb'], comparison, extra))
+        sys.stdout.flush()
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+        print('baseline saved to {}'.format(args.save_baseline))
+    if regressions > 0:
+        print('{} case(s) slower than the baseline by more than {:.0%}'.format(regressions, args.tolerance))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
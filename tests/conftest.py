@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+import pytest
+
+
+#   不打印提示信息的进度回调
+@pytest.fixture
+def quiet():
+    def callback(event):
+        pass
+    return callback
+
+
+#   暂存文件写在当前目录下(与目标tiff同名)，测试在临时目录中进行
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+#   read_levels(path)：用内置的读取器读出一个tiff的所有层(完整的ndarray，去掉边缘tile的填充)
+@pytest.fixture
+def read_levels():
+    from tif_writer.tiffio import Tiled_tiff_reader
+
+    def read(path):
+        reader = Tiled_tiff_reader(path)
+        levels = []
+        for level, info in enumerate(reader.levels):
+            rows = []
+            for tile_y in range(info['offsets'].shape[0]):
+                rows.append(np.concatenate([reader.read_tile(level, tile_x, tile_y)
+                                            for tile_x in range(info['offsets'].shape[1])], axis=1))
+            levels.append(np.concatenate(rows, axis=0)[:info['height'], :info['width']])
+        reader.close()
+        return levels
+    return read
+
+
+#   没有安装ASAP时，使用benchmarks/fake_mir中的替身读取slide
+@pytest.fixture
+def mir(monkeypatch):
+    try:
+        import multiresolutionimageinterface  # noqa: F401
+    except ImportError:
+        monkeypatch.syspath_prepend(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks',
+                                                 'fake_mir'))
+
+
+#   边长为奇数的slide(3001x2999，各层的降采样倍数不是整数)，每个像素都是随机值，错开一个像素就能发现
+#   返回(路径, 各层的ndarray)
+@pytest.fixture
+def odd_slide(workdir, quiet, mir, read_levels):
+    from tif_writer.tifflib import Tiff_writer
+    image = np.random.default_rng(0).integers(0, 256, (2999, 3001)).astype(np.uint8)
+    writer = Tiff_writer('odd_slide.tif', 3001, 2999, chunk_size=512, store='memory', progress=quiet)
+    writer.write(0, 0, image)
+    writer.finish()
+    path = str(workdir / 'odd_slide.tif')
+    return path, read_levels(path)
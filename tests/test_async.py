@@ -0,0 +1,45 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from tif_writer.tifflib import Tiff_writer
+
+
+#   同时await大量写入(不使用后台队列)时，结果与按顺序写入相同
+@pytest.mark.parametrize('store', ['hdf5', 'memory'])
+def test_concurrent_write_async(workdir, quiet, store):
+    rng = np.random.default_rng(0)
+    positions = [(int(x), int(y)) for x, y in rng.integers(0, 2048 - 128, (400, 2))]
+    tiles = [np.full((128, 128), i % 250 + 1, dtype=np.uint8) for i in range(len(positions))]
+    writer = Tiff_writer('async.tif', 2048, 2048, chunk_size=256, write_tile_size=128,
+                         cache_bytes=4 * 256 ** 2, store=store, progress=quiet)
+
+    async def run():
+        await asyncio.gather(*[writer.write_async(x, y, tile) for (x, y), tile in zip(positions, tiles)],
+                             writer.write_many_async([0, 512], [0, 512], np.stack(tiles[:2])))
+
+    asyncio.run(run())
+    expected = np.zeros((2048, 2048), dtype=np.uint8)
+    for (x, y), tile in zip(positions, tiles):
+        expected[y:y + 128, x:x + 128] = tile
+    expected[0:128, 0:128] = tiles[0]
+    expected[512:640, 512:640] = tiles[1]
+    assert np.array_equal(writer.read(0, 0, 2048, 2048), expected)
+    asyncio.run(writer.finish_async())
+
+
+#   后台写入出错时，finish()/finish_async()抛出错误，同时后台线程和执行器都已经退出
+@pytest.mark.parametrize('use_async', [False, True])
+def test_failed_finish_releases_threads(workdir, quiet, use_async):
+    writer = Tiff_writer('failed.tif', 1024, 1024, chunk_size=256, write_tile_size=256, store='memory', queue_size=4,
+                         progress=quiet)
+    writer.write(0, 0, np.ones((64, 64, 3), dtype=np.uint8))
+    with pytest.raises(ValueError):
+        if use_async:
+            asyncio.run(writer.finish_async())
+        else:
+            writer.finish()
+    assert not writer.background_thread.is_alive()
+    assert writer.queue is None
+    assert writer.async_executor is None
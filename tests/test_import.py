@@ -0,0 +1,58 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+#   模块 -> 导入后不应出现在sys.modules中的模块
+forbidden_modules = {'tif_writer': ['numpy', 'h5py', 'PIL', 'multiresolutionimageinterface'],
+                     'tif_writer.tifflib': ['h5py', 'PIL', 'multiresolutionimageinterface'],
+                     'tif_writer.tiffio': ['h5py', 'PIL', 'multiresolutionimageinterface'],
+                     'tif_writer.chunkstore': ['h5py', 'PIL', 'multiresolutionimageinterface'],
+                     'tif_writer.files': ['h5py', 'PIL', 'multiresolutionimageinterface'],
+                     'tif_writer.slidelib': ['h5py', 'PIL', 'multiresolutionimageinterface', 'multiprocessing'],
+                     'tif_writer.mapping': ['h5py', 'PIL', 'multiresolutionimageinterface', 'multiprocessing']}
+
+#   导入耗时的预算(毫秒)：不依赖numpy的tif_writer为固定值，其余在"import numpy"的基础上允许的额外耗时
+#   比benchmarks/bench_import.py的默认值宽松，只拦截明显的回归(例如又在import时导入了h5py)
+budget_ms = 100.
+repeat = 3
+
+probe = '''
+import sys, time, json
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'loaded': [name for name in {forbidden!r} if name in sys.modules]}}))
+'''
+
+
+#   在新的解释器中导入若干次，返回最快的一次
+def measure(module, forbidden=()):
+    best = None
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', probe.format(root=root, module=module, forbidden=list(forbidden))],
+                                stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+
+@pytest.fixture(scope='module')
+def numpy_ms():
+    return measure('numpy')['seconds'] * 1000
+
+
+#   导入各模块不会提前导入重依赖，耗时也在预算之内
+@pytest.mark.parametrize('module', list(forbidden_modules))
+def test_import_is_light(module, numpy_ms):
+    forbidden = forbidden_modules[module]
+    result = measure(module, forbidden)
+    assert result['loaded'] == []
+    budget = budget_ms if 'numpy' in forbidden else numpy_ms + budget_ms
+    assert result['seconds'] * 1000 <= budget
@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+from tif_writer.mapping import map_tiles
+
+
+#   恒等映射
+def identity(patch):
+    return patch
+
+
+#   在边长为奇数的slide的高层级上做映射，带不带halo，结果都与该层的像素完全一致
+@pytest.mark.parametrize('level', [1, 2])
+@pytest.mark.parametrize('halo', [0, 5])
+def test_map_tiles_on_odd_slide_level(odd_slide, quiet, read_levels, level, halo):
+    path, levels = odd_slide
+    map_tiles(path, identity, 'mapped.tif', level=level, tile_size=256, halo=halo, chunk_size=256,
+              write_tile_size=256, store='memory', progress=quiet)
+    assert np.array_equal(read_levels('mapped.tif')[0], levels[level])
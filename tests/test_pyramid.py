@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from tif_writer.pyramid import reductions
+from tif_writer.tifflib import Tiff_writer
+
+
+#   画布之外的写入不能影响奇数边长的层
+@pytest.mark.parametrize('reduction', ['max', 'majority'])
+def test_writes_outside_odd_canvas_do_not_leak(tmp_path, quiet, read_levels, reduction):
+    path = str(tmp_path / 'odd.tif')
+    writer = Tiff_writer(path, 1001, 1001, chunk_size=256, write_tile_size=256, reduction=reduction,
+                         store='memory', progress=quiet)
+    writer.write(1001, 0, np.full((256, 256), 255, dtype=np.uint8))
+    writer.write(0, 1001, np.full((256, 256), 255, dtype=np.uint8))
+    writer.finish()
+    for level in read_levels(path):
+        assert level.max() == 0
+
+
+#   只由画布内像素计算的参考金字塔
+def reference_levels(image, reduction, count):
+    levels = [image]
+    for _ in range(count - 1):
+        level = levels[-1]
+        padded = np.zeros((level.shape[0] + level.shape[0] % 2, level.shape[1] + level.shape[1] % 2), dtype=np.uint8)
+        padded[:level.shape[0], :level.shape[1]] = level
+        levels.append(reductions[reduction](padded))
+    return levels
+
+
+#   更新已有的tiff与重新生成得到的各层都与参考结果相同，画布外写入的255不会进入任何一层
+@pytest.mark.parametrize('reduction', ['max', 'majority'])
+def test_update_matches_rebuild_on_odd_canvas(tmp_path, quiet, read_levels, reduction):
+    rng = np.random.default_rng(0)
+    canvas = np.full((1024, 1024), 255, dtype=np.uint8)
+    canvas[:1001, :1001] = rng.integers(0, 4, (1001, 1001))
+    patch = rng.integers(0, 4, (256, 256)).astype(np.uint8)
+
+    def build(path):
+        writer = Tiff_writer(path, 1001, 1001, chunk_size=256, write_tile_size=256, reduction=reduction,
+                             store='memory', progress=quiet)
+        for y in range(0, 1001, 256):
+            for x in range(0, 1001, 256):
+                writer.write(x, y, canvas[y:y + 256, x:x + 256])
+        return writer
+
+    updated, rebuilt = str(tmp_path / 'updated.tif'), str(tmp_path / 'rebuilt.tif')
+    build(updated).finish()
+    writer = Tiff_writer(updated, 1001, 1001, write_tile_size=256, reduction=reduction, store='memory',
+                         update=True, progress=quiet)
+    writer.write(600, 600, patch)
+    writer.finish()
+
+    writer = build(rebuilt)
+    writer.write(600, 600, patch)
+    writer.finish()
+
+    expected = canvas[:1001, :1001].copy()
+    expected[600:856, 600:856] = patch
+    rebuilt_levels = read_levels(rebuilt)
+    assert len(rebuilt_levels) == 3
+    for updated_level, rebuilt_level, expected_level in zip(read_levels(updated), rebuilt_levels,
+                                                            reference_levels(expected, reduction, 3)):
+        assert np.array_equal(rebuilt_level, expected_level)
+        assert np.array_equal(updated_level, expected_level)
@@ -0,0 +1,20 @@
+import numpy as np
+
+from tif_writer.tifflib import Tiff_writer
+from tif_writer.tiffio import Tiled_tiff_reader
+
+
+#   被多边形完全覆盖的chunk直接指向同一个均匀tile，其余的chunk按实际内容写入
+def test_fully_covered_chunks_share_the_uniform_tile(workdir, quiet):
+    square = np.array([[0, 0], [1536, 0], [1536, 1536], [0, 1536]], dtype=float)
+    writer = Tiff_writer('polygons.tif', 2000, 2000, chunk_size=512, progress=quiet)
+    writer.write_polygons([square], 6)
+    writer.finish()
+    assert writer.stats()['counters'].get('chunks_read', 0) == 0
+
+    reader = Tiled_tiff_reader('polygons.tif')
+    offsets = reader.levels[0]['offsets']
+    assert len(set(offsets[:3, :3].flatten())) == 1
+    assert (reader.read_tile(0, 1, 1) == 6).all()
+    assert (reader.read_tile(0, 3, 3) == 0).all()
+    reader.close()
@@ -0,0 +1,16 @@
+import numpy as np
+
+from tif_writer.tifflib import Tiff_writer
+
+
+#   分片的chunk有两个平面，read()返回写入的值，未写过的像素为default_val
+def test_read_on_shard_writer(workdir, quiet):
+    tile = (np.arange(300 * 200) % 50).astype(np.uint8).reshape(300, 200)
+    writer = Tiff_writer('shard.tif', 3000, 3000, default_val=7, shard=0, progress=quiet)
+    writer.write(1000, 900, tile)
+    expected = np.full((400, 400), 7, dtype=np.uint8)
+    expected[50:350, 50:250] = tile
+    assert np.array_equal(writer.read(950, 850, 400, 400), expected)
+    assert np.array_equal(writer.read(1010, 910, 20, 20), tile[10:30, 10:30])
+    writer.finish()
+    writer.free()
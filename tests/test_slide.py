@@ -0,0 +1,40 @@
+import numpy as np
+
+from tif_writer.slidelib import mir_based_slide
+
+
+#   边长为奇数的slide上，各层的缓存读取与不缓存的读取(以及该层真实的像素)完全一致，不会错开一个像素
+def test_cached_reads_match_uncached_on_odd_slide(odd_slide):
+    path, levels = odd_slide
+    cached = mir_based_slide().OpenSlide(path, cache_bytes=64 * 1024 ** 2, cache_tile_size=256)
+    uncached = mir_based_slide().OpenSlide(path, cache_bytes=0)
+    rng = np.random.default_rng(1)
+    assert cached.level_count == len(levels) > 2
+    for level, expected in enumerate(levels):
+        height, width = expected.shape
+        assert cached.level_dimensions[level] == (width, height)
+        for _ in range(20):
+            size = (int(rng.integers(1, 300)), int(rng.integers(1, 300)))
+            x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+            location = cached.level0_location((x, y), level)
+            patch = cached.read_region(location, level, size, channels='native')
+            assert np.array_equal(patch, uncached.read_region(location, level, size, channels='native'))
+            crop = expected[y:y + size[1], x:x + size[0]]
+            assert np.array_equal(patch[:crop.shape[0], :crop.shape[1], 0], crop)
+    cached.close()
+    uncached.close()
+
+
+#   iter_patches给出的location按ASAP换算回该层后正好落在网格上
+def test_iter_patches_locations_on_odd_slide(odd_slide):
+    path, levels = odd_slide
+    slide = mir_based_slide().OpenSlide(path, cache_tile_size=256)
+    for level in range(1, len(levels)):
+        height, width = levels[level].shape
+        for x, y, patch in slide.iter_patches(level, 200, workers=2, channels='native'):
+            x = int(x / slide.level_downsamples[level])
+            y = int(y / slide.level_downsamples[level])
+            assert x % 200 == 0 or x == width - 200
+            assert y % 200 == 0 or y == height - 200
+            assert np.array_equal(patch[:, :, 0], levels[level][y:y + 200, x:x + 200])
+    slide.close()
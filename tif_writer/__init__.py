@@ -0,0 +1,51 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''Lazy top-level namespace of tif_writer, e.g. from tif_writer import Tiff_writer'''
+
+#   公开的接口按需导入(PEP 562)：import tif_writer本身不会导入numpy/h5py/PIL/ASAP，
+#   第一次访问tif_writer.Tiff_writer之类的名字时才导入对应的模块，
+#   所以只用到其中一部分的短进程(例如spawn方式的进程池中的worker)不需要为其它依赖付出导入的开销
+#   Public names are imported on first access (PEP 562): importing tif_writer itself pulls in none of
+#   numpy/h5py/PIL/ASAP, so short-lived worker processes only pay for the modules they actually use.
+
+import importlib
+
+_exports = {'Tiff_writer': 'tifflib',
+            'build_tif_from_image': 'tifflib',
+            'mir_based_slide': 'slidelib',
+            'get_preview': 'slidelib',
+            'Foreground_index': 'foreground',
+            'otsu_threshold': 'foreground',
+            'map_tiles': 'mapping',
+            'Label_index': 'labelindex',
+            'load_label_index': 'labelindex',
+            'Lru_cache': 'cache',
+            'make_chunk_store': 'chunkstore',
+            'Tiled_tiff_encoder': 'tiffio',
+            'Tiled_tiff_reader': 'tiffio',
+            'Stats_recorder': 'monitor',
+            'Progress_reporter': 'monitor',
+            'terminal_progress': 'monitor',
+            'terminal_viewer': 'monitor'}
+
+_submodules = ['anything', 'cache', 'calc', 'chunkstore', 'files', 'foreground', 'imgprocessing', 'labelindex',
+               'mapping', 'monitor', 'plotter', 'pyramid', 'rasterize', 'slidelib', 'tiffio', 'tifflib']
+
+__all__ = list(_exports.keys())
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module('.' + _exports[name], __name__), name)
+    elif name in _submodules:
+        value = importlib.import_module('.' + name, __name__)
+    else:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    #   之后的访问不再经过__getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals().keys()) | set(_exports.keys()) | set(_submodules))
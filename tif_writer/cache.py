@@ -0,0 +1,87 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+
+'''Byte-bounded LRU cache, used for keeping decoded chunks/tiles in memory'''
+
+
+#   初始化参数：
+#       capacity_bytes: 缓存容量(字节)，超出后按最近最少使用的顺序淘汰
+#       on_evict: 淘汰回调on_evict(key, value)，例如用于把脏数据写回暂存文件
+#   方法：
+#       get(key)：命中则返回缓存值并计数hits，否则返回None并计数misses
+#       put(key, value)：放入缓存，必要时淘汰旧数据(至少保留刚放入的那一项)
+#       pop(key)：移出缓存，不触发on_evict
+#       evict_all()：按LRU顺序淘汰所有数据，会触发on_evict
+#       clear()：清空缓存，不触发on_evict
+#       stats()：返回命中/未命中/淘汰次数以及当前占用
+class Lru_cache():
+    def __init__(self, capacity_bytes, on_evict=None):
+        self.capacity_bytes = int(capacity_bytes)
+        self.on_evict = on_evict
+        self.items = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        value = self.items.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    #   只查看，不改变LRU顺序，也不计数
+    def peek(self, key):
+        return self.items.get(key)
+
+    def put(self, key, value):
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.nbytes -= old.nbytes
+        self.items[key] = value
+        self.nbytes += value.nbytes
+        #   超出容量时从最旧的开始淘汰，但不淘汰刚放进来的这一项
+        while self.nbytes > self.capacity_bytes and len(self.items) > 1:
+            self.__evict_oldest()
+
+    def pop(self, key):
+        value = self.items.pop(key, None)
+        if value is not None:
+            self.nbytes -= value.nbytes
+        return value
+
+    def evict_all(self):
+        while len(self.items) > 0:
+            self.__evict_oldest()
+
+    def clear(self):
+        self.items.clear()
+        self.nbytes = 0
+
+    def __evict_oldest(self):
+        key, value = self.items.popitem(last=False)
+        self.nbytes -= value.nbytes
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / total if total > 0 else 0.,
+                'items': len(self.items),
+                'nbytes': self.nbytes,
+                'capacity_bytes': self.capacity_bytes}
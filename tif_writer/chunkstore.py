@@ -0,0 +1,194 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+
+'''Staging stores used by Tiff_writer for keeping chunks before the final tif is written'''
+
+
+#   所有暂存后端都提供同样的接口：
+#       read(x_chunk_id, y_chunk_id)：读出一个chunk，默认是(chunk_size, chunk_size)的uint8 ndarray
+#           planes大于1时为(planes, chunk_size, chunk_size)，dtype由构建时的dtype指定(例如累加写入时的float32)
+#       write(x_chunk_id, y_chunk_id, data)：写入一个chunk
+#       save(accessed)：把数据以及accessed矩阵持久化
+#       close()：关闭后端
+#       free()：删除后端产生的临时文件
+#   只有accessed矩阵中为True的chunk才会被读，所以后端不需要为未访问过的chunk准备数据
+#   reopen为'r'(只读)或'r+'(读写)时打开已经save()过的暂存文件(例如分片写入的各个shard，或中断后继续写入)，
+#   此时load_accessed()返回保存的accessed矩阵(从未save()过时返回None)；'memory'后端不会留下文件，不支持reopen
+
+#   Every staging backend offers the same methods:
+#       read(x_chunk_id, y_chunk_id): return one chunk as a (chunk_size, chunk_size) uint8 ndarray,
+#           or (planes, chunk_size, chunk_size) of the given dtype when planes > 1
+#       write(x_chunk_id, y_chunk_id, data): store one chunk
+#       save(accessed): persist data together with the accessed matrix
+#       close(): close the backend
+#       free(): remove temporary files created by the backend
+#   Only chunks marked in the accessed matrix are ever read back.
+#   With reopen='r' (read only) or 'r+' (read/write) an already saved store is opened, e.g. a shard written by another
+#   process or an interrupted job; load_accessed() then returns the saved accessed matrix (None if never saved).
+#   The 'memory' backend leaves no file behind and cannot be reopened.
+
+
+#   基于hdf5的暂存：整张图是一个按chunk分块存储的'value'数据集，分块大小与chunk一致
+#   数据集在第一次写入时才创建，hdf5只为写过的分块分配空间，所以构建的耗时与画布大小无关
+#   chunk直接用整数下标切片访问，不再需要按名字查找group
+class Hdf5_chunk_store():
+    suffix = '_temp.hdf5'
+
+    def __init__(self, name, horizontal_chunk_amount, vertical_chunk_amount, chunk_size, default_val=0,
+                 planes=1, dtype=np.uint8, reopen=None):
+        import h5py
+        self.path = name + self.suffix
+        self.horizontal_chunk_amount = horizontal_chunk_amount
+        self.vertical_chunk_amount = vertical_chunk_amount
+        self.chunk_size = chunk_size
+        self.default_val = default_val
+        self.planes = planes
+        self.dtype = dtype
+        if reopen is not None:
+            self.f = h5py.File(self.path, reopen)
+            self.value = self.f['value'] if 'value' in self.f else None
+            return
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.f = h5py.File(self.path, 'w')
+        self.value = None
+
+    def __create_value(self):
+        shape = (self.planes, self.vertical_chunk_amount * self.chunk_size,
+                 self.horizontal_chunk_amount * self.chunk_size)
+        self.value = self.f.create_dataset('value', shape=shape, dtype=self.dtype,
+                                           chunks=(self.planes, self.chunk_size, self.chunk_size),
+                                           fillvalue=self.default_val if self.planes == 1 else 0)
+
+    def read(self, x_chunk_id, y_chunk_id):
+        y_lb = y_chunk_id * self.chunk_size
+        x_lb = x_chunk_id * self.chunk_size
+        data = self.value[:, y_lb:y_lb + self.chunk_size, x_lb:x_lb + self.chunk_size]
+        return data[0] if self.planes == 1 else data
+
+    def write(self, x_chunk_id, y_chunk_id, data):
+        if self.value is None:
+            self.__create_value()
+        y_lb = y_chunk_id * self.chunk_size
+        x_lb = x_chunk_id * self.chunk_size
+        self.value[:, y_lb:y_lb + self.chunk_size, x_lb:x_lb + self.chunk_size] = \
+            data.reshape((self.planes, self.chunk_size, self.chunk_size))
+
+    def save(self, accessed):
+        if 'accessed' in self.f:
+            self.f['accessed'][...] = accessed
+        else:
+            self.f.create_dataset(name='accessed', dtype=bool, data=accessed)
+        self.f.flush()
+
+    def load_accessed(self):
+        if 'accessed' not in self.f:
+            return None
+        return self.f['accessed'][...]
+
+    def close(self):
+        self.f.close()
+
+    def free(self):
+        os.remove(self.path)
+
+
+#   纯内存暂存：适用于整张图能放进内存的情况
+class Memory_chunk_store():
+    suffix = None
+
+    def __init__(self, name, horizontal_chunk_amount, vertical_chunk_amount, chunk_size, default_val=0,
+                 planes=1, dtype=np.uint8, reopen=None):
+        if reopen is not None:
+            print('the memory chunk store cannot be reopened, use "hdf5" or "memmap"')
+            raise ValueError
+        self.dtype = dtype
+        self.chunks = {}
+
+    def read(self, x_chunk_id, y_chunk_id):
+        return self.chunks[(x_chunk_id, y_chunk_id)].copy()
+
+    def write(self, x_chunk_id, y_chunk_id, data):
+        self.chunks[(x_chunk_id, y_chunk_id)] = np.array(data, dtype=self.dtype)
+
+    def save(self, accessed):
+        pass
+
+    def close(self):
+        pass
+
+    def free(self):
+        self.chunks = {}
+
+
+#   基于np.memmap的暂存：所有chunk按顺序平铺在一个文件中，每个chunk在文件中是连续的一段
+#   文件在创建时只是设定了长度，未写入的chunk在文件系统中是空洞(hole)，不占用磁盘
+class Memmap_chunk_store():
+    suffix = '_temp.dat'
+
+    def __init__(self, name, horizontal_chunk_amount, vertical_chunk_amount, chunk_size, default_val=0,
+                 planes=1, dtype=np.uint8, reopen=None):
+        self.path = name + self.suffix
+        self.accessed_path = name + '_temp_accessed.npy'
+        self.horizontal_chunk_amount = horizontal_chunk_amount
+        self.vertical_chunk_amount = vertical_chunk_amount
+        self.chunk_size = chunk_size
+        if reopen is None:
+            for path in (self.path, self.accessed_path):
+                if os.path.isfile(path):
+                    os.remove(path)
+        chunk_shape = (chunk_size, chunk_size) if planes == 1 else (planes, chunk_size, chunk_size)
+        self.data = np.memmap(self.path, dtype=dtype, mode='w+' if reopen is None else reopen,
+                              shape=(vertical_chunk_amount * horizontal_chunk_amount,) + chunk_shape)
+
+    def __index(self, x_chunk_id, y_chunk_id):
+        return y_chunk_id * self.horizontal_chunk_amount + x_chunk_id
+
+    def read(self, x_chunk_id, y_chunk_id):
+        return np.array(self.data[self.__index(x_chunk_id, y_chunk_id)])
+
+    def write(self, x_chunk_id, y_chunk_id, data):
+        self.data[self.__index(x_chunk_id, y_chunk_id)] = data
+
+    def save(self, accessed):
+        self.data.flush()
+        np.save(self.accessed_path, accessed)
+
+    def load_accessed(self):
+        if not os.path.isfile(self.accessed_path):
+            return None
+        return np.load(self.accessed_path)
+
+    def close(self):
+        if self.data.mode != 'r':
+            self.data.flush()
+        del self.data
+
+    def free(self):
+        for path in (self.path, self.accessed_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+chunk_stores = {'hdf5': Hdf5_chunk_store,
+                'memory': Memory_chunk_store,
+                'memmap': Memmap_chunk_store}
+
+
+#   根据名字创建暂存后端
+def make_chunk_store(store, name, horizontal_chunk_amount, vertical_chunk_amount, chunk_size, default_val=0,
+                     planes=1, dtype=np.uint8, reopen=None):
+    if store not in chunk_stores:
+        print('unknown chunk store "{}", should be one of {}'.format(store, list(chunk_stores.keys())))
+        raise ValueError
+    return chunk_stores[store](name, horizontal_chunk_amount, vertical_chunk_amount, chunk_size, default_val,
+                               planes, dtype, reopen)
+
+
+#   是否存在名为name的暂存文件(可以用reopen打开)
+def chunk_store_exists(store, name):
+    suffix = chunk_stores[store].suffix
+    return suffix is not None and os.path.isfile(name + suffix)
@@ -0,0 +1,162 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import numpy as np
+
+'''Foreground index of a slide built from its preview, used for fast foreground queries and patch sampling'''
+
+
+#   Otsu阈值：使类间方差最大的灰度值(不大于它的为一类)，values为uint8数组
+def otsu_threshold(values):
+    histogram = np.bincount(values.ravel(), minlength=256).astype(np.float64)
+    total = histogram.sum()
+    if total == 0:
+        return 0
+    levels = np.arange(256)
+    weight_background = np.cumsum(histogram)
+    weight_foreground = total - weight_background
+    sum_background = np.cumsum(histogram * levels)
+    mean_background = sum_background / np.maximum(weight_background, 1)
+    mean_foreground = (sum_background[-1] - sum_background) / np.maximum(weight_foreground, 1)
+    between = weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+    return int(np.argmax(between))
+
+
+#   初始化参数：
+#       slide: slide的路径，或已经打开的mir_based_slide
+#       level: 生成预览图的层级，默认为最低分辨率
+#       method: 'otsu'(默认，组织比背景暗，对灰度图求Otsu阈值，0值视为背景)或'nonzero'(标签图，非0即前景)
+#       threshold: 'otsu'时可以直接指定灰度阈值(不大于阈值为前景)，默认自动计算
+#       cache: 是否把索引缓存在slide旁边的 <slide名>_foreground.npz 中，
+#              缓存记录了slide的路径、修改时间以及上面的参数，任一不同时重新计算
+#   属性：
+#       mask: 阈值化后的预览图(bool)，每个像素对应level 0上downsample x downsample的区域
+#       cells: 前景像素在mask中的一维下标(压缩的前景列表)
+#       integral: mask的二维前缀和，用于O(1)计算任意矩形内的前景比例
+#   方法：
+#       fraction(x, y, w, h)：level 0上左上角为(x, y)、宽w高h的矩形中前景的比例，参数可以是数组(向量化)
+#       sample_coordinates(n, level, patch_size, min_fg)：随机采样n个在level层上大小为patch_size、前景比例不小于min_fg的patch，
+#           返回(n, 2)的数组，每行为patch左上角在level 0上的(x, y)，可以直接用于read_region
+
+#   Initialization:
+#       slide: slide path or an opened mir_based_slide
+#       level: level of the preview, the lowest resolution by default
+#       method: 'otsu' (default, tissue is darker than background, Otsu on the gray preview, 0 is background)
+#               or 'nonzero' (label masks, every non-zero pixel is foreground)
+#       threshold: gray threshold for 'otsu' (pixels not above it are foreground), computed automatically by default
+#       cache: keep the index in <slide name>_foreground.npz next to the slide, keyed by slide path, mtime and the
+#              parameters above; it is rebuilt whenever one of them differs
+#   Attributes:
+#       mask: thresholded preview (bool), each pixel covers downsample x downsample pixels of level 0
+#       cells: flat indices of the foreground pixels of mask (compressed foreground list)
+#       integral: summed-area table of mask for O(1) box queries
+#   Method:
+#       fraction(x, y, w, h): foreground fraction of level 0 boxes, arguments may be arrays
+#       sample_coordinates(n, level, patch_size, min_fg): sample n patches of patch_size at level whose foreground
+#           fraction is at least min_fg, returns an (n, 2) array of level 0 top left (x, y) usable by read_region
+class Foreground_index():
+    def __init__(self, slide, level=None, method='otsu', threshold=None, cache=True):
+        from .slidelib import mir_based_slide
+        if method not in ('otsu', 'nonzero'):
+            print('method must be "otsu" or "nonzero"')
+            raise ValueError
+        need_close = isinstance(slide, str)
+        if need_close:
+            slide = mir_based_slide().OpenSlide(slide, cache_bytes=0)
+        self.slide_path = slide.slide_path
+        level = slide.level_count - 1 if level is None else (level if level >= 0 else slide.level_count + level)
+        self.level = level
+        self.method = method
+        self.dimensions = tuple(slide.dimensions)
+        self.level_downsamples = list(slide.level_downsamples)
+        self.downsample = slide.level_downsamples[level]
+        self.cache_path = os.path.splitext(self.slide_path)[0] + '_foreground.npz'
+        key = np.array([os.path.abspath(self.slide_path), str(os.path.getmtime(self.slide_path)), str(level), method,
+                        str(threshold)])
+
+        self.mask = self.__load(key) if cache else None
+        if self.mask is None:
+            self.mask = self.__build(slide, level, method, threshold)
+            if cache:
+                self.__save(key)
+        if need_close:
+            slide.close()
+        self.cells = np.flatnonzero(self.mask)
+        self.integral = np.zeros((self.mask.shape[0] + 1, self.mask.shape[1] + 1), dtype=np.int64)
+        self.integral[1:, 1:] = np.cumsum(np.cumsum(self.mask, axis=0), axis=1)
+
+    @staticmethod
+    def __build(slide, level, method, threshold):
+        from .slidelib import get_preview
+        preview = get_preview(slide, level)
+        if method == 'nonzero':
+            return np.any(preview != 0, axis=2)
+        gray = np.round(preview.mean(axis=2)).astype(np.uint8)
+        if threshold is None:
+            threshold = otsu_threshold(gray[gray > 0])
+        return (gray > 0) & (gray <= threshold)
+
+    def __load(self, key):
+        if not os.path.isfile(self.cache_path):
+            return None
+        try:
+            with np.load(self.cache_path) as data:
+                if not np.array_equal(data['key'], key):
+                    return None
+                shape = tuple(data['shape'])
+                return np.unpackbits(data['mask'], count=shape[0] * shape[1]).reshape(shape).astype(bool)
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def __save(self, key):
+        try:
+            np.savez_compressed(self.cache_path, key=key, shape=np.array(self.mask.shape),
+                                mask=np.packbits(self.mask.ravel()))
+        except OSError:
+            print('warning: cannot write foreground index cache {}'.format(self.cache_path))
+
+    #   level 0上矩形(x, y, w, h)中前景的比例，矩形按预览图的像素向外取整
+    def fraction(self, x, y, w, h):
+        height, width = self.mask.shape
+        x_lb = np.clip(np.floor(np.asarray(x) / self.downsample), 0, width).astype(np.int64)
+        y_lb = np.clip(np.floor(np.asarray(y) / self.downsample), 0, height).astype(np.int64)
+        x_ub = np.clip(np.ceil((np.asarray(x) + w) / self.downsample), 0, width).astype(np.int64)
+        y_ub = np.clip(np.ceil((np.asarray(y) + h) / self.downsample), 0, height).astype(np.int64)
+        count = self.integral[y_ub, x_ub] - self.integral[y_lb, x_ub] - self.integral[y_ub, x_lb] + \
+            self.integral[y_lb, x_lb]
+        area = (x_ub - x_lb) * (y_ub - y_lb)
+        return np.where(area > 0, count / np.maximum(area, 1), 0.)
+
+    #   随机采样patch：先在前景像素中均匀抽取patch的中心，再用积分图筛掉前景比例不足的，不够时继续抽取
+    #       n：采样数量
+    #       level：patch所在的层级
+    #       patch_size：patch在该层上的尺寸，int或(宽, 高)
+    #       min_fg：最小的前景比例
+    #       seed：随机种子，或np.random.Generator
+    #       max_rounds：最多抽取的轮数，仍然不够时返回已经采到的(少于n个)
+    def sample_coordinates(self, n, level, patch_size, min_fg=0.5, seed=None, max_rounds=20):
+        rng = seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
+        size = (patch_size, patch_size) if isinstance(patch_size, int) else (int(patch_size[0]), int(patch_size[1]))
+        level_downsample = self.level_downsamples[level]
+        width, height = size[0] * level_downsample, size[1] * level_downsample
+        result = np.zeros((0, 2), dtype=np.int64)
+        if len(self.cells) == 0:
+            return result
+        for _ in range(max_rounds):
+            missing = n - len(result)
+            if missing <= 0:
+                break
+            #   每轮多抽一些，减少轮数
+            count = int(missing * 1.5) + 16
+            cells = self.cells[rng.integers(0, len(self.cells), count)]
+            cell_y, cell_x = np.divmod(cells, self.mask.shape[1])
+            center_x = (cell_x + rng.random(count)) * self.downsample
+            center_y = (cell_y + rng.random(count)) * self.downsample
+            x = np.clip(np.round(center_x - width / 2), 0, max(self.dimensions[0] - width, 0)).astype(np.int64)
+            y = np.clip(np.round(center_y - height / 2), 0, max(self.dimensions[1] - height, 0)).astype(np.int64)
+            keep = self.fraction(x, y, width, height) >= min_fg
+            result = np.concatenate([result, np.stack([x[keep], y[keep]], axis=1)])
+        if len(result) < n:
+            print('warning: only {} of {} patches have at least {} foreground'.format(len(result), n, min_fg))
+        return result[:n]
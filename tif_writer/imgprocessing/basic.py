@@ -2,10 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from PIL import Image
+
+#   PIL只在用到时才导入(import本模块不依赖PIL)
 
 #   打开一个图像文件，并读入数据
 def imread(img_path):
+    from PIL import Image
     return np.array(Image.open(img_path))
 
 #   搞这么麻烦，是因为不想在对三维图缩放的时候，把第三维也缩放了……
@@ -22,6 +24,7 @@ def imrescale_to_shape(img, target_shape, hard=False):
     # final_scale[1] = target_shape[1] / img_shape[1]
     # return scipy_ndi_int_zoom(img, final_scale, order=1, mode='nearest')
     #   使用Image库进行缩放会比ndimage快四五百倍，应注意的是resize方法的参数是(缩放后的宽,缩放后的高)
+    from PIL import Image
     img = Image.fromarray(img)
     if isinstance(target_shape, int):
         target_shape = (target_shape, target_shape)
@@ -0,0 +1,143 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+'''Per-chunk label statistics of a uint8 label tif, answering area/chunk/bounding box queries without pixel I/O'''
+
+
+#   初始化参数：
+#       width, height: 画布的尺寸
+#       chunk_size: chunk的大小
+#       default_val: 未写入区域的值，从未写过的chunk不单独记录，查询default_val时把它们算进去
+#   方法：
+#       update(x_chunk_id, y_chunk_id, chunk)：用chunk(最终的uint8数据)的内容替换该chunk的统计，只统计画布以内的部分
+#       labels()：出现过的所有标签
+#       area(label)：该标签的像素数
+#       chunks(label)：含有该标签的chunk，(n, 2)的数组，每行为(x_chunk_id, y_chunk_id)
+#       bbox(label)：该标签在level 0上的外接矩形(x_lb, y_lb, x_ub, y_ub)，上界不包含，不存在时为None
+#       save(path)：保存为npz，load_label_index(path)读回
+#   每个chunk只记录其中出现的标签，每个标签一行：(像素数, 外接矩形)，所以索引的大小与标签种类和chunk数量成正比
+
+#   Initialization:
+#       width, height: canvas size
+#       chunk_size: chunk edge length
+#       default_val: value of unwritten areas, untouched chunks are not stored but count for default_val queries
+#   Method:
+#       update(x_chunk_id, y_chunk_id, chunk): replace the statistics of a chunk with those of its final uint8 content
+#       labels(): all labels present
+#       area(label): number of pixels with this label
+#       chunks(label): (n, 2) array of (x_chunk_id, y_chunk_id) containing the label
+#       bbox(label): bounding box (x_lb, y_lb, x_ub, y_ub) on level 0, exclusive upper bounds, None if absent
+#       save(path): store as npz, read back with load_label_index(path)
+class Label_index():
+    def __init__(self, width, height, chunk_size, default_val=0):
+        self.width = int(width)
+        self.height = int(height)
+        self.chunk_size = int(chunk_size)
+        self.default_val = int(default_val)
+        horizontal_chunk_amount = int(np.ceil(width / chunk_size))
+        vertical_chunk_amount = int(np.ceil(height / chunk_size))
+        #   每个chunk在画布以内的宽和高
+        self.chunk_widths = np.minimum(chunk_size, width - np.arange(horizontal_chunk_amount) * chunk_size)
+        self.chunk_heights = np.minimum(chunk_size, height - np.arange(vertical_chunk_amount) * chunk_size)
+        self.touched = np.zeros((vertical_chunk_amount, horizontal_chunk_amount), dtype=bool)
+        #   (x_chunk_id, y_chunk_id) -> (labels, counts, boxes)，boxes每行为level 0上的(x_lb, y_lb, x_ub, y_ub)
+        self.entries = {}
+        self.arrays = None
+
+    def update(self, x_chunk_id, y_chunk_id, chunk):
+        x_chunk_id, y_chunk_id = int(x_chunk_id), int(y_chunk_id)
+        h, w = int(self.chunk_heights[y_chunk_id]), int(self.chunk_widths[x_chunk_id])
+        values = chunk[:h, :w]
+        counts = np.bincount(values.ravel(), minlength=256)
+        labels = np.flatnonzero(counts)
+        x_origin, y_origin = x_chunk_id * self.chunk_size, y_chunk_id * self.chunk_size
+        if len(labels) == 1:
+            boxes = np.array([[0, 0, w, h]], dtype=np.int64)
+        elif len(labels) <= 16:
+            #   标签不多时逐个标签比较，比下面的散列赋值快
+            rows = np.stack([(values == label).any(axis=1) for label in labels])
+            cols = np.stack([(values == label).any(axis=0) for label in labels])
+        else:
+            #   每个标签出现在哪些行、哪些列
+            row_hit = np.zeros((256, h), dtype=bool)
+            row_hit[values, np.arange(h)[:, None]] = True
+            col_hit = np.zeros((256, w), dtype=bool)
+            col_hit[values, np.arange(w)[None, :]] = True
+            rows, cols = row_hit[labels], col_hit[labels]
+        if len(labels) > 1:
+            boxes = np.stack([cols.argmax(axis=1), rows.argmax(axis=1),
+                              w - cols[:, ::-1].argmax(axis=1), h - rows[:, ::-1].argmax(axis=1)], axis=1)
+        boxes = boxes + np.array([x_origin, y_origin, x_origin, y_origin])
+        self.entries[(x_chunk_id, y_chunk_id)] = (labels.astype(np.uint8), counts[labels].astype(np.int64),
+                                                  boxes.astype(np.int64))
+        self.touched[y_chunk_id, x_chunk_id] = True
+        self.arrays = None
+
+    #   把所有chunk的记录拼成一张表：每行为(x_chunk_id, y_chunk_id, label, count, x_lb, y_lb, x_ub, y_ub)
+    def __table(self):
+        if self.arrays is None:
+            rows = [np.column_stack([np.full(len(labels), key[0]), np.full(len(labels), key[1]), labels, counts, boxes])
+                    for key, (labels, counts, boxes) in self.entries.items()]
+            self.arrays = np.concatenate(rows).astype(np.int64) if len(rows) > 0 else np.zeros((0, 8), dtype=np.int64)
+        return self.arrays
+
+    #   从未写过的chunk(全部为default_val)
+    def __untouched(self):
+        y_chunk_ids, x_chunk_ids = np.nonzero(~self.touched)
+        return x_chunk_ids, y_chunk_ids
+
+    def labels(self):
+        labels = np.unique(self.__table()[:, 2])
+        if (~self.touched).any():
+            labels = np.union1d(labels, [self.default_val])
+        return labels
+
+    def area(self, label):
+        table = self.__table()
+        area = int(table[table[:, 2] == label, 3].sum())
+        if label == self.default_val:
+            x_chunk_ids, y_chunk_ids = self.__untouched()
+            area += int((self.chunk_widths[x_chunk_ids] * self.chunk_heights[y_chunk_ids]).sum())
+        return area
+
+    def chunks(self, label):
+        table = self.__table()
+        chunks = table[table[:, 2] == label, :2]
+        if label == self.default_val:
+            chunks = np.concatenate([chunks, np.stack(self.__untouched(), axis=1)])
+        return chunks
+
+    def bbox(self, label):
+        table = self.__table()
+        boxes = table[table[:, 2] == label, 4:]
+        if label == self.default_val:
+            x_chunk_ids, y_chunk_ids = self.__untouched()
+            x_lb, y_lb = x_chunk_ids * self.chunk_size, y_chunk_ids * self.chunk_size
+            boxes = np.concatenate([boxes, np.stack([x_lb, y_lb, x_lb + self.chunk_widths[x_chunk_ids],
+                                                     y_lb + self.chunk_heights[y_chunk_ids]], axis=1)])
+        if len(boxes) == 0:
+            return None
+        return (int(boxes[:, 0].min()), int(boxes[:, 1].min()), int(boxes[:, 2].max()), int(boxes[:, 3].max()))
+
+    def save(self, path):
+        np.savez_compressed(path, size=np.array([self.width, self.height, self.chunk_size, self.default_val]),
+                            touched=self.touched, table=self.__table())
+
+
+#   读出Label_index.save()保存的索引
+def load_label_index(path):
+    with np.load(path) as data:
+        width, height, chunk_size, default_val = [int(value) for value in data['size']]
+        index = Label_index(width, height, chunk_size, default_val)
+        index.touched = data['touched']
+        table = data['table']
+    #   表是按chunk依次拼接的，同一个chunk的行是连续的
+    if len(table) > 0:
+        starts = np.flatnonzero(np.r_[True, (np.diff(table[:, 0]) != 0) | (np.diff(table[:, 1]) != 0)])
+        for rows in np.split(table, starts[1:]):
+            index.entries[(int(rows[0, 0]), int(rows[0, 1]))] = (rows[:, 2].astype(np.uint8), rows[:, 3].copy(),
+                                                                 rows[:, 4:].copy())
+    index.arrays = table
+    return index
@@ -0,0 +1,142 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sys
+import numpy as np
+
+'''Tile-parallel mapping from one slide/mask to a new tif, e.g. thresholding, dilation or relabelling'''
+
+
+#   进程池中每个进程各自打开一份slide
+_map_slide = None
+_map_fn = None
+
+
+def _init_map_worker(slide_path, fn, cache_bytes):
+    from .slidelib import mir_based_slide
+    global _map_slide, _map_fn
+    _map_slide = mir_based_slide().OpenSlide(slide_path, cache_bytes=cache_bytes)
+    _map_fn = fn
+
+
+def _map_job(x, y, level, tile_size, halo):
+    return _map_tile(_map_slide, _map_fn, x, y, level, tile_size, halo)
+
+
+#   读出(x, y)处带halo的tile(该层上的坐标)，调用fn，再去掉halo
+def _map_tile(slide, fn, x, y, level, tile_size, halo):
+    size = tile_size + 2 * halo
+    #   降采样倍数不是整数时，int((x - halo) * downsample)会被ASAP换算回x - halo - 1
+    patch = slide.read_region(slide.level0_location((x - halo, y - halo), level), level, size, channels='native')
+    result = np.asarray(fn(patch))
+    if result.ndim == 3 and result.shape[2] == 1:
+        result = result[:, :, 0]
+    if result.shape != (size, size):
+        print('fn must return an array of shape {}, got {}'.format((size, size), result.shape))
+        raise ValueError
+    return np.ascontiguousarray(result[halo:halo + tile_size, halo:halo + tile_size], dtype=np.uint8)
+
+
+#   把fn逐tile地作用在一张slide的某一层上，结果流式写成新的tiff
+#   Inputs:
+#       src_slide: 源slide的路径，或已经打开的mir_based_slide(pool='process'时每个进程会按它的路径重新打开)
+#       fn: fn(patch)，patch为(tile_size + 2 * halo, tile_size + 2 * halo, 通道数)的uint8数组(通道数与slide一致，mask为1)，
+#           返回同样大小的2-d uint8数组；pool='process'时fn必须能被pickle(模块级的函数)
+#       target_tiff: 输出的tiff路径，尺寸与源slide的该层相同
+#       level: 读取的层级
+#       tile_size: 每次处理的tile大小
+#       halo: 每个tile四周额外读取的像素数，邻域运算(例如膨胀)在tile的接缝处也是正确的；slide之外的部分按read_region的结果(通常为0)
+#       workers: 并行的进程/线程数，为1时在当前进程中依次处理
+#       pool: 'process'(默认)或'thread'(fn会释放GIL时，例如大部分numpy运算)
+#       read_ahead: 最多同时在途的tile数，默认为workers的两倍，内存占用约为 read_ahead * (tile_size + 2 * halo)^2
+#       show_process: 是否在终端显示进度(限速刷新)
+#       cache_bytes: 每个slide句柄的tile缓存容量，相邻tile的halo会重复读到同一块数据
+#       其余参数(例如default_val，compression，reduction，progress)传给Tiff_writer，写入总是按行优先的顺序流式进行
+#       给出progress回调时，tile的处理进度也以{'stage': 'map', ...}的形式交给它
+#   Inputs:
+#       src_slide: source slide path or an opened mir_based_slide (reopened from its path by every worker process)
+#       fn: fn(patch) with patch a (tile_size + 2 * halo, tile_size + 2 * halo, channels) uint8 array (1 channel for
+#           masks), returning a 2-d uint8 array of the same size; must be picklable for pool='process'
+#       target_tiff: output path, same size as the source level
+#       level: source level
+#       tile_size: size of the tiles fn is applied to
+#       halo: overlap read around every tile so neighbourhood operations are seam-free, cropped from the result;
+#             pixels outside the slide are whatever read_region returns (usually 0)
+#       workers: number of processes/threads, 1 runs everything in the calling process
+#       pool: 'process' (default) or 'thread' (when fn releases the GIL, e.g. most numpy operations)
+#       read_ahead: maximum tiles in flight (2 * workers by default), memory ~ read_ahead * (tile_size + 2 * halo)^2
+#       show_process: show a (rate limited) process bar in the terminal
+#       cache_bytes: tile cache of every slide handle, neighbouring halos decode the same slide tiles
+#       other keyword arguments (e.g. default_val, compression, reduction, progress) go to Tiff_writer, which streams
+#       in raster order; a progress callback also receives the tile progress as {'stage': 'map', ...} events
+def map_tiles(src_slide, fn, target_tiff, level=0, tile_size=1024, halo=0, workers=1, pool='process',
+              read_ahead=None, show_process=False, cache_bytes=64 * 1024 ** 2, **writer_kwargs):
+    from collections import deque
+    from .slidelib import mir_based_slide
+    from .tifflib import Tiff_writer
+    from .monitor import Progress_reporter
+
+    need_close = isinstance(src_slide, str)
+    if need_close:
+        src_slide = mir_based_slide().OpenSlide(src_slide, cache_bytes=cache_bytes)
+    width, height = src_slide.level_dimensions[level]
+    if 'spacing' not in writer_kwargs and src_slide.spacing is not None and len(src_slide.spacing) > 0:
+        writer_kwargs['spacing'] = src_slide.spacing[0] * src_slide.level_downsamples[level]
+    writer = Tiff_writer(target_tiff, width, height, streaming=True, **writer_kwargs)
+
+    locations = [(x, y) for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+    progress = writer_kwargs.get('progress')
+    reporter = None
+    if show_process or progress is not None:
+        reporter = Progress_reporter(progress, len(locations), stage='map')
+    if progress is not None:
+        reporter.message('mapping {} tiles of {} ...'.format(len(locations), src_slide.slide_path))
+    else:
+        print('mapping {} tiles of {} ...'.format(len(locations), src_slide.slide_path))
+        sys.stdout.flush()
+
+    executor = None
+    if workers > 1:
+        if pool == 'process':
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_map_worker,
+                                           initargs=(src_slide.slide_path, fn, cache_bytes))
+        elif pool == 'thread':
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=workers)
+        else:
+            print('pool must be "process" or "thread"')
+            raise ValueError
+    read_ahead = 2 * workers if read_ahead is None else max(int(read_ahead), 1)
+
+    def submit(x, y):
+        if executor is None:
+            return _map_tile(src_slide, fn, x, y, level, tile_size, halo)
+        if pool == 'process':
+            return executor.submit(_map_job, x, y, level, tile_size, halo)
+        return executor.submit(_map_tile, src_slide, fn, x, y, level, tile_size, halo)
+
+    #   按提交的顺序写入，保证写入是行优先的，同时在途的tile不超过read_ahead个
+    pending = deque()
+
+    def write_next():
+        if reporter is not None:
+            reporter.update()
+        done_x, done_y, result = pending.popleft()
+        writer.write(done_x, done_y, result if executor is None else result.result())
+
+    try:
+        for x, y in locations:
+            while len(pending) >= read_ahead:
+                write_next()
+            pending.append((x, y, submit(x, y)))
+        while len(pending) > 0:
+            write_next()
+    finally:
+        if executor is not None:
+            for _, _, result in pending:
+                result.cancel()
+            executor.shutdown(wait=True)
+        if need_close:
+            src_slide.close()
+    writer.finish()
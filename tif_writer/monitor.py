@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 #   Monitor主要实现对任务的监控和管理
 import os
+import time
 
 #   在终端显示进度条
 def terminal_viewer(current, total, head="Percent: ", tail="", interval=0):
@@ -13,4 +14,133 @@ def terminal_viewer(current, total, head="Percent: ", tail="", interval=0):
     if interval == 0 or int(current * 100 / total) % interval == 0:
         sys.stdout.write("\r%s[%s] %d%% %d/%d %s"
                          % (head, hashes + spaces, percent * 100, current, total, tail))
-        sys.stdout.flush()
\ No newline at end of file
+        sys.stdout.flush()
+
+#   进度回调的默认实现：消息直接打印，进度显示为终端进度条
+#   event为dict：{'stage', 'message'}，或{'stage', 'current', 'total', 'elapsed', 'rate'}(total可能为None)
+def terminal_progress(event):
+    import sys
+    if 'message' in event:
+        print(event['message'])
+        sys.stdout.flush()
+    elif event['total']:
+        terminal_viewer(event['current'], event['total'], head='{}: '.format(event['stage']))
+        if event['current'] >= event['total']:
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+
+
+#   限速的进度报告：update()可以在热路径上频繁调用，只有距离上一次回调超过interval秒(或已完成)时才调用callback
+#   初始化参数：
+#       callback: callback(event)，例如把进度发给任务面板，默认为terminal_progress
+#       total: 总量，未知时为None
+#       stage: 阶段的名字，会放进event
+#       interval: 两次回调之间的最短间隔(秒)
+class Progress_reporter():
+    def __init__(self, callback=None, total=None, stage='', interval=0.5):
+        self.callback = terminal_progress if callback is None else callback
+        self.total = total
+        self.stage = stage
+        self.interval = interval
+        self.current = 0
+        self.start = time.perf_counter()
+        self.last = None
+
+    def update(self, advance=1, force=False):
+        self.current += advance
+        now = time.perf_counter()
+        done = self.total is not None and self.current >= self.total
+        if not (force or done or self.last is None or now - self.last >= self.interval):
+            return
+        self.last = now
+        elapsed = now - self.start
+        self.callback({'stage': self.stage, 'current': self.current, 'total': self.total, 'elapsed': elapsed,
+                       'rate': self.current / elapsed if elapsed > 0 else 0.})
+
+    def message(self, text):
+        self.callback({'stage': self.stage, 'message': text})
+
+
+#   线程安全的性能统计：计数器、累计耗时，以及按2的幂(微秒)分桶的耗时直方图
+#   方法：
+#       count(name, amount)：计数器加amount
+#       add_time(name, seconds)：累计一次耗时
+#       timer(name)：with recorder.timer(name): ... 统计代码块的耗时
+#       observe(name, seconds)：累计耗时，同时记进直方图(用于单次调用的延迟)
+#       snapshot()：返回{'counters': {...}, 'timers': {name: {'count', 'seconds'}}, 'histograms': {...}}，
+#           直方图为{'count', 'max_us', 'p50_us', 'p90_us', 'p99_us', 'buckets_us': [(桶的上界, 次数), ...]}，分位数取桶的上界
+#       reset()：清零
+class Stats_recorder():
+    buckets = 32
+
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.timers = {}
+            self.histograms = {}
+            self.maxima = {}
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.__add_time(name, seconds)
+
+    def __add_time(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = [0, 0.]
+        timer[0] += 1
+        timer[1] += seconds
+
+    def observe(self, name, seconds):
+        bucket = min(max(int(seconds * 1e6), 1).bit_length() - 1, self.buckets - 1)
+        with self.lock:
+            self.__add_time(name, seconds)
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0] * self.buckets
+            histogram[bucket] += 1
+            self.maxima[name] = max(self.maxima.get(name, 0.), seconds)
+
+    def timer(self, name):
+        return _Timer(self, name)
+
+    def snapshot(self):
+        with self.lock:
+            histograms = {}
+            for name, histogram in self.histograms.items():
+                total = sum(histogram)
+                summary = {'count': total, 'max_us': self.maxima[name] * 1e6,
+                           'buckets_us': [(2 ** (i + 1), n) for i, n in enumerate(histogram) if n > 0]}
+                for quantile in (50, 90, 99):
+                    seen = 0
+                    for i, n in enumerate(histogram):
+                        seen += n
+                        if seen * 100 >= quantile * total:
+                            summary['p{}_us'.format(quantile)] = 2 ** (i + 1)
+                            break
+                histograms[name] = summary
+            return {'counters': dict(self.counters),
+                    'timers': {name: {'count': timer[0], 'seconds': timer[1]} for name, timer in self.timers.items()},
+                    'histograms': histograms}
+
+
+class _Timer():
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.recorder.add_time(self.name, time.perf_counter() - self.start)
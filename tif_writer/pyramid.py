@@ -0,0 +1,191 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+'''Pyramid levels of a Tiff_writer, maintained incrementally while chunks are flushed'''
+
+
+#   2x2降采样的几种方式，输入的边长必须是偶数
+#   最近邻：取每个2x2块的左上角
+def reduce_nearest(block):
+    return block[0::2, 0::2]
+
+
+#   最大值
+def reduce_max(block):
+    return np.maximum(np.maximum(block[0::2, 0::2], block[0::2, 1::2]),
+                      np.maximum(block[1::2, 0::2], block[1::2, 1::2]))
+
+
+#   多数投票：每个2x2块取出现次数最多的标签，票数相同时按左上、右上、左下、右下的顺序优先
+def reduce_majority(block):
+    candidates = [block[0::2, 0::2], block[0::2, 1::2], block[1::2, 0::2], block[1::2, 1::2]]
+    result = candidates[0].copy()
+    best = None
+    for i, candidate in enumerate(candidates):
+        votes = np.zeros(candidate.shape, dtype=np.uint8)
+        for other in candidates:
+            votes += candidate == other
+        if best is None:
+            best = votes
+            continue
+        better = votes > best
+        result[better] = candidate[better]
+        best = np.maximum(best, votes)
+    return result
+
+
+reductions = {'nearest': reduce_nearest,
+              'max': reduce_max,
+              'majority': reduce_majority}
+
+
+#   金字塔各层的(宽, 高, 降采样倍数)，逐层减半，直到一层能放进一个tile
+def pyramid_levels(width, height, tile_size):
+    levels = [(width, height, 1)]
+    level_width, level_height, downsample = width, height, 1
+    while max(level_width, level_height) > tile_size:
+        downsample *= 2
+        level_width = int(np.ceil(width / downsample))
+        level_height = int(np.ceil(height / downsample))
+        levels.append((level_width, level_height, downsample))
+    return levels
+
+
+#   初始化参数：
+#       levels: pyramid_levels()的结果，第0层为原始分辨率(由Tiff_writer自己保存)
+#       chunk_size: 每一层都按chunk_size分块暂存，与最终tiff的tile大小一致
+#       default_val: 未写入区域的值
+#       reduction: 降采样方式，'nearest'，'max'或'majority'
+#       store: 各层暂存使用的后端，与Tiff_writer的store相同
+#       name: 暂存文件名的前缀，第L层为 <name>_level<L>
+#       cache_bytes: 各层共用的chunk缓存容量
+#       initial: 可选的initial(level, x_chunk_id, y_chunk_id)，返回某层chunk的初始内容(例如更新已有tiff时读出原来的tile)，
+#                为None时未写过的chunk以default_val填充
+#   方法：
+#       update(x_chunk_id, y_chunk_id, chunk)：第0层的某个chunk被写回时调用，逐层更新对应的区域
+#       flush()：把缓存中的脏数据写回各层的暂存后端
+#       tiles(level)：依次返回该层被写过的(tile_x, tile_y, tile)
+#       emit_rows(base_rows_done, encoder, final)：流式写入时使用，把已经完整的各层chunk行交给编码器，并从内存中丢弃
+#   每次只更新受影响的区域：第0层的chunk缩小一半后写进第1层对应的位置，再由第1层的这块区域缩小后写进第2层，依此类推
+class Pyramid():
+    def __init__(self, levels, chunk_size, default_val=0, reduction='nearest', store='memory', name='pyramid',
+                 cache_bytes=64 * 1024 ** 2, initial=None):
+        from .cache import Lru_cache
+        from .chunkstore import make_chunk_store
+        if reduction not in reductions:
+            print('unknown reduction "{}", should be one of {}'.format(reduction, list(reductions.keys())))
+            raise ValueError
+        self.levels = levels
+        self.chunk_size = chunk_size
+        self.default_val = default_val
+        self.reduce = reductions[reduction]
+        self.initial = initial
+        self.stores = [None]
+        self.accessed = [None]
+        for level in range(1, len(levels)):
+            width, height, downsample = levels[level]
+            horizontal_chunk_amount = int(np.ceil(width / chunk_size))
+            vertical_chunk_amount = int(np.ceil(height / chunk_size))
+            self.stores.append(make_chunk_store(store, name + '_level' + str(level),
+                                                horizontal_chunk_amount, vertical_chunk_amount,
+                                                chunk_size, default_val))
+            self.accessed.append(np.zeros((vertical_chunk_amount, horizontal_chunk_amount), dtype=bool))
+        self.dirty = set()
+        self.cache = Lru_cache(cache_bytes, on_evict=self.__flush_chunk)
+        #   流式写入时，每一层已经输出的chunk行数
+        self.emitted_rows = [0] * len(levels)
+
+    def __get_chunk(self, level, x_chunk_id, y_chunk_id):
+        key = (level, x_chunk_id, y_chunk_id)
+        chunk = self.cache.get(key)
+        if chunk is not None:
+            return chunk
+        if self.accessed[level][y_chunk_id, x_chunk_id]:
+            chunk = self.stores[level].read(x_chunk_id, y_chunk_id)
+        elif self.initial is not None:
+            chunk = np.array(self.initial(level, x_chunk_id, y_chunk_id), dtype=np.uint8)
+            self.accessed[level][y_chunk_id, x_chunk_id] = True
+        else:
+            chunk = np.full((self.chunk_size, self.chunk_size), self.default_val, dtype=np.uint8)
+            self.accessed[level][y_chunk_id, x_chunk_id] = True
+        self.cache.put(key, chunk)
+        return chunk
+
+    def __flush_chunk(self, key, chunk):
+        if key not in self.dirty:
+            return
+        self.stores[key[0]].write(key[1], key[2], chunk)
+        self.dirty.discard(key)
+
+    def update(self, x_chunk_id, y_chunk_id, chunk):
+        chunk_size = self.chunk_size
+        #   source是上一层中包含待更新区域的chunk，(y_lb, y_ub, x_lb, x_ub)是该区域在上一层的绝对坐标
+        source = chunk
+        source_y = y_chunk_id * chunk_size
+        source_x = x_chunk_id * chunk_size
+        y_lb, y_ub = source_y, source_y + chunk_size
+        x_lb, x_ub = source_x, source_x + chunk_size
+        for level in range(1, len(self.levels)):
+            #   区域扩展到偶数边界，保证每个2x2块都完整
+            y_lb, x_lb = y_lb - y_lb % 2, x_lb - x_lb % 2
+            y_ub, x_ub = y_ub + y_ub % 2, x_ub + x_ub % 2
+            block = source[y_lb - source_y:y_ub - source_y, x_lb - source_x:x_ub - source_x]
+            #   边缘chunk超出上一层画布的部分可能被写过(写入只按chunk裁剪)，降采样前按default_val处理，
+            #   否则'max'/'majority'会把画布外的值带进奇数边长的层的最后一行/列
+            width, height = self.levels[level - 1][:2]
+            if x_ub > width or y_ub > height:
+                block = block.copy()
+                block[max(height - y_lb, 0):, :] = self.default_val
+                block[:, max(width - x_lb, 0):] = self.default_val
+            reduced = self.reduce(block)
+            y_lb, y_ub, x_lb, x_ub = y_lb // 2, y_ub // 2, x_lb // 2, x_ub // 2
+            target = self.__get_chunk(level, x_lb // chunk_size, y_lb // chunk_size)
+            target_y = (y_lb // chunk_size) * chunk_size
+            target_x = (x_lb // chunk_size) * chunk_size
+            target[y_lb - target_y:y_ub - target_y, x_lb - target_x:x_ub - target_x] = reduced
+            self.dirty.add((level, x_lb // chunk_size, y_lb // chunk_size))
+            source, source_y, source_x = target, target_y, target_x
+
+    def flush(self):
+        for key in list(self.dirty):
+            self.__flush_chunk(key, self.cache.peek(key))
+
+    def tiles(self, level):
+        for y_chunk_id, x_chunk_id in zip(*np.nonzero(self.accessed[level])):
+            chunk = self.cache.peek((level, x_chunk_id, y_chunk_id))
+            if chunk is None:
+                chunk = self.stores[level].read(x_chunk_id, y_chunk_id)
+            yield x_chunk_id, y_chunk_id, chunk
+
+    #   第0层的前base_rows_done行chunk已经写完时，第L层的前(base_rows_done >> L)行chunk也就不会再变了
+    #   final为True时输出所有剩下的行
+    def emit_rows(self, base_rows_done, encoder, final=False):
+        for level in range(1, len(self.levels)):
+            vertical_chunk_amount, horizontal_chunk_amount = self.accessed[level].shape
+            rows_done = vertical_chunk_amount if final else min(base_rows_done >> level, vertical_chunk_amount)
+            for y_chunk_id in range(self.emitted_rows[level], rows_done):
+                for x_chunk_id in range(horizontal_chunk_amount):
+                    if not self.accessed[level][y_chunk_id, x_chunk_id]:
+                        continue
+                    key = (level, x_chunk_id, y_chunk_id)
+                    chunk = self.cache.pop(key)
+                    if chunk is None:
+                        chunk = self.stores[level].read(x_chunk_id, y_chunk_id)
+                    self.dirty.discard(key)
+                    encoder.write_tile(level, x_chunk_id, y_chunk_id, chunk)
+            self.emitted_rows[level] = max(self.emitted_rows[level], rows_done)
+
+    def save(self):
+        self.flush()
+        for level in range(1, len(self.levels)):
+            self.stores[level].save(self.accessed[level])
+
+    def close(self):
+        for store in self.stores[1:]:
+            store.close()
+
+    def free(self):
+        for store in self.stores[1:]:
+            store.free()
@@ -0,0 +1,98 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+'''Scanline rasterisation of polygons and run-length encoded masks into runs, used by Tiff_writer.write_polygons/write_rle'''
+
+
+#   所有函数都把几何形状转换成"run"：(几何形状的编号, 行, 起点, 终点)，表示该行上[起点, 终点)的像素属于该形状
+#   像素(x, y)的中心(x + 0.5, y + 0.5)在多边形内时，该像素属于多边形(奇偶规则，所以环可以表示洞)
+
+
+#   把多边形列表转换成边的数组
+#   Inputs:
+#       polygons: 多边形的list，每个多边形为(n, 2)的(x, y)顶点数组(自动闭合)，或者若干个这样的环的list(外环与洞)
+#   Outputs:
+#       (x0, y0, x1, y1, ids)：每条非水平边的两个端点以及所属多边形的编号
+def polygon_edges(polygons):
+    edges, ids = [], []
+    for polygon_id, polygon in enumerate(polygons):
+        rings = [polygon] if isinstance(polygon, np.ndarray) and polygon.ndim == 2 else polygon
+        for ring in rings:
+            ring = np.asarray(ring, dtype=np.float64).reshape(-1, 2)
+            if len(ring) < 3:
+                continue
+            edges.append(np.concatenate([ring, np.roll(ring, -1, axis=0)], axis=1))
+            ids.append(np.full(len(ring), polygon_id, dtype=np.int64))
+    if len(edges) == 0:
+        return [np.zeros(0)] * 4 + [np.zeros(0, dtype=np.int64)]
+    edges, ids = np.concatenate(edges), np.concatenate(ids)
+    keep = edges[:, 1] != edges[:, 3]
+    edges, ids = edges[keep], ids[keep]
+    return edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3], ids
+
+
+#   行row_lb到row_ub(不包含)之间，各多边形内部的水平run
+#   每条边与经过像素中心的水平线y = row + 0.5相交(半开区间，顶点不会被算两次)，
+#   同一多边形同一行的交点排序后两两配对就是该行的run
+def polygon_runs(x0, y0, x1, y1, ids, row_lb, row_ub):
+    y_min, y_max = np.minimum(y0, y1), np.maximum(y0, y1)
+    edge_row_lb = np.maximum(np.ceil(y_min - 0.5), row_lb).astype(np.int64)
+    edge_row_ub = np.minimum(np.ceil(y_max - 0.5), row_ub).astype(np.int64)
+    row_count = np.maximum(edge_row_ub - edge_row_lb, 0)
+    edge_ids = np.repeat(np.arange(len(ids)), row_count)
+    if len(edge_ids) == 0:
+        return [np.zeros(0, dtype=np.int64)] * 4
+    rows = edge_row_lb[edge_ids] + np.arange(len(edge_ids)) - np.repeat(np.cumsum(row_count) - row_count, row_count)
+    crossing = x0[edge_ids] + (rows + 0.5 - y0[edge_ids]) * (x1[edge_ids] - x0[edge_ids]) / \
+        (y1[edge_ids] - y0[edge_ids])
+    polygon_ids = ids[edge_ids]
+    order = np.lexsort((crossing, rows, polygon_ids))
+    crossing, rows, polygon_ids = crossing[order], rows[order], polygon_ids[order]
+    starts = np.ceil(crossing[0::2] - 0.5).astype(np.int64)
+    ends = np.ceil(crossing[1::2] - 0.5).astype(np.int64)
+    keep = starts < ends
+    return polygon_ids[0::2][keep], rows[0::2][keep], starts[keep], ends[keep]
+
+
+#   解码COCO的压缩RLE字符串(pycocotools中rleFrString的算法)
+def coco_counts(string):
+    if isinstance(string, str):
+        string = string.encode('ascii')
+    counts = []
+    position = 0
+    while position < len(string):
+        value, shift, more = 0, 0, True
+        while more:
+            c = string[position] - 48
+            value |= (c & 0x1f) << (5 * shift)
+            more = c & 0x20
+            position += 1
+            shift += 1
+            if not more and c & 0x10:
+                value |= -1 << (5 * shift)
+        if len(counts) > 2:
+            value += counts[-2]
+        counts.append(value)
+    return np.array(counts, dtype=np.int64)
+
+
+#   把RLE的counts(从0开始交替的0/1长度)转换成run，line_length为每行(order='C')或每列(order='F')的长度
+#   Outputs:
+#       (lines, starts, ends)：run所在的行(或列)，以及在该行(或列)上的[起点, 终点)
+def rle_runs(counts, line_length):
+    bounds = np.cumsum(np.asarray(counts, dtype=np.int64))
+    if len(bounds) % 2 == 1:
+        bounds = np.append(bounds, bounds[-1])
+    starts, ends = bounds[0::2], bounds[1::2]
+    keep = starts < ends
+    starts, ends = starts[keep], ends[keep]
+    #   跨越多行的run在行的边界处切开
+    first, last = starts // line_length, (ends - 1) // line_length
+    line_count = last - first + 1
+    run_ids = np.repeat(np.arange(len(starts)), line_count)
+    lines = first[run_ids] + np.arange(len(run_ids)) - np.repeat(np.cumsum(line_count) - line_count, line_count)
+    line_starts = np.maximum(starts[run_ids], lines * line_length) - lines * line_length
+    line_ends = np.minimum(ends[run_ids], (lines + 1) * line_length) - lines * line_length
+    return lines, line_starts, line_ends
@@ -1,26 +1,54 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import gc, os, time, multiprocessing
+import gc, os, time, threading
 import numpy as np
-import multiresolutionimageinterface as mir
 
 '''
     This is an object that mimic openslide
     Get a new slide: slide = mir_based_slide().OpenSlide(slide_path)
     The object have properties like: level_count, level_downsamples, level_dimensions, dimensions, spacing
     The main function is to get a patch from a slide, using read_region
+    Decoded tiles are kept in a byte bounded LRU cache (cache_bytes, default 256MB, 0 disables it), so overlapping
+    read_region calls reuse them; prefetch(regions) decodes tiles ahead of time and cache_stats() reports the hit rate
+    iter_patches(level, patch_size, stride, mask) reads a grid of patches in a thread or process pool with read-ahead
+    stats() reports read_region latency histograms, time spent decoding tiles and the cache statistics
+    level0_location((x, y), level) gives the level 0 location at which read_region starts exactly at (x, y) of that level
+    multiresolutionimageinterface is only imported when the first slide is opened
 '''
 
 
+#   ASAP的接口在第一次打开slide时才导入，import本模块(例如进程池中的worker)不需要付出这部分开销
+def _mir():
+    import multiresolutionimageinterface
+    return multiresolutionimageinterface
+
+
+#   某一层上的坐标value对应的level 0坐标，保证ASAP换算回该层(除以降采样倍数后向0取整)时正好得到value
+#   降采样倍数不是整数时(边长为奇数的slide，例如1.9993)，int(value * downsample)换算回去会变成value - 1
+def level0_coordinate(value, downsample):
+    origin = int(round(value * downsample))
+    #   降采样倍数不小于1，换算回value的level 0坐标一定存在，最多调整一两步
+    while int(origin / downsample) < value:
+        origin += 1
+    while int(origin / downsample) > value:
+        origin -= 1
+    return origin
+
+
 class mir_based_slide():
 
     def __init__(self):
         pass
 
-    def OpenSlide(self, slide_path):
+    #   slide_path: slide的路径
+    #   cache_bytes: 解码后tile的LRU缓存容量(字节)，为0时不缓存，每次都直接从slide读取
+    #   cache_tile_size: 缓存的tile大小，read_region按这个网格从缓存中拼出patch
+    def OpenSlide(self, slide_path, cache_bytes=256 * 1024 ** 2, cache_tile_size=512):
+        from .cache import Lru_cache
+        from .monitor import Stats_recorder
         self.slide_path = slide_path
-        self.slide = mir.MultiResolutionImageReader().open(slide_path)
+        self.slide = _mir().MultiResolutionImageReader().open(slide_path)
         if self.slide is None:
             print('* Error while opening ' + slide_path + ' [mir_based_slide @ slidelib]')
             raise (ValueError)
@@ -31,13 +59,32 @@ class mir_based_slide():
             self.level_dimensions = [self.slide.getLevelDimensions(level) for level in range(self.level_count)]
             self.dimensions = self.level_dimensions[0]
             self.spacing = self.slide.getSpacing()
+            #   ASAP自己的缓存没有上限，所以关掉了；这里用有上限的缓存代替，键为(level, tile_x, tile_y)
+            self.cache_bytes = cache_bytes
+            self.cache_tile_size = cache_tile_size
+            self.tile_cache = Lru_cache(cache_bytes) if cache_bytes > 0 else None
+            self.cache_lock = threading.Lock()
+            self.prefetcher = None
+            self.recorder = Stats_recorder()
         return self
 
     #   读区域
     #       location：待读取位置的左上角坐标，tuple
     #       level：待进行读取的层级，int
     #       size：待读取的尺寸，tuple；若为int，则长宽一致；若留为None，则读取该level下的全尺寸
-    def read_region(self, location, level, size=None, mode='lefttop', reverse_zero=False):
+    #       reverse_zero：把0改为255，直接在结果上修改
+    #       out：可选，预先分配好的(高, 宽, 通道数)的uint8数组，结果直接写进去并返回它，批量读取时可以反复使用同一块内存
+    #       channels：3(默认，与openslide一样把单通道扩展成3通道)，或'native'(保持slide原有的通道数，单通道的mask为(高, 宽, 1))
+    def read_region(self, location, level, size=None, mode='lefttop', reverse_zero=False, out=None, channels=3):
+        start = time.perf_counter()
+        patch = self.__read_region(location, level, size, mode, reverse_zero, out, channels)
+        self.recorder.observe('read_region', time.perf_counter() - start)
+        return patch
+
+    def __read_region(self, location, level, size, mode, reverse_zero, out, channels):
+        if channels not in (3, 'native'):
+            print('channels must be 3 or "native"')
+            raise ValueError
         #   处理location
         effective_location = (int(location[0]), int(location[1]))
         #   如果size是int，那么默认为两方向尺寸相同
@@ -55,18 +102,231 @@ class mir_based_slide():
         else:
             final_location = effective_location
         #   正常截取patch的流程
-        patch = self.slide.getUCharPatch(final_location[0], final_location[1],
-                                         effective_size[0], effective_size[1],
-                                         level)
-        if patch.shape[2] == 1:
-            patch = np.repeat(patch, 3, axis=-1)  # openslide里，单通道也会读成3通道的，这里模仿一下
-        #   如果需要将0转置为255，则进行该流程
+        if self.tile_cache is None:
+            with self.recorder.timer('slide_read'):
+                patch = self.slide.getUCharPatch(final_location[0], final_location[1],
+                                                 effective_size[0], effective_size[1],
+                                                 level)
+            if out is not None:
+                self.__check_out(out, effective_size, self.__output_channels(patch.shape[2], channels))
+                out[...] = patch  # 单通道时直接广播成3通道，不产生中间数组
+                patch = out
+            elif channels == 3 and patch.shape[2] == 1:
+                patch = np.repeat(patch, 3, axis=-1)  # openslide里，单通道也会读成3通道的，这里模仿一下
+        else:
+            patch = self.__read_cached(final_location, effective_size, level, out, channels)
+        #   如果需要将0转置为255，则进行该流程(原地修改)
         if reverse_zero:
-            patch[patch == 0] = 255
-            patch = patch.astype(np.uint8)
+            np.putmask(patch, patch == 0, 255)
         return patch
 
+    #   结果的通道数：channels为3时单通道扩展成3通道，其余保持不变
+    @staticmethod
+    def __output_channels(decoded_channels, channels):
+        return 3 if channels == 3 and decoded_channels == 1 else decoded_channels
+
+    @staticmethod
+    def __check_out(out, size, output_channels):
+        if out.shape != (size[1], size[0], output_channels) or out.dtype != np.uint8:
+            print('out must be a uint8 array of shape {}, got {} {}'.format((size[1], size[0], output_channels),
+                                                                           out.dtype, out.shape))
+            raise ValueError
+
+    #   某一层上的(x, y)对应的level 0坐标，用这个坐标调用read_region(location, level, ...)正好从该层的(x, y)开始读
+    def level0_location(self, location, level):
+        downsample = self.level_downsamples[level]
+        return level0_coordinate(location[0], downsample), level0_coordinate(location[1], downsample)
+
+    #   读区域时用到的缓存tile范围(均为该level下的tile坐标，包含上界)
+    def __tile_range(self, location, size, level):
+        #   与ASAP一致，level 0的坐标除以降采样倍数后向0取整
+        downsample = self.level_downsamples[level]
+        x = int(location[0] / downsample)
+        y = int(location[1] / downsample)
+        return (x, y, x // self.cache_tile_size, y // self.cache_tile_size,
+                (x + size[0] - 1) // self.cache_tile_size, (y + size[1] - 1) // self.cache_tile_size)
+
+    #   读一个缓存tile，未命中时从slide中解码后放进缓存
+    def __read_tile(self, level, tile_x, tile_y):
+        key = (level, tile_x, tile_y)
+        with self.cache_lock:
+            tile = self.tile_cache.get(key)
+        if tile is not None:
+            return tile
+        x, y = self.level0_location((tile_x * self.cache_tile_size, tile_y * self.cache_tile_size), level)
+        with self.recorder.timer('slide_read'):
+            tile = self.slide.getUCharPatch(x, y, self.cache_tile_size, self.cache_tile_size, level)
+        self.recorder.count('tiles_decoded')
+        self.recorder.count('bytes_decoded', tile.nbytes)
+        with self.cache_lock:
+            self.tile_cache.put(key, tile)
+        return tile
+
+    #   从缓存的tile中拼出patch，写进out(为None时新建)，不会和缓存共用内存
+    #   单通道的tile在拷贝时直接广播成3通道
+    def __read_cached(self, location, size, level, out=None, channels=3):
+        x, y, tile_x_lb, tile_y_lb, tile_x_ub, tile_y_ub = self.__tile_range(location, size, level)
+        tile_size = self.cache_tile_size
+        patch = None
+        for tile_y in range(tile_y_lb, tile_y_ub + 1):
+            for tile_x in range(tile_x_lb, tile_x_ub + 1):
+                tile = self.__read_tile(level, tile_x, tile_y)
+                if patch is None:
+                    output_channels = self.__output_channels(tile.shape[2], channels)
+                    if out is None:
+                        patch = np.empty((size[1], size[0], output_channels), dtype=tile.dtype)
+                    else:
+                        self.__check_out(out, size, output_channels)
+                        patch = out
+                #   该tile与patch交叉的区域，分别相对于patch和tile
+                x_lb, x_ub = max(tile_x * tile_size, x), min((tile_x + 1) * tile_size, x + size[0])
+                y_lb, y_ub = max(tile_y * tile_size, y), min((tile_y + 1) * tile_size, y + size[1])
+                patch[y_lb - y:y_ub - y, x_lb - x:x_ub - x] = \
+                    tile[y_lb - tile_y * tile_size:y_ub - tile_y * tile_size,
+                         x_lb - tile_x * tile_size:x_ub - tile_x * tile_size]
+        return patch
+
+    #   预先把若干区域用到的tile解码进缓存
+    #       regions：(location, level, size)或(location, level, size, mode)的列表，参数含义与read_region相同
+    #       wait：为False时在后台线程中进行，返回一个Future
+    def prefetch(self, regions, wait=True):
+        if self.tile_cache is None:
+            return None
+        keys = []
+        for region in regions:
+            location, level, size = region[:3]
+            mode = region[3] if len(region) > 3 else 'lefttop'
+            size = (size, size) if isinstance(size, int) else (int(size[0]), int(size[1]))
+            if mode == 'center':
+                location = (int(location[0] - size[0] * self.level_downsamples[level] / 2),
+                            int(location[1] - size[1] * self.level_downsamples[level] / 2))
+            _, _, tile_x_lb, tile_y_lb, tile_x_ub, tile_y_ub = self.__tile_range(location, size, level)
+            for tile_y in range(tile_y_lb, tile_y_ub + 1):
+                for tile_x in range(tile_x_lb, tile_x_ub + 1):
+                    keys.append((level, tile_x, tile_y))
+        keys = list(dict.fromkeys(keys))
+
+        def load():
+            for key in keys:
+                with self.cache_lock:
+                    cached = key in self.tile_cache
+                if not cached:
+                    self.__read_tile(*key)
+
+        if wait:
+            load()
+            return None
+        if self.prefetcher is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.prefetcher = ThreadPoolExecutor(max_workers=1)
+        return self.prefetcher.submit(load)
+
+    #   按网格依次读取某一层上的patch，返回(x, y, patch)的生成器，x, y为patch左上角在level 0上的坐标(可以直接用于read_region)
+    #       level：读取的层级
+    #       patch_size：patch的尺寸，int或(宽, 高)，为该层上的像素数
+    #       stride：步长，int或(x方向, y方向)，默认与patch_size相同；网格覆盖整层，最后一行/列向回移动，保证patch不越界
+    #       mask：可选，2-d的bool数组(覆盖整张slide，任意分辨率，例如get_preview得到的前景)，或函数mask(x, y)，
+    #             只读取中心落在前景上的patch
+    #       workers：读取用的线程/进程数
+    #       read_ahead：最多同时在途的patch数，默认为workers的两倍，内存占用约为 read_ahead * patch大小
+    #       ordered：True时按网格的顺序(先行后列)返回，False时按读完的先后顺序返回
+    #       pool：'thread'(默认)或'process'；读取时不释放GIL的情况下使用'process'，每个进程各自打开一份slide
+    #       其余参数(例如reverse_zero)传给read_region
+    def iter_patches(self, level, patch_size, stride=None, mask=None, workers=4, read_ahead=None, ordered=True,
+                     pool='thread', **kwargs):
+        from collections import deque
+        from concurrent.futures import wait, FIRST_COMPLETED
+        size = (patch_size, patch_size) if isinstance(patch_size, int) else (int(patch_size[0]), int(patch_size[1]))
+        stride = size if stride is None else ((stride, stride) if isinstance(stride, int) else tuple(stride))
+        locations = self.__grid_locations(level, size, stride, mask)
+
+        if pool == 'thread':
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=workers)
+            read = self.read_region
+        elif pool == 'process':
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_patch_worker,
+                                           initargs=(self.slide_path, self.cache_bytes, self.cache_tile_size))
+            read = _read_patch_job
+        else:
+            print('pool must be "thread" or "process"')
+            raise ValueError
+        read_ahead = 2 * workers if read_ahead is None else max(int(read_ahead), 1)
+        pending = deque()
+        try:
+            for location in locations:
+                #   在途的patch达到read_ahead时，先返回已经读好的
+                while len(pending) >= read_ahead:
+                    yield self.__next_patch(pending, ordered, wait, FIRST_COMPLETED)
+                pending.append((location, executor.submit(read, location, level, size, **kwargs)))
+            while len(pending) > 0:
+                yield self.__next_patch(pending, ordered, wait, FIRST_COMPLETED)
+        finally:
+            #   调用者提前停止迭代时，取消还没开始的读取
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    @staticmethod
+    def __next_patch(pending, ordered, wait, first_completed):
+        if ordered:
+            location, future = pending.popleft()
+        else:
+            done, _ = wait([future for _, future in pending], return_when=first_completed)
+            index = next(i for i, (_, future) in enumerate(pending) if future in done)
+            location, future = pending[index]
+            del pending[index]
+        return location[0], location[1], future.result()
+
+    #   网格上需要读取的patch左上角(level 0坐标)
+    def __grid_locations(self, level, size, stride, mask):
+        width, height = self.level_dimensions[level]
+        downsample = self.level_downsamples[level]
+
+        def starts(length, patch, step):
+            values = list(range(0, max(length - patch, 0) + 1, step))
+            if values[-1] + patch < length:
+                values.append(length - patch)
+            return values
+
+        if mask is not None and not callable(mask):
+            mask = np.asarray(mask)
+            scale_y = mask.shape[0] / (height * downsample)
+            scale_x = mask.shape[1] / (width * downsample)
+        for y in starts(height, size[1], stride[1]):
+            for x in starts(width, size[0], stride[0]):
+                location = self.level0_location((x, y), level)
+                if mask is not None:
+                    center_x = (x + size[0] / 2) * downsample
+                    center_y = (y + size[1] / 2) * downsample
+                    if callable(mask):
+                        if not mask(center_x, center_y):
+                            continue
+                    elif not mask[min(int(center_y * scale_y), mask.shape[0] - 1),
+                                  min(int(center_x * scale_x), mask.shape[1] - 1)]:
+                        continue
+                yield location
+
+    #   性能统计：read_region单次调用耗时的直方图，从slide解码的耗时(slide_read)与tile数/字节数，以及tile缓存的统计
+    #   格式见monitor.Stats_recorder.snapshot()；iter_patches(pool='process')时各进程的统计不会汇总到这里
+    def stats(self):
+        stats = self.recorder.snapshot()
+        stats['cache'] = self.cache_stats()
+        return stats
+
+    #   tile缓存的命中率等统计信息
+    def cache_stats(self):
+        if self.tile_cache is None:
+            return None
+        with self.cache_lock:
+            return self.tile_cache.stats()
+
     def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown(wait=True)
+        del self.prefetcher
+        del self.tile_cache
         self.slide.close()
         del self.slide_path
         del self.slide
@@ -78,6 +338,19 @@ class mir_based_slide():
 
 
 
+#   iter_patches(pool='process')时每个进程各自打开一份slide
+_worker_slide = None
+
+
+def _init_patch_worker(slide_path, cache_bytes, cache_tile_size):
+    global _worker_slide
+    _worker_slide = mir_based_slide().OpenSlide(slide_path, cache_bytes=cache_bytes, cache_tile_size=cache_tile_size)
+
+
+def _read_patch_job(location, level, size, **kwargs):
+    return _worker_slide.read_region(location, level, size, **kwargs)
+
+
 #   获取一个slide的预览图，默认会使用最低分辨率
 def get_preview(slide, level=None):
     if isinstance(slide, str):
@@ -88,7 +361,8 @@ def get_preview(slide, level=None):
     level = level if level is not None else (slide.level_count - 1)
     level = level if level >= 0 else (slide.level_count + level)
     downsample_rate = slide.level_downsamples[level]
-    tile = np.array(slide.read_region((0, 0), level, slide.level_dimensions[level]))
+    #   read_region返回的已经是新的数组，直接取前3个通道的视图即可
+    tile = slide.read_region((0, 0), level, slide.level_dimensions[level])
     tile = tile[:, :, 0:3]
     if need_close:
         slide.close()
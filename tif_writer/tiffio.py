@@ -0,0 +1,579 @@
+# !/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import struct
+import time
+import zlib
+from fractions import Fraction
+
+import numpy as np
+
+'''Pure numpy tiled (Big)TIFF encoding, used by Tiff_writer.finish() when mir is not wanted'''
+
+#   压缩方式与TIFF中Compression标签的对应关系
+compression_tags = {'none': 1, 'lzw': 5, 'deflate': 8}
+
+#   TIFF中用到的数据类型
+_SHORT = 3
+_LONG = 4
+_RATIONAL = 5
+_LONG8 = 16
+
+
+#   TIFF的LZW压缩(高位在前，码宽的切换时机与libtiff一致，解码端会提前一位切换)
+def lzw_encode(data):
+    out = bytearray()
+    bit_buffer = 0
+    bit_count = 0
+    width = 9
+    table = {}
+    next_code = 258
+
+    #   先输出Clear码
+    bit_buffer = 256
+    bit_count = 9
+
+    prefix = -1
+    for byte in data:
+        if prefix < 0:
+            prefix = byte
+            continue
+        key = (prefix << 8) | byte
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        #   输出当前前缀
+        bit_buffer = (bit_buffer << width) | prefix
+        bit_count += width
+        while bit_count >= 8:
+            bit_count -= 8
+            out.append((bit_buffer >> bit_count) & 0xff)
+        bit_buffer &= (1 << bit_count) - 1
+        table[key] = next_code
+        next_code += 1
+        if next_code == 4094:
+            #   码表已满，输出Clear码并重置
+            bit_buffer = (bit_buffer << width) | 256
+            bit_count += width
+            table = {}
+            next_code = 258
+            width = 9
+        elif next_code == (1 << width):
+            width += 1
+        prefix = byte
+    if prefix >= 0:
+        bit_buffer = (bit_buffer << width) | prefix
+        bit_count += width
+        next_code += 1
+        if next_code == 4094:
+            bit_buffer = (bit_buffer << width) | 256
+            bit_count += width
+            width = 9
+        elif next_code == (1 << width):
+            width += 1
+    #   最后输出EOI码
+    bit_buffer = (bit_buffer << width) | 257
+    bit_count += width
+    while bit_count >= 8:
+        bit_count -= 8
+        out.append((bit_buffer >> bit_count) & 0xff)
+    if bit_count > 0:
+        out.append((bit_buffer << (8 - bit_count)) & 0xff)
+    return bytes(out)
+
+
+#   压缩一个tile，返回压缩后的bytes
+def encode_tile(tile, compression='deflate'):
+    raw = np.ascontiguousarray(tile, dtype=np.uint8).tobytes()
+    if compression == 'deflate':
+        return zlib.compress(raw, 6)
+    elif compression == 'lzw':
+        return lzw_encode(raw)
+    elif compression == 'none':
+        return raw
+    print('unknown compression "{}", should be one of {}'.format(compression, list(compression_tags.keys())))
+    raise ValueError
+
+
+#   若tile中所有像素都相同，返回该值，否则返回None
+def uniform_value(tile):
+    first = tile.flat[0]
+    if (tile == first).all():
+        return int(first)
+    return None
+
+
+#   并行压缩时在worker中执行：均匀的tile不压缩，只返回它的值；同时返回压缩的耗时
+def _encode_job(tile, compression):
+    start = time.perf_counter()
+    value = uniform_value(tile)
+    if value is not None:
+        return value, None, time.perf_counter() - start
+    data = encode_tile(tile, compression)
+    return None, data, time.perf_counter() - start
+
+
+#   把一个浮点数表示成TIFF里的RATIONAL(两个uint32)
+def _rational(value):
+    fraction = Fraction(value).limit_denominator(2 ** 31)
+    return fraction.numerator, fraction.denominator
+
+
+#   初始化参数：
+#       path: 目标tiff路径
+#       tile_size: tile的大小(必须是16的倍数)
+#       compression: 'deflate'，'lzw'或'none'
+#       spacing: 第0层的像素间距(微米/像素)，会写成分辨率标签，可以为None
+#       default_val: 没有写入数据的tile的填充值
+#       dedup: 是否对内容相同的tile去重(默认True)，相同的tile在偏移表中指向同一段数据
+#   方法：
+#       add_level(width, height, downsample)：添加一层(第0层为原始分辨率，后面依次为降采样的层)，返回层号
+#       write_tile(level, tile_x, tile_y, tile)：压缩并写入一个tile，tile为(tile_size, tile_size)的uint8 ndarray
+#       write_uniform(level, tile_x, tile_y, value)：写入一个所有像素都为value的tile
+#       write_encoded(level, tile_x, tile_y, data)：写入已经压缩好的数据
+#       write_tiles(tiles, workers, queue_depth, pool)：用线程池/进程池并行压缩一批(level, tile_x, tile_y, tile)，按顺序写入，
+#           tile也可以是一个整数，表示已知所有像素都为该值的tile，直接交给write_uniform
+#       close()：写入所有层的IFD，完成文件
+#   tile的数据按写入的顺序直接追加在文件后面，每一层的偏移表和长度表只在内存中记录，最后才写出
+#   所有像素都相同的tile不经过压缩：每种取值只压缩、存储一次，之后的均匀tile直接指向它
+#   属性compress_seconds，write_seconds，bytes_written记录压缩与写文件的耗时以及写入的字节数
+#   (并行压缩时compress_seconds是各个worker耗时的总和)
+
+#   Initialization:
+#       path: target tif path
+#       tile_size: tile edge length, must be a multiple of 16
+#       compression: 'deflate', 'lzw' or 'none'
+#       spacing: pixel spacing (um/pixel) of level 0, written as resolution tags, can be None
+#       default_val: fill value of tiles which are never written
+#       dedup: store identical encoded tiles only once (default True)
+#   Method:
+#       add_level(width, height, downsample): add a level (level 0 first, then the downsampled ones), returns its index
+#       write_tile(level, tile_x, tile_y, tile): encode and append one (tile_size, tile_size) uint8 tile
+#       write_uniform(level, tile_x, tile_y, value): write a tile whose pixels all equal value
+#       write_encoded(level, tile_x, tile_y, data): append an already encoded tile
+#       write_tiles(tiles, workers, queue_depth, pool): compress (level, tile_x, tile_y, tile) items in a thread/process pool, append in order;
+#           tile may also be an int, a tile known to be uniform, which goes straight to write_uniform
+#   Attributes compress_seconds, write_seconds and bytes_written account for compression time (summed over workers
+#   when compressing in parallel), file writing time and bytes appended
+#       close(): write the IFDs of all levels and finish the file
+class Tiled_tiff_encoder():
+    def __init__(self, path, tile_size, compression='deflate', spacing=None, default_val=0, dedup=True):
+        if tile_size % 16 != 0:
+            print('tile size must be a multiple of 16')
+            raise ValueError
+        if compression not in compression_tags:
+            print('unknown compression "{}", should be one of {}'.format(compression,
+                                                                       list(compression_tags.keys())))
+            raise ValueError
+        self.path = path
+        self.tile_size = tile_size
+        self.compression = compression
+        self.spacing = spacing
+        self.default_val = default_val
+        self.dedup = dedup
+        #   压缩后内容的摘要 -> (偏移, 长度)，以及均匀tile的取值 -> (偏移, 长度)
+        self.stored = {}
+        self.uniform_stored = {}
+        self.tiles_written = 0
+        self.tiles_deduplicated = 0
+        self.compress_seconds = 0.
+        self.write_seconds = 0.
+        self.bytes_written = 0
+        self.levels = []
+        self.file = open(path, 'wb')
+        #   BigTIFF文件头，第一个IFD的位置在close()时回填
+        self.file.write(b'II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+        self.position = self.file.tell()
+
+    def add_level(self, width, height, downsample=1):
+        tiles_across = int(np.ceil(width / self.tile_size))
+        tiles_down = int(np.ceil(height / self.tile_size))
+        self.levels.append({'width': int(width),
+                            'height': int(height),
+                            'downsample': downsample,
+                            'offsets': np.zeros((tiles_down, tiles_across), dtype=np.uint64),
+                            'byte_counts': np.zeros((tiles_down, tiles_across), dtype=np.uint64)})
+        return len(self.levels) - 1
+
+    def write_tile(self, level, tile_x, tile_y, tile):
+        start = time.perf_counter()
+        value = uniform_value(tile)
+        if value is not None:
+            self.compress_seconds += time.perf_counter() - start
+            return self.write_uniform(level, tile_x, tile_y, value)
+        data = encode_tile(tile, self.compression)
+        self.compress_seconds += time.perf_counter() - start
+        return self.write_encoded(level, tile_x, tile_y, data)
+
+    #   写入一个所有像素都为value的tile，每种取值只压缩一次
+    def write_uniform(self, level, tile_x, tile_y, value):
+        location = self.uniform_stored.get(value)
+        if location is None:
+            start = time.perf_counter()
+            data = encode_tile(np.full((self.tile_size, self.tile_size), value, dtype=np.uint8), self.compression)
+            self.compress_seconds += time.perf_counter() - start
+            location = (self.__append(data), len(data))
+            self.uniform_stored[value] = location
+        else:
+            self.tiles_deduplicated += 1
+        self.point_tile(level, tile_x, tile_y, location[0], location[1])
+        self.tiles_written += 1
+        return location[0]
+
+    def write_encoded(self, level, tile_x, tile_y, data):
+        self.tiles_written += 1
+        if self.dedup:
+            digest = hashlib.blake2b(data, digest_size=16).digest()
+            location = self.stored.get(digest)
+            if location is not None:
+                self.tiles_deduplicated += 1
+                self.point_tile(level, tile_x, tile_y, location[0], location[1])
+                return location[0]
+        offset = self.__append(data)
+        if self.dedup:
+            self.stored[digest] = (offset, len(data))
+        self.point_tile(level, tile_x, tile_y, offset, len(data))
+        return offset
+
+    def __append(self, data):
+        offset = self.position
+        start = time.perf_counter()
+        self.file.write(data)
+        self.write_seconds += time.perf_counter() - start
+        self.position += len(data)
+        self.bytes_written += len(data)
+        return offset
+
+    #   并行压缩一批tile：tiles是(level, tile_x, tile_y, tile)的可迭代对象
+    #   压缩在线程池或进程池中进行，调用者所在的线程按提交的顺序依次写入文件并记录偏移
+    #   同时在途的tile不超过queue_depth个(默认为workers的两倍)，所以内存占用约为 queue_depth * tile大小
+    #   zlib压缩时会释放GIL，deflate用线程池就够了；lzw是纯python实现，需要用进程池
+    def write_tiles(self, tiles, workers=1, queue_depth=None, pool='thread'):
+        if workers <= 1:
+            for level, tile_x, tile_y, tile in tiles:
+                if isinstance(tile, np.ndarray):
+                    self.write_tile(level, tile_x, tile_y, tile)
+                else:
+                    self.write_uniform(level, tile_x, tile_y, int(tile))
+            return
+        from collections import deque
+        if pool == 'thread':
+            from concurrent.futures import ThreadPoolExecutor as Executor
+        elif pool == 'process':
+            from concurrent.futures import ProcessPoolExecutor as Executor
+        else:
+            print('pool must be "thread" or "process"')
+            raise ValueError
+        queue_depth = 2 * workers if queue_depth is None else max(int(queue_depth), 1)
+        pending = deque()
+        with Executor(max_workers=workers) as executor:
+            for level, tile_x, tile_y, tile in tiles:
+                if len(pending) >= queue_depth:
+                    self.__write_pending(pending.popleft())
+                #   均匀的tile不提交，按顺序排在队列中，轮到时直接写入
+                job = executor.submit(_encode_job, tile, self.compression) if isinstance(tile, np.ndarray) else int(tile)
+                pending.append((level, tile_x, tile_y, job))
+            while len(pending) > 0:
+                self.__write_pending(pending.popleft())
+
+    def __write_pending(self, item):
+        level, tile_x, tile_y, future = item
+        if isinstance(future, int):
+            self.write_uniform(level, tile_x, tile_y, future)
+            return
+        value, data, seconds = future.result()
+        self.compress_seconds += seconds
+        if value is not None:
+            self.write_uniform(level, tile_x, tile_y, value)
+        else:
+            self.write_encoded(level, tile_x, tile_y, data)
+
+    #   让某个tile指向文件中已经存在的一段数据
+    def point_tile(self, level, tile_x, tile_y, offset, byte_count):
+        self.levels[level]['offsets'][tile_y, tile_x] = offset
+        self.levels[level]['byte_counts'][tile_y, tile_x] = byte_count
+
+    #   所有没有写入过的tile共用同一份默认tile的数据
+    def __fill_missing(self):
+        for index, level in enumerate(self.levels):
+            missing = level['byte_counts'] == 0
+            if not missing.any():
+                continue
+            tile_y, tile_x = np.argwhere(missing)[0]
+            self.write_uniform(index, tile_x, tile_y, self.default_val)
+            level['offsets'][missing] = level['offsets'][tile_y, tile_x]
+            level['byte_counts'][missing] = level['byte_counts'][tile_y, tile_x]
+
+    def __ifd_entries(self, index, level):
+        entries = [(254, _LONG, [0 if index == 0 else 1]),
+                   (256, _LONG, [level['width']]),
+                   (257, _LONG, [level['height']]),
+                   (258, _SHORT, [8]),
+                   (259, _SHORT, [compression_tags[self.compression]]),
+                   (262, _SHORT, [1]),
+                   (277, _SHORT, [1])]
+        if self.spacing is not None:
+            #   分辨率单位为厘米，每厘米的像素数 = 10000 / spacing(微米)
+            resolution = _rational(10000. / (float(self.spacing) * level['downsample']))
+            entries += [(282, _RATIONAL, [resolution]),
+                        (283, _RATIONAL, [resolution])]
+        entries.append((284, _SHORT, [1]))
+        if self.spacing is not None:
+            entries.append((296, _SHORT, [3]))
+        entries += [(322, _LONG, [self.tile_size]),
+                    (323, _LONG, [self.tile_size]),
+                    (324, _LONG8, level['offsets'].flatten()),
+                    (325, _LONG8, level['byte_counts'].flatten()),
+                    (339, _SHORT, [1])]
+        return entries
+
+    @staticmethod
+    def __pack_values(tag_type, values):
+        if tag_type == _SHORT:
+            return struct.pack('<{}H'.format(len(values)), *values)
+        if tag_type == _LONG:
+            return struct.pack('<{}I'.format(len(values)), *values)
+        if tag_type == _RATIONAL:
+            return b''.join(struct.pack('<II', *value) for value in values)
+        return np.asarray(values, dtype='<u8').tobytes()
+
+    #   写出一个IFD，返回其位置以及存放"下一个IFD位置"的地址
+    def __write_ifd(self, entries):
+        #   先把放不进IFD条目的数据写在IFD前面
+        packed = []
+        for tag, tag_type, values in entries:
+            data = self.__pack_values(tag_type, values)
+            if len(data) > 8:
+                offset = self.position
+                self.file.write(data)
+                self.position += len(data)
+                if self.position % 2:
+                    self.file.write(b'\0')
+                    self.position += 1
+                packed.append((tag, tag_type, len(values), struct.pack('<Q', offset)))
+            else:
+                packed.append((tag, tag_type, len(values), data.ljust(8, b'\0')))
+        ifd_offset = self.position
+        ifd = struct.pack('<Q', len(packed))
+        for tag, tag_type, count, value in packed:
+            ifd += struct.pack('<HHQ', tag, tag_type, count) + value
+        self.file.write(ifd)
+        self.position += len(ifd)
+        next_pointer = self.position
+        self.file.write(struct.pack('<Q', 0))
+        self.position += 8
+        return ifd_offset, next_pointer
+
+    def close(self):
+        self.__fill_missing()
+        if self.position % 2:
+            self.file.write(b'\0')
+            self.position += 1
+        previous_pointer = 8  # 文件头中第一个IFD的位置
+        for index, level in enumerate(self.levels):
+            ifd_offset, next_pointer = self.__write_ifd(self.__ifd_entries(index, level))
+            self.file.seek(previous_pointer)
+            self.file.write(struct.pack('<Q', ifd_offset))
+            self.file.seek(self.position)
+            previous_pointer = next_pointer
+        self.file.close()
+
+
+#   TIFF的LZW解压，与lzw_encode对应(解码端比编码端提前一位切换码宽)
+def lzw_decode(data):
+    out = bytearray()
+    table = [bytes([i]) for i in range(256)] + [b'', b'']
+    width = 9
+    bit_buffer = 0
+    bit_count = 0
+    previous = None
+    for byte in data:
+        bit_buffer = (bit_buffer << 8) | byte
+        bit_count += 8
+        if bit_count < width:
+            continue
+        bit_count -= width
+        code = (bit_buffer >> bit_count) & ((1 << width) - 1)
+        bit_buffer &= (1 << bit_count) - 1
+        if code == 257:
+            break
+        if code == 256:
+            table = table[:258]
+            width = 9
+            previous = None
+            continue
+        if previous is None:
+            entry = table[code]
+        elif code < len(table):
+            entry = table[code]
+            table.append(previous + entry[:1])
+        else:
+            entry = previous + previous[:1]
+            table.append(entry)
+        out += entry
+        previous = entry
+        if len(table) + 1 >= (1 << width) and width < 12:
+            width += 1
+    return bytes(out)
+
+
+#   解压一个tile，返回(tile_height, tile_width)的uint8 ndarray
+def decode_tile(data, compression, tile_height, tile_width):
+    if compression == 'deflate':
+        raw = zlib.decompress(data)
+    elif compression == 'lzw':
+        raw = lzw_decode(data)
+    elif compression == 'none':
+        raw = data
+    else:
+        print('unknown compression "{}", should be one of {}'.format(compression, list(compression_tags.keys())))
+        raise ValueError
+    return np.frombuffer(raw, dtype=np.uint8, count=tile_height * tile_width).reshape((tile_height, tile_width))
+
+
+#   初始化参数：
+#       path: 已有的分块tiff(Tiled_tiff_encoder生成的BigTIFF，或同样是单通道uint8分块的普通TIFF)
+#       mode: 'r'只读，'r+'可以替换其中的tile
+#   方法：
+#       read_tile(level, tile_x, tile_y)：读出并解压一个tile
+#       write_tile(level, tile_x, tile_y, tile)：压缩一个新的tile追加到文件末尾，并让偏移表指向它(仅'r+')
+#       close()：把改动过的偏移表和长度表写回原来的位置，关闭文件
+#   levels中每一层记录width，height，tile_width，tile_height，compression以及offsets/byte_counts表
+#   替换tile时不移动文件中的其它数据，旧的tile数据留在原处不再被引用，所以改动的代价只与替换的tile数量有关
+
+#   Initialization:
+#       path: an existing tiled tif (BigTIFF written by Tiled_tiff_encoder, or a classic single channel uint8 tiled TIFF)
+#       mode: 'r' read only, 'r+' allows replacing tiles
+#   Method:
+#       read_tile(level, tile_x, tile_y): read and decode one tile
+#       write_tile(level, tile_x, tile_y, tile): append a newly encoded tile and point the offset table at it ('r+' only)
+#       close(): write modified offset/byte count tables back in place and close the file
+#   Replacing a tile never moves other data, the old bytes stay unreferenced, so the cost scales with the replaced tiles.
+class Tiled_tiff_reader():
+    def __init__(self, path, mode='r'):
+        if mode not in ('r', 'r+'):
+            print('mode must be "r" or "r+"')
+            raise ValueError
+        self.path = path
+        self.mode = mode
+        self.file = open(path, 'rb' if mode == 'r' else 'r+b')
+        header = self.file.read(16)
+        if header[:2] != b'II':
+            print('{} is not a little-endian tiff'.format(path))
+            raise ValueError
+        version = struct.unpack('<H', header[2:4])[0]
+        if version == 43:
+            self.big = True
+            ifd_offset = struct.unpack('<Q', header[8:16])[0]
+        elif version == 42:
+            self.big = False
+            ifd_offset = struct.unpack('<I', header[4:8])[0]
+        else:
+            print('{} is not a tiff'.format(path))
+            raise ValueError
+        self.levels = []
+        while ifd_offset != 0:
+            level, ifd_offset = self.__read_ifd(ifd_offset)
+            self.levels.append(level)
+        self.file.seek(0, 2)
+        self.position = self.file.tell()
+        #   本次追加的均匀tile：(层号, 取值) -> (偏移, 长度)
+        self.uniform_stored = {}
+        self.modified = set()
+
+    def __read_ifd(self, ifd_offset):
+        count_format, entry_format, entry_size, pointer_format = \
+            ('<Q', '<HHQ', 20, '<Q') if self.big else ('<H', '<HHI', 12, '<I')
+        self.file.seek(ifd_offset)
+        count = struct.unpack(count_format, self.file.read(struct.calcsize(count_format)))[0]
+        entries = self.file.read(count * entry_size)
+        next_offset = struct.unpack(pointer_format, self.file.read(struct.calcsize(pointer_format)))[0]
+        type_formats = {1: 'B', 3: 'H', 4: 'I', 16: 'Q'}
+        tags = {}
+        for i in range(count):
+            entry = entries[i * entry_size:(i + 1) * entry_size]
+            tag, tag_type, value_count = struct.unpack(entry_format, entry[:struct.calcsize(entry_format)])
+            if tag_type not in type_formats:
+                continue
+            item_format = '<' + type_formats[tag_type]
+            size = struct.calcsize(item_format) * value_count
+            value_field_size = 8 if self.big else 4
+            #   数据所在的位置：放得下时就在条目里，否则条目里是指向数据的偏移
+            position = ifd_offset + struct.calcsize(count_format) + i * entry_size + entry_size - value_field_size
+            if size > value_field_size:
+                position = struct.unpack(pointer_format, entry[entry_size - value_field_size:])[0]
+            self.file.seek(position)
+            values = np.frombuffer(self.file.read(size), dtype=item_format)
+            tags[tag] = (values, position)
+        for tag in (256, 257, 322, 323, 324, 325):
+            if tag not in tags:
+                print('{} is not a tiled tiff'.format(self.path))
+                raise ValueError
+        if int(tags.get(258, ([8],))[0][0]) != 8 or int(tags.get(277, ([1],))[0][0]) != 1 or \
+                int(tags.get(317, ([1],))[0][0]) != 1:
+            print('{}: only single channel uint8 tiles without predictor are supported'.format(self.path))
+            raise ValueError
+        compressions = {tag: name for name, tag in compression_tags.items()}
+        compression_tag = int(tags.get(259, ([1],))[0][0])
+        if compression_tag not in compressions:
+            print('{}: unsupported compression {}'.format(self.path, compression_tag))
+            raise ValueError
+        width, height = int(tags[256][0][0]), int(tags[257][0][0])
+        tile_width, tile_height = int(tags[322][0][0]), int(tags[323][0][0])
+        shape = (int(np.ceil(height / tile_height)), int(np.ceil(width / tile_width)))
+        level = {'width': width,
+                 'height': height,
+                 'tile_width': tile_width,
+                 'tile_height': tile_height,
+                 'compression': compressions[compression_tag],
+                 'offsets': tags[324][0].astype(np.uint64).reshape(shape),
+                 'byte_counts': tags[325][0].astype(np.uint64).reshape(shape),
+                 'offsets_position': tags[324][1],
+                 'byte_counts_position': tags[325][1],
+                 'offsets_dtype': tags[324][0].dtype,
+                 'byte_counts_dtype': tags[325][0].dtype}
+        return level, next_offset
+
+    def read_tile(self, level, tile_x, tile_y):
+        info = self.levels[level]
+        self.file.seek(int(info['offsets'][tile_y, tile_x]))
+        data = self.file.read(int(info['byte_counts'][tile_y, tile_x]))
+        return decode_tile(data, info['compression'], info['tile_height'], info['tile_width'])
+
+    def write_tile(self, level, tile_x, tile_y, tile):
+        if self.mode != 'r+':
+            print('{} is opened read only'.format(self.path))
+            raise ValueError
+        info = self.levels[level]
+        value = uniform_value(tile)
+        location = self.uniform_stored.get((level, value)) if value is not None else None
+        if location is None:
+            data = encode_tile(tile, info['compression'])
+            if self.position % 2:
+                self.file.seek(self.position)
+                self.file.write(b'\0')
+                self.position += 1
+            location = (self.position, len(data))
+            self.file.seek(self.position)
+            self.file.write(data)
+            self.position += len(data)
+            if value is not None:
+                self.uniform_stored[(level, value)] = location
+        if not self.big and self.position >= 2 ** 32:
+            print('{}: a classic tiff cannot grow beyond 4GB'.format(self.path))
+            raise ValueError
+        info['offsets'][tile_y, tile_x] = location[0]
+        info['byte_counts'][tile_y, tile_x] = location[1]
+        self.modified.add(level)
+
+    def close(self):
+        for level in sorted(self.modified):
+            info = self.levels[level]
+            self.file.seek(info['offsets_position'])
+            self.file.write(info['offsets'].flatten().astype(info['offsets_dtype']).tobytes())
+            self.file.seek(info['byte_counts_position'])
+            self.file.write(info['byte_counts'].flatten().astype(info['byte_counts_dtype']).tobytes())
+        self.modified = set()
+        self.file.close()
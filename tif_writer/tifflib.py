@@ -1,10 +1,10 @@
 # !/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import h5py
 import numpy as np
 import os
 import sys
+import time
 
 '''Used for writing tif file'''
 
@@ -16,10 +16,60 @@ import sys
 #       default_val: tiff的初始值，默认0
 #       write_tile_size: 最终写tiff时使用的块大小，默认为512
 #       chunk_size: 暂存数据的大小，默认1024
+#       cache_bytes: 内存中缓存chunk的容量(字节)，写入先落在缓存里，只有被淘汰或finish()时才写回暂存文件，默认256MB
+#       store: 暂存数据的后端，'hdf5'(默认)，'memory'(整张图放在内存里)，或'memmap'(稀疏的平铺文件)
+#       encoder: 生成tiff的方式，'numpy'(默认，内置的BigTIFF编码，不依赖ASAP)或'mir'(使用multiresolutionimageinterface)
+#       compression: encoder为'numpy'时的压缩方式，'deflate'(默认)，'lzw'或'none'；'mir'总是使用LZW
+#       reduction: encoder为'numpy'时金字塔的降采样方式，'nearest'(默认)，'max'或'majority'(多数投票，适合标签图)
+#                  金字塔在chunk写回暂存后端时逐层增量更新，finish()时直接输出
+#       streaming: 流式写入模式(需要encoder='numpy')，调用者保证按行优先的顺序写入(y不减小)
+#                  每当一行chunk写完，就直接压缩写进最终的tiff并从内存中丢弃，不再使用暂存后端，store参数被忽略
+#                  往已经输出的行中写数据会报错
+#       mode: 写入方式，'overwrite'(默认，覆盖)，'max'/'min'(与已写入的值取最大/最小)，
+#             'sum'(加权求和)或'mean'(加权平均)，后两者可以在write时给出weight(标量或与tile同尺寸的数组)
+#             非覆盖模式下chunk带有第二个平面记录写入情况(sum/mean为float32的累加值与权重)，
+#             最终的uint8结果在chunk写回以及finish()时逐chunk计算，从未写过的像素保持default_val
+#       shard: 分片写入时，工作进程中的分片编号(0, 1, ...)，该实例只把数据写进自己的暂存文件 <name>_shard<k>，
+#              finish()只保存暂存文件，不生成tiff；store必须是'hdf5'或'memmap'，其余参数要与协调进程中的一致
+#       shards: 协调进程中的分片数量，finish()时先按分片编号的顺序逐chunk合并各个分片，再生成tiff
+#               冲突的像素按mode处理：'overwrite'为编号大的分片覆盖编号小的(last-writer)，'max'/'min'/'sum'/'mean'同上
+#       queue_size: 大于0时使用后台线程写入，write()/write_many()只是把(复制后的)数据放进长度为queue_size的队列就返回，
+#                   缓存的改写以及暂存文件的读写都在后台线程中进行，队列满时write()会阻塞(backpressure)；默认0为同步写入
+#                   后台线程中发生的异常会在下一次调用write()/checkpoint()/finish()时抛出
+#       resume: 为True时，若存在上次中断留下的暂存文件(store为'hdf5'或'memmap')，连同其accessed矩阵一起打开继续写入，
+#               最后一次checkpoint()之后的写入需要重新写；金字塔由已有的chunk重新计算；不存在时正常新建
+#               被淘汰的chunk可能已经带有checkpoint之后的写入，重写对'overwrite'/'max'/'min'没有影响，'sum'/'mean'会重复累加
+#       update: 为True时，target_tiff是一个已经生成好的tiff(内置编码器生成)，只暂存被改写的chunk，
+#               finish()时只重新压缩这些tile以及金字塔中受影响的tile，追加到原文件末尾并修改偏移表，其余数据不动
+#               chunk_size与压缩方式取自原文件，第一次改写某个chunk时先读出原来的tile；不支持'sum'/'mean'
+#       label_index: 为True时记录每个chunk中各个标签的像素数与外接矩形，chunk写回暂存或流式输出时由最终的uint8数据重新统计，
+#                    finish()时保存在tiff旁边的 <name>_labels.npz 中(用labelindex.load_label_index读取)，
+#                    之后"类别k的面积/含有类别k的chunk/类别k的外接矩形"都不需要再读像素；
+#                    更新已有的tiff时沿用已有的索引文件，没有时未改写的chunk从原文件的tile统计；分片不记录
+#       progress: 进度回调progress(event)，默认None时照常打印；给出时所有提示信息都以{'stage', 'message'}的形式交给它，
+#                 写入与finish()的进度以{'stage', 'current', 'total', 'elapsed', 'rate'}的形式限速(每秒约2次)交给它，
+#                 例如发给任务面板；monitor.terminal_progress为终端上的实现
 #   方法：
 #       write(x, y, tile)：以位置(x, y)为左上角，写入一个任意大小的tile
 #       write_center(x, y, tile)：以位置(x, y)为中心，写入一个任意大小的tile
+#       write_many(xs, ys, tiles)：一次写入一批tile(以左上角为位置)，按目标chunk分组后每个chunk只处理一次
+#       write_center_many(xs, ys, tiles)：同上，以中心为位置
+#       write_polygons(polygons, labels)：把多边形标注(level 0上的顶点)逐chunk扫描线填充写入，不需要整张的ndarray
+#       write_rle(rles, labels, xs, ys)：把COCO格式的RLE mask逐chunk写入
+#       read(x, y, w, h)：读出以(x, y)为左上角、宽w高h的区域中目前已经写入的数据(先查缓存，再查暂存后端)，
+#           从未写过的chunk直接以default_val填充，不读文件；区域在一个chunk之内且mode为'overwrite'时返回缓存中chunk的视图，
+#           该视图会随后续的写入而改变，不要修改它
+#       read_center(x, y, w, h)：同上，以(x, y)为中心
 #       finish()：完成所有数据的写入后，调用该命令生成最终的tiff文件
+#           finish(workers=n, queue_depth=m, pool='thread'/'process')可以并行压缩tile
+#       cache_stats()：返回chunk缓存的命中/未命中/淘汰次数，便于确定cache_bytes
+#       label_index：label_index=True时的Label_index，可以直接查询area(k)，chunks(k)，bbox(k)
+#       stats()：返回性能统计：计数器(写过的chunk数，写回暂存的chunk数与字节数，从暂存读出的chunk数与字节数，输出的字节数)，
+#           各部分的累计耗时(暂存读写，金字塔更新，压缩，写tiff，finish)，以及write()/write_many()单次调用耗时的直方图
+#       checkpoint()：等待队列中的写入完成，把脏数据写回暂存后端并持久化accessed矩阵(write(..., save=True)等价于写完后调用它)
+#       write_async(...)/write_many_async(...)/checkpoint_async()/finish_async(...)：对应方法的asyncio版本，
+#           在writer自己的单线程执行器中按调用的顺序依次执行，不会阻塞事件循环，同时await多个调用(例如asyncio.gather)也是安全的，
+#           例如 await writer.write_async(x, y, tile)
 
 #   Initialization:
 #       target_tiff: the path for saving tif file
@@ -28,20 +78,90 @@ import sys
 #       default_val: initial value of all pixels in tif file, default = 0
 #       write_tile_size: TileSize used in mir.writer, you can leave this as default
 #       chunk_size: chunk size for building hdf5 file, you can leave this as default
+#       cache_bytes: capacity (in bytes) of the in-memory chunk cache, dirty chunks are flushed to the store on eviction or finish()
+#       store: staging backend, 'hdf5' (default), 'memory' (whole canvas in RAM) or 'memmap' (sparse flat file)
+#       encoder: 'numpy' (default, built-in BigTIFF writer without ASAP) or 'mir' (multiresolutionimageinterface)
+#       compression: 'deflate' (default), 'lzw' or 'none' for the numpy encoder; 'mir' always uses LZW
+#       reduction: pyramid downsampling of the numpy encoder, 'nearest' (default), 'max' or 'majority' (for label masks)
+#                  levels are updated incrementally whenever a chunk is flushed, finish() only emits them
+#       streaming: raster-order mode (numpy encoder only), the caller promises that y never decreases
+#                  every completed row of chunks is encoded into the final tif right away and dropped from memory,
+#                  no staging store is used (store is ignored); writing into an already emitted row raises an error
+#       mode: 'overwrite' (default), 'max'/'min' (reduce with what is already written),
+#             'sum' (weighted sum) or 'mean' (weighted mean), write(..., weight=w) takes a scalar or per-pixel weight
+#             non-overwrite modes keep a second plane per chunk (float32 accumulator and weight for sum/mean),
+#             the uint8 result is computed per chunk on flush and in finish(), unwritten pixels keep default_val
+#       shard: id (0, 1, ...) of a shard writer living in a worker process, it only writes its own staging file
+#              <name>_shard<k> and finish() just saves it without producing a tif; store must be 'hdf5' or 'memmap',
+#              all other parameters must match the coordinating writer
+#       shards: number of shards merged by the coordinating writer, finish() merges them chunk by chunk in shard order
+#               before writing the tif; conflicting pixels follow mode, 'overwrite' means the highest shard id wins
+#       queue_size: when > 0, write()/write_many() only put a copy of the data into a bounded queue of this length,
+#                   a background thread applies them to the cache and does all staging I/O, write() blocks while
+#                   the queue is full (backpressure); 0 (default) writes synchronously
+#                   errors raised in the background thread are re-raised by the next write()/checkpoint()/finish()
+#       resume: reopen the staging file of an interrupted job ('hdf5' or 'memmap') together with its accessed matrix,
+#               writes after the last checkpoint() must be redone, the pyramid is rebuilt from the staged chunks;
+#               a new store is created when none exists. Evicted chunks may already hold some of those writes, redoing
+#               them is harmless for 'overwrite'/'max'/'min' but double counts for 'sum'/'mean'
+#       update: target_tiff is an existing tif (written by the numpy encoder), only touched chunks are staged and
+#               finish() re-encodes just those tiles plus the affected pyramid tiles, appends them to the file and
+#               patches the offset tables; chunk_size and compression come from the file, a chunk starts from the
+#               existing tile when it is first written; 'sum'/'mean' are not supported
+#       label_index: keep per-chunk label statistics (pixel count and bounding box of every label), refreshed from the
+#                    final uint8 content whenever a chunk is flushed or streamed out; finish() saves them next to the
+#                    tif as <name>_labels.npz (see labelindex.load_label_index). In update mode an existing sidecar is
+#                    reused, otherwise untouched chunks are counted from the original tiles. Not kept by shard writers
+#       progress: progress(event) callback; None (default) keeps printing. When given, every message is passed as
+#                 {'stage', 'message'} and write/finish progress as {'stage', 'current', 'total', 'elapsed', 'rate'},
+#                 rate limited to about two events per second, e.g. for a job dashboard
+#                 (monitor.terminal_progress renders them in the terminal)
 #   Method:
 #       write(x, y, tile): write a tile at location (x,y) (top left coordinates), tile: 2-d uint8 ndarray of arbitary size
 #       write(x, y, tile): write a tile at location (x,y) (center coordinates), tile: 2-d uint8 ndarray of arbitrary size
+#       write_many(xs, ys, tiles): write a batch of tiles (top left coordinates), pieces are grouped by destination chunk
+#       write_center_many(xs, ys, tiles): same as write_many, with center coordinates
+#       write_polygons(polygons, labels): scanline-fill polygon annotations (level 0 vertices) chunk by chunk,
+#           in draw order, without a full-size ndarray
+#       write_rle(rles, labels, xs, ys): write COCO style run-length encoded masks chunk by chunk
+#       read(x, y, w, h): read back the data written so far in the w x h region at (x, y) (top left), from the cache
+#           first and then the staging store; untouched chunks are filled with default_val without any I/O. A region
+#           inside one chunk in 'overwrite' mode is returned as a view of the cached chunk, which later writes will
+#           change and which must not be modified
+#       read_center(x, y, w, h): same as read, with center coordinates
 #       finish(): when all data has been writen, call this to obtain final tif file.
+#           finish(workers=n, queue_depth=m, pool='thread'/'process') compresses tiles in parallel
+#       cache_stats(): hits/misses/evictions of the chunk cache, useful for choosing cache_bytes
+#       label_index: the Label_index kept with label_index=True, answering area(k), chunks(k) and bbox(k)
+#       stats(): counters (chunks touched, chunks/bytes staged and read back, bytes output), accumulated time of
+#           staging I/O, pyramid updates, compression, output writing and finish(), and latency histograms of
+#           write()/write_many() calls, together with the cache statistics
+#       checkpoint(): wait for queued writes, flush dirty chunks and persist the accessed matrix
+#           (write(..., save=True) is the same as calling it after the write)
+#       write_async/write_many_async/checkpoint_async/finish_async: asyncio versions run one at a time, in call order, on a
+#           single-thread executor owned by the writer, so concurrent awaits (asyncio.gather) are safe,
+#           e.g. await writer.write_async(x, y, tile)
 class Tiff_writer():
     def __init__(self, target_tiff, tiff_width, tiff_height,
                  default_val=0,
                  spacing=None,
-                 write_tile_size=512, chunk_size=1024):
+                 write_tile_size=512, chunk_size=1024,
+                 cache_bytes=256 * 1024 ** 2,
+                 store='hdf5',
+                 encoder='numpy', compression='deflate', reduction='nearest',
+                 streaming=False, mode='overwrite', shard=None, shards=0, queue_size=0,
+                 resume=False, update=False, label_index=False, progress=None):
         self.target_tiff = target_tiff
         self.tiff_width = tiff_width
         self.tiff_height = tiff_height
         self.default_val = default_val
         self.spacing = spacing
+        #   性能统计与进度回调
+        from .monitor import Stats_recorder, Progress_reporter
+        self.recorder = Stats_recorder()
+        self.progress = progress
+        self.write_progress = None if progress is None else Progress_reporter(progress, stage='write')
+        self.output_encoder = None
 
         def get_2_base(num):
             power = 1
@@ -62,44 +182,301 @@ class Tiff_writer():
 
         self.chunk_size = get_2_base(chunk_size)
 
+        #   更新已有的tiff：tile大小与压缩方式沿用原文件
+        self.base_tiff = None
+        if update:
+            if encoder != 'numpy' or streaming or shard is not None or mode in ('sum', 'mean'):
+                print('update mode requires encoder="numpy", no streaming or shard, and a mode other than sum/mean')
+                raise ValueError
+            from .tiffio import Tiled_tiff_reader
+            self.base_tiff = Tiled_tiff_reader(target_tiff, 'r+')
+            base_level = self.base_tiff.levels[0]
+            if (base_level['width'], base_level['height']) != (tiff_width, tiff_height) or \
+                    base_level['tile_width'] != base_level['tile_height']:
+                print('{} is {}x{} with {}x{} tiles, cannot update it as {}x{}'.format(
+                    target_tiff, base_level['width'], base_level['height'], base_level['tile_width'],
+                    base_level['tile_height'], tiff_width, tiff_height))
+                raise ValueError
+            self.chunk_size = base_level['tile_width']
+            self.write_tile_size = min(self.write_tile_size, self.chunk_size)
+            compression = base_level['compression']
+
         if self.chunk_size < self.write_tile_size:
             #   这样子可以保证写数据时，只需要从某一个chunk上读
             print('write_tile_size must not larger than chunk_size')
             raise ValueError
 
-        self.horizontal_chunk_amount = int(np.ceil(tiff_width / chunk_size))
-        self.vertical_chunk_amount = int(np.ceil(tiff_height / chunk_size))
+        if encoder not in ('numpy', 'mir'):
+            print('encoder must be "numpy" or "mir"')
+            raise ValueError
+        self.encoder = encoder
+        self.compression = compression
+        if streaming and encoder != 'numpy':
+            print('streaming mode requires encoder="numpy"')
+            raise ValueError
+        self.streaming = streaming
+        if mode not in ('overwrite', 'max', 'min', 'sum', 'mean'):
+            print('mode must be one of "overwrite", "max", "min", "sum" and "mean"')
+            raise ValueError
+        self.mode = mode
+        if (shard is not None or shards > 0 or resume) and (streaming or store == 'memory'):
+            print('sharded writing and resume require store="hdf5" or "memmap" and do not support streaming')
+            raise ValueError
+        self.shard = shard
+        self.shards = shards
+        #   非覆盖模式下chunk有两个平面：max/min为(值, 是否写过)，sum/mean为(加权累加值, 权重)
+        #   分片在覆盖模式下也要记录哪些像素写过，合并时才能区分写入的default_val和未写入的像素
+        self.chunk_planes = 1 if mode == 'overwrite' and shard is None else 2
+        self.chunk_dtype = np.float32 if mode in ('sum', 'mean') else np.uint8
+
+        self.horizontal_chunk_amount = int(np.ceil(tiff_width / self.chunk_size))
+        self.vertical_chunk_amount = int(np.ceil(tiff_height / self.chunk_size))
+
+        #   accessed矩阵在内存中保留一份，不必每次都去hdf5里读
+        self.accessed = np.zeros((self.vertical_chunk_amount, self.horizontal_chunk_amount), dtype=bool)
+        #   写入直接落在缓存中的ndarray上，被改动过的chunk记在dirty里，淘汰时才写回暂存后端
+        from .cache import Lru_cache
+        self.dirty = set()
+        #   被write_polygons/write_rle完全覆盖的chunk -> 标签值，输出时直接指向编码器中共用的均匀tile，不用读回、检查和压缩
+        #   之后再被写入的chunk从这里去掉
+        self.uniform_chunks = {}
+        if streaming:
+            #   流式写入时，内存中只保留尚未输出的几行chunk，它们不会被淘汰
+            store = 'memory'
+            cache_bytes = sys.maxsize
+        self.cache = Lru_cache(cache_bytes, on_evict=self.__flush_chunk)
 
         from .files import purename
+        from .chunkstore import make_chunk_store, chunk_store_exists
 
-        hdf5name = purename(target_tiff) + '_temp.hdf5'
-        self.hdf5name = hdf5name
-        if os.path.isfile(hdf5name):
-            os.remove(hdf5name)
+        self.__log('initializing {} data structure ...'.format('streaming' if streaming else store))
+        #   暂存文件与目标tiff同名，例如 <name>_temp.hdf5，分片为 <name>_shard<k>_temp.hdf5
+        self.store_type = store
+        self.store = None
+        resumed = False
+        if not streaming:
+            name = purename(target_tiff) if shard is None else self.__shard_name(shard)
+            resumed = resume and chunk_store_exists(store, name)
+            self.store = make_chunk_store(store, name,
+                                          self.horizontal_chunk_amount, self.vertical_chunk_amount,
+                                          self.chunk_size, default_val, self.chunk_planes, self.chunk_dtype,
+                                          reopen='r+' if resumed else None)
+            if resumed:
+                accessed = self.store.load_accessed()
+                if accessed is not None:
+                    self.accessed = accessed.astype(bool)
+                self.__log('resuming {} chunks from the staging file'.format(int(self.accessed.sum())))
+        self.shard_stores = []
 
-        print('initializing hdf5 data structure ...')
-        sys.stdout.flush()
-        self.__hdf5file_init(hdf5name)
-
-    #   初始化中间的hdf5文件
-    #   在根目录下创建了适当数目的group
-    #   在根目录下创建了'accessed'数据集，对应每个group是否被访问过，初始化全为False
-    def __hdf5file_init(self, hdf5name):
-        f = h5py.File(hdf5name)
-        #   为每一个子区域创建一个group，同时在母数据集上设置一个标记矩阵，表示每个区域是否被改动
-        f.create_dataset(name='accessed', dtype=bool,
-                         data=np.zeros((self.vertical_chunk_amount, self.horizontal_chunk_amount), dtype=bool))
-        for x in range(self.horizontal_chunk_amount):
-            for y in range(self.vertical_chunk_amount):
-                sub_group = f.create_group(str(x) + '_' + str(y))
-        f.close()  # 先保存下来
-        f = h5py.File(hdf5name, 'r+')  # 然后再打开
-        self.f = f
-
-    #   只有当必要的时候，才对一个group进行初始化
-    def __subgroup_init(self, sub_group):
-        chunk_default_data = (np.ones((self.chunk_size, self.chunk_size)) * self.default_val).astype(np.uint8)
-        sub_group.create_dataset('value', dtype='uint8', data=chunk_default_data)
+        #   金字塔(仅内置编码器需要，mir会在finishImage()时自己生成)，分片不生成tiff，也不需要金字塔
+        self.pyramid = None
+        if encoder == 'numpy' and shard is None:
+            from .pyramid import Pyramid, pyramid_levels
+            levels = pyramid_levels(tiff_width, tiff_height, self.chunk_size)
+            initial = None
+            if self.base_tiff is not None:
+                if [level[:2] for level in levels] != [(level['width'], level['height'])
+                                                       for level in self.base_tiff.levels]:
+                    print('the pyramid levels of {} do not match, it cannot be updated'.format(target_tiff))
+                    raise ValueError
+                initial = self.base_tiff.read_tile
+            self.pyramid = Pyramid(levels, self.chunk_size,
+                                   default_val=default_val, reduction=reduction, store=store,
+                                   name=purename(target_tiff), cache_bytes=max(cache_bytes // 4, self.chunk_size ** 2),
+                                   initial=initial)
+            #   继续写入时，金字塔由已有的chunk重新计算
+            if resumed:
+                for y_chunk_id, x_chunk_id in zip(*np.nonzero(self.accessed)):
+                    self.pyramid.update(x_chunk_id, y_chunk_id, self.__finalize(self.__store_read(x_chunk_id, y_chunk_id)))
+
+        #   标签统计：更新已有的tiff时先读入已有的索引文件
+        self.label_index = None
+        self.label_index_path = os.path.splitext(target_tiff)[0] + '_labels.npz'
+        self.label_index_complete = self.base_tiff is None
+        if label_index and shard is None:
+            from .labelindex import Label_index, load_label_index
+            self.label_index = Label_index(tiff_width, tiff_height, self.chunk_size, default_val)
+            if self.base_tiff is not None and os.path.isfile(self.label_index_path):
+                saved = load_label_index(self.label_index_path)
+                if (saved.width, saved.height, saved.chunk_size, saved.default_val) == \
+                        (tiff_width, tiff_height, self.chunk_size, default_val):
+                    self.label_index = saved
+                    self.label_index_complete = True
+            if resumed:
+                for y_chunk_id, x_chunk_id in zip(*np.nonzero(self.accessed)):
+                    self.label_index.update(x_chunk_id, y_chunk_id,
+                                            self.__finalize(self.__store_read(x_chunk_id, y_chunk_id)))
+
+        #   流式写入时，最终的tiff从一开始就打开，stream_row之前的chunk行都已经输出了
+        self.stream_row = 0
+        self.stream_encoder = None
+        if streaming:
+            self.stream_encoder = self.__open_encoder()
+
+        #   后台写入线程，队列中的每一项为(方法, 参数)，None表示结束
+        self.queue = None
+        self.background_thread = None
+        self.background_error = None
+        #   asyncio接口使用的单线程执行器，第一次调用时才创建
+        self.async_executor = None
+        if queue_size > 0:
+            import queue
+            import threading
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.background_thread = threading.Thread(target=self.__background_loop, daemon=True)
+            self.background_thread.start()
+
+    def __background_loop(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                #   出错之后不再处理后面的写入，只把队列清空
+                if self.background_error is None:
+                    func, args = job
+                    func(*args)
+            except BaseException as e:
+                self.background_error = e
+            finally:
+                self.queue.task_done()
+
+    def __raise_background_error(self):
+        if self.background_error is not None:
+            error, self.background_error = self.background_error, None
+            raise error
+
+    #   把一次写入交给后台线程，队列满时阻塞
+    def __submit(self, func, args):
+        self.__raise_background_error()
+        self.queue.put((func, args))
+
+    #   等待队列中的写入全部完成
+    def __drain(self):
+        if self.queue is not None:
+            self.queue.join()
+            self.__raise_background_error()
+
+    def __shard_name(self, shard):
+        from .files import purename
+        return purename(self.target_tiff) + '_shard' + str(shard)
+
+    #   新建一个默认值填充的chunk
+    def __default_chunk(self):
+        if self.chunk_planes == 1:
+            return np.full((self.chunk_size, self.chunk_size), self.default_val, dtype=np.uint8)
+        return np.zeros((self.chunk_planes, self.chunk_size, self.chunk_size), dtype=self.chunk_dtype)
+
+    #   第一次写某个chunk时的初始内容：更新已有的tiff时为原来的tile，否则为默认值
+    def __initial_chunk(self, x_chunk_id, y_chunk_id):
+        chunk = self.__default_chunk()
+        if self.base_tiff is None:
+            return chunk
+        tile = self.base_tiff.read_tile(0, x_chunk_id, y_chunk_id)
+        if self.chunk_planes == 1:
+            chunk[...] = tile
+        else:
+            chunk[0] = tile
+            chunk[1] = 1
+        return chunk
+
+    #   把chunk换算成最终写进tiff的uint8数据
+    def __finalize(self, chunk):
+        if self.chunk_planes == 1:
+            return chunk
+        #   分片在覆盖模式下也是两个平面，没有写过的像素同样为default_val
+        written = chunk[1] > 0
+        if self.mode in ('overwrite', 'max', 'min'):
+            value = chunk[0]
+        elif self.mode == 'sum':
+            value = np.clip(np.round(chunk[0]), 0, 255)
+        else:
+            value = np.clip(np.round(chunk[0] / np.where(written, chunk[1], 1)), 0, 255)
+        return np.where(written, value, self.default_val).astype(np.uint8)
+
+    #   获取chunk数据，优先从缓存中取；若该chunk尚未被访问过，create为False时返回None
+    def __get_chunk(self, x_chunk_id, y_chunk_id, create=True):
+        key = (x_chunk_id, y_chunk_id)
+        if create:
+            self.uniform_chunks.pop(key, None)
+        chunk = self.cache.get(key)
+        if chunk is not None:
+            return chunk
+        if self.accessed[y_chunk_id, x_chunk_id]:
+            chunk = self.__store_read(x_chunk_id, y_chunk_id)
+        elif create:
+            chunk = self.__initial_chunk(x_chunk_id, y_chunk_id)
+            self.accessed[y_chunk_id, x_chunk_id] = True
+            self.dirty.add(key)
+        else:
+            return None
+        self.cache.put(key, chunk)
+        return chunk
+
+    #   把一个chunk写回暂存后端(只有脏数据才需要写)
+    def __flush_chunk(self, key, chunk):
+        if key not in self.dirty:
+            return
+        with self.recorder.timer('staging_write'):
+            self.store.write(key[0], key[1], chunk)
+        self.recorder.count('chunks_staged')
+        self.recorder.count('bytes_staged', chunk.nbytes)
+        if self.pyramid is not None or self.label_index is not None:
+            value = self.__finalize(chunk)
+            if self.pyramid is not None:
+                with self.recorder.timer('pyramid_update'):
+                    self.pyramid.update(key[0], key[1], value)
+            if self.label_index is not None:
+                with self.recorder.timer('label_index'):
+                    self.label_index.update(key[0], key[1], value)
+        self.dirty.discard(key)
+
+    #   从暂存后端读出一个chunk，并记录耗时
+    def __store_read(self, x_chunk_id, y_chunk_id):
+        with self.recorder.timer('staging_read'):
+            chunk = self.store.read(x_chunk_id, y_chunk_id)
+        self.recorder.count('chunks_read')
+        self.recorder.count('bytes_read', chunk.nbytes)
+        return chunk
+
+    #   把缓存中所有脏数据写回暂存后端，缓存内容保留
+    def __flush_all(self):
+        for key in list(self.dirty):
+            self.__flush_chunk(key, self.cache.peek(key))
+
+    #   缓存的统计信息
+    def cache_stats(self):
+        return self.cache.stats()
+
+    #   性能统计：计数器、各部分的累计耗时以及写入调用的耗时直方图(见monitor.Stats_recorder.snapshot())
+    #   压缩与写tiff的耗时来自内置编码器；mir以及更新已有tiff时压缩包含在output_write中
+    def stats(self):
+        stats = self.recorder.snapshot()
+        stats['counters']['chunks_touched'] = int(self.accessed.sum())
+        if self.output_encoder is not None:
+            stats['timers']['compression'] = {'count': self.output_encoder.tiles_written,
+                                              'seconds': self.output_encoder.compress_seconds}
+            stats['timers']['output_write'] = {'count': self.output_encoder.tiles_written,
+                                               'seconds': self.output_encoder.write_seconds}
+            stats['counters']['bytes_output'] = self.output_encoder.bytes_written
+        stats['cache'] = self.cache.stats()
+        return stats
+
+    #   提示信息：没有进度回调时直接打印
+    def __log(self, message):
+        if self.progress is None:
+            print(message)
+            sys.stdout.flush()
+        else:
+            self.progress({'stage': 'message', 'message': message})
+
+    #   等待队列中的写入完成，把脏数据写回暂存后端，并持久化accessed矩阵
+    def checkpoint(self):
+        self.__drain()
+        if self.streaming:
+            return
+        self.__flush_all()
+        self.store.save(self.accessed)
 
     #   给定一个chunk的坐标范围，以及一个区域(x_lb,y_lb)~(x_ub,y_ub)，返回交叉区域在各自上的相对位置
     def __find_relative_location(self, chunk_x_lb, chunk_y_lb, chunk_x_ub, chunk_y_ub,
@@ -124,10 +501,88 @@ class Tiff_writer():
                (cross_x_lb_relative_tile, cross_x_ub_relative_tile, cross_y_lb_relative_tile,
                 cross_y_ub_relative_tile)
 
+    #   流式写入：第y_chunk_lb行之前的chunk行都已经写完了，把它们输出
+    def __advance_stream(self, y_chunk_lb):
+        if y_chunk_lb < self.stream_row:
+            print('streaming mode: chunk row {} has already been written to {}, writes must be in raster order'.format(
+                y_chunk_lb, self.target_tiff))
+            raise ValueError
+        y_chunk_lb = min(y_chunk_lb, self.vertical_chunk_amount)
+        while self.stream_row < y_chunk_lb:
+            for x_chunk_id in range(self.horizontal_chunk_amount):
+                key = (x_chunk_id, self.stream_row)
+                chunk = self.cache.pop(key)
+                if chunk is None:
+                    continue
+                chunk = self.__finalize(chunk)
+                uniform = self.uniform_chunks.pop(key, None)
+                if uniform is None:
+                    self.stream_encoder.write_tile(0, x_chunk_id, self.stream_row, chunk)
+                else:
+                    self.stream_encoder.write_uniform(0, x_chunk_id, self.stream_row, uniform)
+                with self.recorder.timer('pyramid_update'):
+                    self.pyramid.update(x_chunk_id, self.stream_row, chunk)
+                if self.label_index is not None:
+                    with self.recorder.timer('label_index'):
+                        self.label_index.update(x_chunk_id, self.stream_row, chunk)
+                self.dirty.discard(key)
+            self.stream_row += 1
+            self.pyramid.emit_rows(self.stream_row, self.stream_encoder)
+
+    #   把若干块数据按顺序写进同一个chunk，pieces中每一项为(y_lb, y_ub, x_lb, x_ub, sub_tile, sub_weight)，坐标相对于chunk
+    def __write_pieces(self, x_chunk_id, y_chunk_id, pieces):
+        index = 0
+        #   检查数据的情况，如果用户试图在写默认块，而且该位置尚未初始化，则什么都不做(仅单平面的覆盖模式，且不是在更新已有的tiff)
+        if self.chunk_planes == 1 and self.base_tiff is None and not self.accessed[y_chunk_id, x_chunk_id]:
+            while index < len(pieces) and (pieces[index][4] == self.default_val).all():
+                index += 1
+            if index == len(pieces):
+                return
+
+        #   读取现有数据(缓存中的ndarray)
+        value = self.__get_chunk(x_chunk_id, y_chunk_id)
+
+        #   改写数据
+        for y_lb, y_ub, x_lb, x_ub, sub_tile, sub_weight in pieces[index:]:
+            if self.chunk_planes == 1:
+                value[y_lb:y_ub, x_lb:x_ub] = sub_tile
+            elif self.mode == 'overwrite':
+                value[0, y_lb:y_ub, x_lb:x_ub] = sub_tile
+                value[1, y_lb:y_ub, x_lb:x_ub] = 1
+            elif self.mode in ('max', 'min'):
+                current = value[0, y_lb:y_ub, x_lb:x_ub]
+                written = value[1, y_lb:y_ub, x_lb:x_ub]
+                reduced = np.maximum(current, sub_tile) if self.mode == 'max' else np.minimum(current, sub_tile)
+                current[...] = np.where(written > 0, reduced, sub_tile)
+                written[...] = 1
+            else:
+                weight = 1. if sub_weight is None else sub_weight
+                value[0, y_lb:y_ub, x_lb:x_ub] += weight * sub_tile.astype(np.float32)
+                value[1, y_lb:y_ub, x_lb:x_ub] += weight
+        self.dirty.add((x_chunk_id, y_chunk_id))
+
     #   以x,y位置为左上角，写入一批数据tile
-    def write(self, x, y, tile, save=False):
-        f = self.f
+    #       weight: 仅mode为'sum'/'mean'时有效，标量或与tile同尺寸的数组，默认为1
+    def write(self, x, y, tile, save=False, weight=None):
+        start = time.perf_counter()
+        if self.queue is not None:
+            #   调用者可能会复用tile的内存，放进队列的是一份拷贝
+            if isinstance(weight, np.ndarray):
+                weight = weight.copy()
+            self.__submit(self.__write, (x, y, np.array(tile), weight))
+        else:
+            self.__write(x, y, tile, weight)
+        if save:
+            self.checkpoint()
+        self.__record_call('write', start)
+
+    #   记录一次写入调用的耗时(排队写入时只是放进队列的耗时)，并报告进度
+    def __record_call(self, name, start):
+        self.recorder.observe(name, time.perf_counter() - start)
+        if self.write_progress is not None:
+            self.write_progress.update()
 
+    def __write(self, x, y, tile, weight=None):
         chunk_size = self.chunk_size
 
         tile_shape = tile.shape
@@ -137,10 +592,13 @@ class Tiff_writer():
         y_lb = y
         y_ub = y + tile_shape[0]
 
-        x_chunk_lb = int(max(np.floor(x_lb / chunk_size), 0))
-        y_chunk_lb = int(max(np.floor(y_lb / chunk_size), 0))
-        x_chunk_ub = int(min(np.floor((x_ub - 1) / chunk_size), self.horizontal_chunk_amount - 1))
-        y_chunk_ub = int(min(np.floor((y_ub - 1) / chunk_size), self.vertical_chunk_amount - 1))
+        x_chunk_lb = int(max((x_lb // chunk_size), 0))
+        y_chunk_lb = int(max((y_lb // chunk_size), 0))
+        x_chunk_ub = int(min(((x_ub - 1) // chunk_size), self.horizontal_chunk_amount - 1))
+        y_chunk_ub = int(min(((y_ub - 1) // chunk_size), self.vertical_chunk_amount - 1))
+
+        if self.streaming:
+            self.__advance_stream(y_chunk_lb)
 
         for x_chunk_id in range(x_chunk_lb, x_chunk_ub + 1):
             for y_chunk_id in range(y_chunk_lb, y_chunk_ub + 1):
@@ -157,31 +615,18 @@ class Tiff_writer():
                     = self.__find_relative_location(this_chunk_x_lb, this_chunk_y_lb, this_chunk_x_ub, this_chunk_y_ub,
                                                     x_lb, y_lb, x_ub, y_ub)
 
-                #   检查数据的情况，如果用户试图在写默认块，而且该位置尚未初始化，则什么都不做
                 sub_tile = tile[cross_y_lb_relative_tile:cross_y_ub_relative_tile,
                            cross_x_lb_relative_tile:cross_x_ub_relative_tile]
-
-                #   检查该组是否已被创建，如果尚未创建，则进行创建
-                group_name = str(x_chunk_id) + '_' + str(y_chunk_id)
-                if not f['accessed'][y_chunk_id, x_chunk_id]:
-                    if (sub_tile == self.default_val).all():
-                        continue
-                    self.__subgroup_init(f[group_name])
-                    f['accessed'][y_chunk_id, x_chunk_id] = True
-
-                #   读取现有数据
-                value = f[str(x_chunk_id) + '_' + str(y_chunk_id)]['value']
-
-                #   改写数据
-                value[cross_y_lb_relative_chunk:cross_y_ub_relative_chunk,
-                cross_x_lb_relative_chunk:cross_x_ub_relative_chunk] = sub_tile
-        if save:
-            self.f.close()  # 先保存下来
-            f = h5py.File(self.hdf5name)  # 再打开
-            self.f = f
+                sub_weight = weight
+                if isinstance(weight, np.ndarray) and weight.ndim == 2:
+                    sub_weight = weight[cross_y_lb_relative_tile:cross_y_ub_relative_tile,
+                                 cross_x_lb_relative_tile:cross_x_ub_relative_tile]
+                self.__write_pieces(x_chunk_id, y_chunk_id,
+                                    [(cross_y_lb_relative_chunk, cross_y_ub_relative_chunk,
+                                      cross_x_lb_relative_chunk, cross_x_ub_relative_chunk, sub_tile, sub_weight)])
 
     #   以x,y位置为中心，写入一批数据
-    def write_center(self, x, y, tile, save=False):
+    def write_center(self, x, y, tile, save=False, weight=None):
         h, w = tile.shape
 
         def get_shift(s):
@@ -189,15 +634,514 @@ class Tiff_writer():
 
         x_lt = x - get_shift(w)
         y_lt = y - get_shift(h)
-        self.write(x_lt, y_lt, tile, save)
+        self.write(x_lt, y_lt, tile, save, weight)
+
+    #   一次写入一批tile，xs/ys为各tile左上角的坐标，tiles为2-d ndarray的list，或(n, h, w)的ndarray
+    #   所有tile先用向量化的方式拆成落在各个chunk上的小块，再按chunk分组，每个chunk只取一次，组内按写入顺序依次改写
+    #   结果与按顺序逐个调用write()相同
+    #       weights: 仅mode为'sum'/'mean'时有效，None，或每个tile一个权重(标量或与tile同尺寸的数组)
+    def write_many(self, xs, ys, tiles, save=False, weights=None):
+        start = time.perf_counter()
+        if self.queue is not None:
+            tiles = np.array(tiles) if isinstance(tiles, np.ndarray) else [np.array(tile) for tile in tiles]
+            if weights is not None:
+                weights = [weight.copy() if isinstance(weight, np.ndarray) else weight for weight in weights]
+            self.__submit(self.__write_many, (np.array(xs), np.array(ys), tiles, weights))
+        else:
+            self.__write_many(xs, ys, tiles, weights)
+        if save:
+            self.checkpoint()
+        self.__record_call('write_many', start)
+
+    def __write_many(self, xs, ys, tiles, weights=None):
+        chunk_size = self.chunk_size
+        xs = np.asarray(xs, dtype=np.int64).reshape(-1)
+        ys = np.asarray(ys, dtype=np.int64).reshape(-1)
+        if isinstance(tiles, np.ndarray) and tiles.ndim == 3:
+            heights = np.full(len(tiles), tiles.shape[1], dtype=np.int64)
+            widths = np.full(len(tiles), tiles.shape[2], dtype=np.int64)
+        else:
+            heights = np.array([tile.shape[0] for tile in tiles], dtype=np.int64)
+            widths = np.array([tile.shape[1] for tile in tiles], dtype=np.int64)
+        if not len(xs) == len(ys) == len(heights):
+            print('xs, ys and tiles must have the same length')
+            raise ValueError
+
+        #   每个tile覆盖的chunk范围
+        x_chunk_lb = np.maximum(xs // chunk_size, 0)
+        y_chunk_lb = np.maximum(ys // chunk_size, 0)
+        x_chunk_ub = np.minimum((xs + widths - 1) // chunk_size, self.horizontal_chunk_amount - 1)
+        y_chunk_ub = np.minimum((ys + heights - 1) // chunk_size, self.vertical_chunk_amount - 1)
+        x_chunk_count = np.maximum(x_chunk_ub - x_chunk_lb + 1, 0)
+        y_chunk_count = np.maximum(y_chunk_ub - y_chunk_lb + 1, 0)
+        piece_count = x_chunk_count * y_chunk_count
+
+        if self.streaming and len(xs) > 0:
+            self.__advance_stream(int(y_chunk_lb.min()))
+
+        #   展开成(tile, chunk)对
+        tile_ids = np.repeat(np.arange(len(xs)), piece_count)
+        if len(tile_ids) == 0:
+            return
+        local = np.arange(len(tile_ids)) - np.repeat(np.cumsum(piece_count) - piece_count, piece_count)
+        x_chunk_ids = x_chunk_lb[tile_ids] + local % x_chunk_count[tile_ids]
+        y_chunk_ids = y_chunk_lb[tile_ids] + local // x_chunk_count[tile_ids]
+
+        #   交叉区域的绝对坐标，再换算成相对于chunk和tile的坐标
+        x_lb = np.maximum(x_chunk_ids * chunk_size, xs[tile_ids])
+        y_lb = np.maximum(y_chunk_ids * chunk_size, ys[tile_ids])
+        x_ub = np.minimum((x_chunk_ids + 1) * chunk_size, xs[tile_ids] + widths[tile_ids])
+        y_ub = np.minimum((y_chunk_ids + 1) * chunk_size, ys[tile_ids] + heights[tile_ids])
+        bounds = np.stack([y_lb - y_chunk_ids * chunk_size, y_ub - y_chunk_ids * chunk_size,
+                           x_lb - x_chunk_ids * chunk_size, x_ub - x_chunk_ids * chunk_size,
+                           y_lb - ys[tile_ids], y_ub - ys[tile_ids],
+                           x_lb - xs[tile_ids], x_ub - xs[tile_ids]], axis=1).tolist()
+
+        #   按chunk分组，稳定排序保证组内仍是写入的顺序
+        keys = y_chunk_ids * self.horizontal_chunk_amount + x_chunk_ids
+        order = np.argsort(keys, kind='stable')
+        group_starts = np.flatnonzero(np.diff(keys[order], prepend=-1))
+        group_ends = np.append(group_starts[1:], len(order))
+        tile_ids = tile_ids.tolist()
+        for start, end in zip(group_starts, group_ends):
+            pieces = []
+            for i in order[start:end]:
+                c_y_lb, c_y_ub, c_x_lb, c_x_ub, t_y_lb, t_y_ub, t_x_lb, t_x_ub = bounds[i]
+                sub_weight = None if weights is None else weights[tile_ids[i]]
+                if isinstance(sub_weight, np.ndarray) and sub_weight.ndim == 2:
+                    sub_weight = sub_weight[t_y_lb:t_y_ub, t_x_lb:t_x_ub]
+                pieces.append((c_y_lb, c_y_ub, c_x_lb, c_x_ub, tiles[tile_ids[i]][t_y_lb:t_y_ub, t_x_lb:t_x_ub],
+                               sub_weight))
+            self.__write_pieces(int(x_chunk_ids[order[start]]), int(y_chunk_ids[order[start]]), pieces)
+
+    #   一次写入一批tile，xs/ys为各tile中心的坐标
+    def write_center_many(self, xs, ys, tiles, save=False, weights=None):
+        if isinstance(tiles, np.ndarray) and tiles.ndim == 3:
+            heights = np.full(len(tiles), tiles.shape[1], dtype=np.int64)
+            widths = np.full(len(tiles), tiles.shape[2], dtype=np.int64)
+        else:
+            heights = np.array([tile.shape[0] for tile in tiles], dtype=np.int64)
+            widths = np.array([tile.shape[1] for tile in tiles], dtype=np.int64)
+        xs = np.asarray(xs, dtype=np.int64).reshape(-1) - (widths - 1) // 2
+        ys = np.asarray(ys, dtype=np.int64).reshape(-1) - (heights - 1) // 2
+        self.write_many(xs, ys, tiles, save, weights)
 
-    #   完成数据构建，生成最终的tiff文件，默认情况下删除临时的hdf5文件
-    def finish(self, free=True):
+    #   把多边形标注直接光栅化写进各个chunk，不需要先生成整张的ndarray
+    #       polygons: 多边形的list，每个多边形为(n, 2)的level 0上(x, y)顶点数组，或由外环与洞组成的list(奇偶规则)
+    #       labels: 标签值，标量或每个多边形一个
+    #   像素的中心在多边形内即属于该多边形；按list的顺序写入，后面的多边形覆盖前面的('max'/'min'/'sum'/'mean'按mode合并)
+    #   按chunk行分段扫描，内存只与chunk大小和边数有关，与标注的范围无关；被完全覆盖的矩形区域直接整块赋值，不逐像素处理，
+#   完全覆盖了整个chunk时(覆盖模式)，该chunk标记为均匀，finish()时直接使用编码器中共用的均匀tile
+    def write_polygons(self, polygons, labels, save=False):
+        from .rasterize import polygon_edges
+        start = time.perf_counter()
+        polygons = list(polygons)
+        labels = np.broadcast_to(np.asarray(labels, dtype=np.uint8), (len(polygons),)).copy()
+        #   边的数组是新建的，放进队列时不需要再复制
+        edges = polygon_edges(polygons)
+        if self.queue is not None:
+            self.__submit(self.__write_polygons, (edges, labels))
+        else:
+            self.__write_polygons(edges, labels)
+        if save:
+            self.checkpoint()
+        self.__record_call('write_polygons', start)
+
+    def __write_polygons(self, edges, labels):
+        from .rasterize import polygon_runs
+        x0, y0, x1, y1, ids = edges
+        if len(ids) == 0:
+            return
+        row_lb = max(int(np.ceil(min(y0.min(), y1.min()) - 0.5)), 0)
+        row_ub = min(int(np.ceil(max(y0.max(), y1.max()) - 0.5)), self.tiff_height)
+        for y_chunk_id in range(row_lb // self.chunk_size, (row_ub - 1) // self.chunk_size + 1):
+            runs = polygon_runs(x0, y0, x1, y1, ids, max(y_chunk_id * self.chunk_size, row_lb),
+                                min((y_chunk_id + 1) * self.chunk_size, row_ub))
+            self.__write_runs(*runs, labels=labels, vertical=False)
+
+    #   把RLE编码的mask直接写进各个chunk
+    #       rles: 一个或一组COCO格式的RLE，{'size': [h, w], 'counts': 长度的list/数组，或压缩的字符串}
+    #       labels: 标签值，标量或每个RLE一个
+    #       xs, ys: 各RLE左上角在level 0上的位置，默认(0, 0)即与整张图对齐的RLE
+    #       order: counts的展开顺序，'F'(默认，按列，与COCO/pycocotools一致)或'C'(按行)
+    #   与write_polygons一样按顺序写入，内存与run的数量成正比
+    def write_rle(self, rles, labels, xs=0, ys=0, order='F', save=False):
+        from .rasterize import coco_counts, rle_runs
+        start = time.perf_counter()
+        if order not in ('F', 'C'):
+            print('order must be "F" (column major, as in COCO) or "C" (row major)')
+            raise ValueError
+        if isinstance(rles, dict):
+            rles = [rles]
+        labels = np.broadcast_to(np.asarray(labels, dtype=np.uint8), (len(rles),)).copy()
+        xs = np.broadcast_to(np.asarray(xs, dtype=np.int64), (len(rles),))
+        ys = np.broadcast_to(np.asarray(ys, dtype=np.int64), (len(rles),))
+        runs = []
+        for rle_id, rle in enumerate(rles):
+            h, w = [int(value) for value in rle['size']]
+            counts = rle['counts']
+            counts = coco_counts(counts) if isinstance(counts, (str, bytes)) else np.asarray(counts, dtype=np.int64)
+            if counts.sum() != h * w:
+                print('the counts of RLE {} sum to {}, expected {}x{}={}'.format(rle_id, counts.sum(), h, w, h * w))
+                raise ValueError
+            lines, starts, ends = rle_runs(counts, h if order == 'F' else w)
+            #   按列展开时run是竖直的，行为列号，起点终点为y坐标
+            line_offset, run_offset = (xs[rle_id], ys[rle_id]) if order == 'F' else (ys[rle_id], xs[rle_id])
+            runs.append((np.full(len(lines), rle_id, dtype=np.int64), lines + line_offset, starts + run_offset,
+                         ends + run_offset))
+        runs = [np.concatenate(parts) for parts in zip(*runs)] if len(runs) > 0 else [np.zeros(0, dtype=np.int64)] * 4
+        if self.queue is not None:
+            self.__submit(self.__write_runs, (*runs, labels, order == 'F'))
+        else:
+            self.__write_runs(*runs, labels=labels, vertical=order == 'F')
+        if save:
+            self.checkpoint()
+        self.__record_call('write_rle', start)
+
+    #   写入一组run：第ids个几何形状在第lines行(vertical为True时为列)上覆盖[starts, ends)，标签为labels[ids]
+    #   run在chunk的边界处切开后按chunk分组，组内再按几何形状的顺序逐个填充
+    def __write_runs(self, ids, lines, starts, ends, labels, vertical):
+        chunk_size = self.chunk_size
+        line_extent, run_extent = (self.tiff_width, self.tiff_height) if vertical else \
+            (self.tiff_height, self.tiff_width)
+        starts, ends = np.maximum(starts, 0), np.minimum(ends, run_extent)
+        keep = (starts < ends) & (lines >= 0) & (lines < line_extent)
+        ids, lines, starts, ends = ids[keep], lines[keep], starts[keep], ends[keep]
+        if len(ids) == 0:
+            return
+
+        first, last = starts // chunk_size, (ends - 1) // chunk_size
+        piece_count = last - first + 1
+        run_ids = np.repeat(np.arange(len(ids)), piece_count)
+        run_chunk_ids = first[run_ids] + np.arange(len(run_ids)) - \
+            np.repeat(np.cumsum(piece_count) - piece_count, piece_count)
+        line_chunk_ids = lines[run_ids] // chunk_size
+        piece_lines = lines[run_ids] - line_chunk_ids * chunk_size
+        piece_starts = np.maximum(starts[run_ids], run_chunk_ids * chunk_size) - run_chunk_ids * chunk_size
+        piece_ends = np.minimum(ends[run_ids], (run_chunk_ids + 1) * chunk_size) - run_chunk_ids * chunk_size
+        piece_ids = ids[run_ids]
+        x_chunk_ids, y_chunk_ids = (line_chunk_ids, run_chunk_ids) if vertical else (run_chunk_ids, line_chunk_ids)
+
+        if self.streaming:
+            self.__advance_stream(int(y_chunk_ids.min()))
+
+        #   按(chunk, 几何形状的顺序)分组
+        keys = y_chunk_ids * self.horizontal_chunk_amount + x_chunk_ids
+        order = np.lexsort((piece_ids, keys))
+        keys, piece_ids = keys[order], piece_ids[order]
+        piece_lines, piece_starts, piece_ends = piece_lines[order], piece_starts[order], piece_ends[order]
+        group_starts = np.flatnonzero(np.diff(keys, prepend=-1) | np.diff(piece_ids, prepend=-1))
+        group_ends = np.append(group_starts[1:], len(keys))
+        for start, end in zip(group_starts, group_ends):
+            y_chunk_id, x_chunk_id = divmod(int(keys[start]), self.horizontal_chunk_amount)
+            self.__fill_runs(x_chunk_id, y_chunk_id, piece_lines[start:end], piece_starts[start:end],
+                             piece_ends[start:end], labels[piece_ids[start]], vertical)
+
+    #   在一个chunk中填充同一个几何形状的run(坐标相对于chunk，互不重叠)
+    def __fill_runs(self, x_chunk_id, y_chunk_id, lines, starts, ends, label, vertical):
+        #   与写默认块时一样，尚未初始化的chunk不需要写default_val
+        if self.chunk_planes == 1 and self.base_tiff is None and not self.accessed[y_chunk_id, x_chunk_id] and \
+                label == self.default_val:
+            return
+        line_lb, line_ub = int(lines.min()), int(lines.max()) + 1
+        run_lb, run_ub = int(starts.min()), int(ends.max())
+        #   chunk在画布内部分的(行数, 每行长度)
+        chunk_width = min(self.chunk_size, self.tiff_width - x_chunk_id * self.chunk_size)
+        chunk_height = min(self.chunk_size, self.tiff_height - y_chunk_id * self.chunk_size)
+        line_extent, run_extent = (chunk_width, chunk_height) if vertical else (chunk_height, chunk_width)
+        #   run正好铺满外接矩形时整块赋值，否则用差分与前缀和在外接矩形内生成mask
+        mask = None
+        if int((ends - starts).sum()) != (line_ub - line_lb) * (run_ub - run_lb):
+            width = run_ub - run_lb + 1
+            size = (line_ub - line_lb) * width
+            offsets = (lines - line_lb) * width - run_lb
+            diff = np.bincount(offsets + starts, minlength=size) - np.bincount(offsets + ends, minlength=size)
+            mask = np.cumsum(diff.reshape(line_ub - line_lb, width), axis=1)[:, :-1] > 0
+
+        value = self.__get_chunk(x_chunk_id, y_chunk_id)
+        if vertical:
+            value = np.swapaxes(value, -1, -2)
+        region = (slice(line_lb, line_ub), slice(run_lb, run_ub))
+        if self.chunk_planes == 1:
+            target = value[region]
+            if mask is None:
+                target[...] = label
+            else:
+                target[mask] = label
+            if mask is None and line_lb == 0 and run_lb == 0 and line_ub == line_extent and run_ub == run_extent:
+                self.uniform_chunks[(x_chunk_id, y_chunk_id)] = int(label)
+        elif self.mode in ('overwrite', 'max', 'min'):
+            current, written = value[0][region], value[1][region]
+            new = label
+            if self.mode != 'overwrite':
+                reduced = np.maximum(current, label) if self.mode == 'max' else np.minimum(current, label)
+                new = np.where(written > 0, reduced, label)
+            if mask is None:
+                current[...] = new
+                written[...] = 1
+            else:
+                current[...] = np.where(mask, new, current)
+                written[mask] = 1
+        else:
+            weight = 1. if mask is None else mask.astype(np.float32)
+            value[0][region] += weight * float(label)
+            value[1][region] += weight
+        self.dirty.add((x_chunk_id, y_chunk_id))
+
+    #   读出以x,y位置为左上角，宽w高h的区域中已经写入的数据，越界的部分为default_val
+    def read(self, x, y, w, h):
+        self.__drain()
+        chunk_size = self.chunk_size
+        x_chunk_lb = max(x // chunk_size, 0)
+        y_chunk_lb = max(y // chunk_size, 0)
+        x_chunk_ub = min((x + w - 1) // chunk_size, self.horizontal_chunk_amount - 1)
+        y_chunk_ub = min((y + h - 1) // chunk_size, self.vertical_chunk_amount - 1)
+        if self.streaming and y_chunk_lb < self.stream_row:
+            print('streaming mode: chunk row {} has already been written to {} and cannot be read back'.format(
+                y_chunk_lb, self.target_tiff))
+            raise ValueError
+
+        #   区域完全落在一个chunk之内：覆盖模式下直接返回缓存中chunk的视图
+        if x_chunk_lb == x_chunk_ub and y_chunk_lb == y_chunk_ub and x >= 0 and y >= 0 and \
+                x + w <= min((x_chunk_lb + 1) * chunk_size, self.tiff_width) and \
+                y + h <= min((y_chunk_lb + 1) * chunk_size, self.tiff_height):
+            chunk = self.__read_chunk(x_chunk_lb, y_chunk_lb)
+            if chunk is None:
+                return np.full((h, w), self.default_val, dtype=np.uint8)
+            x_lb, y_lb = x - x_chunk_lb * chunk_size, y - y_chunk_lb * chunk_size
+            return chunk[y_lb:y_lb + h, x_lb:x_lb + w]
+
+        region = np.full((h, w), self.default_val, dtype=np.uint8)
+        for y_chunk_id in range(y_chunk_lb, y_chunk_ub + 1):
+            for x_chunk_id in range(x_chunk_lb, x_chunk_ub + 1):
+                chunk = self.__read_chunk(x_chunk_id, y_chunk_id)
+                if chunk is None:
+                    continue
+                (c_x_lb, c_x_ub, c_y_lb, c_y_ub), (t_x_lb, t_x_ub, t_y_lb, t_y_ub) = \
+                    self.__find_relative_location(x_chunk_id * chunk_size, y_chunk_id * chunk_size,
+                                                  (x_chunk_id + 1) * chunk_size, (y_chunk_id + 1) * chunk_size,
+                                                  x, y, x + w, y + h)
+                region[t_y_lb:t_y_ub, t_x_lb:t_x_ub] = chunk[c_y_lb:c_y_ub, c_x_lb:c_x_ub]
+        #   画布之外的部分保持default_val
+        if x + w > self.tiff_width:
+            region[:, max(self.tiff_width - x, 0):] = self.default_val
+        if y + h > self.tiff_height:
+            region[max(self.tiff_height - y, 0):, :] = self.default_val
+        return region
+
+    #   读出以x,y位置为中心，宽w高h的区域
+    def read_center(self, x, y, w, h):
+        return self.read(x - int(np.floor((w - 1) / 2)), y - int(np.floor((h - 1) / 2)), w, h)
+
+    #   读一个chunk的uint8数据，从未写过的chunk返回None(更新已有的tiff时为原来的tile)
+    def __read_chunk(self, x_chunk_id, y_chunk_id):
+        chunk = self.__get_chunk(x_chunk_id, y_chunk_id, create=False)
+        if chunk is None:
+            if self.base_tiff is None:
+                return None
+            chunk = self.__initial_chunk(x_chunk_id, y_chunk_id)
+        return self.__finalize(chunk)
+
+    #   asyncio版本的接口：在writer自己的单线程执行器中执行对应的方法，等待队列或磁盘时不阻塞事件循环
+    #   同步的方法不是线程安全的(缓存、暂存后端)，所以不能用默认的多线程池，同时提交的调用在这里按顺序排队
+    async def write_async(self, x, y, tile, save=False, weight=None):
+        await self.__run_in_executor(self.write, x, y, tile, save, weight)
+
+    async def write_center_async(self, x, y, tile, save=False, weight=None):
+        await self.__run_in_executor(self.write_center, x, y, tile, save, weight)
+
+    async def write_many_async(self, xs, ys, tiles, save=False, weights=None):
+        await self.__run_in_executor(self.write_many, xs, ys, tiles, save, weights)
+
+    async def checkpoint_async(self):
+        await self.__run_in_executor(self.checkpoint)
+
+    async def finish_async(self, free=True, workers=1, queue_depth=None, pool='thread'):
+        #   finish之后(包括出错时)不会再有写入，线程此时已经空闲
+        try:
+            await self.__run_in_executor(self.finish, free, workers, queue_depth, pool)
+        finally:
+            self.async_executor.shutdown(wait=False)
+            self.async_executor = None
 
-        #   首先把文件关闭保存数据，再重新打开
-        self.f.close()  # 先保存下来
-        f = h5py.File(self.hdf5name, 'r')  # 然后以只读方式打开
+    async def __run_in_executor(self, func, *args):
+        import asyncio
+        if self.async_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.async_executor = ThreadPoolExecutor(max_workers=1)
+        return await asyncio.get_running_loop().run_in_executor(self.async_executor, func, *args)
 
+    #   完成数据构建，生成最终的tiff文件，默认情况下删除临时的暂存文件
+    #       workers, queue_depth, pool: 仅对encoder='numpy'有效，压缩tile使用的线程/进程数、最多同时在途的tile数、池的类型
+    def finish(self, free=True, workers=1, queue_depth=None, pool='thread'):
+        with self.recorder.timer('finish'):
+            self.__finish(free, workers, queue_depth, pool)
+
+    def __finish(self, free, workers, queue_depth, pool):
+        #   等待后台线程处理完队列中的写入并退出；后台的写入出错时也要让线程退出，再把错误抛出
+        if self.queue is not None:
+            try:
+                self.__drain()
+            finally:
+                self.queue.put(None)
+                self.background_thread.join()
+                self.queue = None
+
+        if self.streaming:
+            #   输出剩下的所有行
+            self.__advance_stream(self.vertical_chunk_amount)
+            self.pyramid.emit_rows(self.vertical_chunk_amount, self.stream_encoder, final=True)
+            self.stream_encoder.close()
+            self.__print_encoder_summary(self.stream_encoder)
+            self.__save_label_index()
+            return
+
+        #   合并各个分片
+        if self.shards > 0:
+            self.__merge_shards()
+
+        #   首先把缓存中的数据写回暂存后端
+        self.__flush_all()
+        self.cache.clear()
+        self.store.save(self.accessed)
+
+        #   分片只需要保存暂存文件，由协调进程合并
+        if self.shard is not None:
+            self.store.close()
+            self.__log('shard {} of {} saved'.format(self.shard, self.target_tiff))
+            return
+
+        if self.encoder == 'mir':
+            self.__finish_mir()
+        elif self.base_tiff is not None:
+            self.pyramid.save()
+            self.__complete_label_index()
+            self.__finish_update()
+            self.pyramid.close()
+        else:
+            self.pyramid.save()
+            self.__finish_numpy(workers, queue_depth, pool)
+            self.pyramid.close()
+        self.__save_label_index()
+        self.store.close()
+        if free:
+            self.free()
+
+    #   更新已有的tiff且没有可用的索引文件时，从原文件统计未改写的chunk；全为默认值的tile共用同一个偏移，只统计一次
+    def __complete_label_index(self):
+        if self.label_index is None or self.label_index_complete:
+            return
+        offsets = self.base_tiff.levels[0]['offsets']
+        values, counts = np.unique(offsets[~self.accessed], return_counts=True)
+        shared = set(int(value) for value in values[counts > 1])
+        tiles = {}
+        for y_chunk_id, x_chunk_id in zip(*np.nonzero(~self.accessed)):
+            offset = int(offsets[y_chunk_id, x_chunk_id])
+            tile = tiles.get(offset)
+            if tile is None:
+                tile = self.base_tiff.read_tile(0, x_chunk_id, y_chunk_id)
+                if offset in shared:
+                    tiles[offset] = tile
+            self.label_index.update(x_chunk_id, y_chunk_id, tile)
+        self.label_index_complete = True
+
+    def __save_label_index(self):
+        if self.label_index is None:
+            return
+        self.label_index.save(self.label_index_path)
+        self.__log('   label index saved to {}'.format(self.label_index_path))
+
+    #   按分片编号的顺序，把各个分片写过的chunk逐个合并进来
+    def __merge_shards(self):
+        from .chunkstore import make_chunk_store
+        self.__log('merging {} shards ...'.format(self.shards))
+        for shard in range(self.shards):
+            store = make_chunk_store(self.store_type, self.__shard_name(shard),
+                                     self.horizontal_chunk_amount, self.vertical_chunk_amount, self.chunk_size,
+                                     self.default_val, 2, self.chunk_dtype, reopen='r')
+            self.shard_stores.append(store)
+            for y_chunk_id, x_chunk_id in zip(*np.nonzero(store.load_accessed())):
+                shard_chunk = store.read(x_chunk_id, y_chunk_id)
+                written = shard_chunk[1] > 0
+                value = self.__get_chunk(x_chunk_id, y_chunk_id)
+                if self.mode == 'overwrite':
+                    value[written] = shard_chunk[0][written]
+                elif self.mode in ('max', 'min'):
+                    reduce = np.maximum if self.mode == 'max' else np.minimum
+                    merged = np.where(value[1] > 0, reduce(value[0], shard_chunk[0]), shard_chunk[0])
+                    value[0] = np.where(written, merged, value[0])
+                    value[1] = np.maximum(value[1], shard_chunk[1])
+                else:
+                    value += shard_chunk
+                self.dirty.add((x_chunk_id, y_chunk_id))
+            store.close()
+
+    #   使用内置的编码器生成tiff：chunk从暂存后端读出后直接压缩写入文件，金字塔各层已经在写回chunk时算好了
+    def __finish_numpy(self, workers=1, queue_depth=None, pool='thread'):
+        encoder = self.__open_encoder()
+        encoder.write_tiles(self.__output_tiles(), workers=workers, queue_depth=queue_depth, pool=pool)
+        encoder.close()
+        self.__print_encoder_summary(encoder)
+
+    #   更新已有的tiff：只重新压缩被改写过的tile，追加到文件末尾并修改偏移表
+    def __finish_update(self):
+        self.__log('updating tiff file {} ...'.format(self.target_tiff))
+        tiles = 0
+        for level, tile_x, tile_y, tile in self.__output_tiles():
+            if not isinstance(tile, np.ndarray):
+                tile = np.full((self.chunk_size, self.chunk_size), tile, dtype=np.uint8)
+            with self.recorder.timer('output_write'):
+                self.base_tiff.write_tile(level, tile_x, tile_y, tile)
+            tiles += 1
+        self.base_tiff.close()
+        self.__log('   tiles rewritten: {}'.format(tiles))
+
+    #   打开内置的编码器，并设置好金字塔的各层
+    def __open_encoder(self):
+        from .tiffio import Tiled_tiff_encoder
+
+        self.__log('start writing tiff file {} ...'.format(self.target_tiff))
+        self.__log('   width: {}, height: {}, default value: {}'.format(self.tiff_width, self.tiff_height,
+                                                                       self.default_val))
+        self.__log('   tile size: {}, compression: {}'.format(self.chunk_size, self.compression))
+
+        encoder = Tiled_tiff_encoder(self.target_tiff, self.chunk_size, compression=self.compression,
+                                     spacing=self.spacing, default_val=self.default_val)
+        for width, height, downsample in self.pyramid.levels:
+            encoder.add_level(width, height, downsample)
+        self.output_encoder = encoder
+        return encoder
+
+    #   finish()中输出第0层时的进度报告，没有进度回调时为None
+    def __finish_progress(self):
+        if self.progress is None:
+            return None
+        from .monitor import Progress_reporter
+        return Progress_reporter(self.progress, int(self.accessed.sum()), stage='finish')
+
+    def __print_encoder_summary(self, encoder):
+        self.__log('   tiles written: {}, deduplicated: {}'.format(encoder.tiles_written, encoder.tiles_deduplicated))
+
+    #   按顺序产生所有需要写入的(level, tile_x, tile_y, tile)，已知均匀的chunk的tile为其标签值(整数)
+    def __output_tiles(self):
+        #   第0层：直接写每个被访问过的chunk，未访问过的chunk由编码器统一指向默认tile
+        progress = self.__finish_progress()
+        for chunk_y, chunk_x in zip(*np.nonzero(self.accessed)):
+            uniform = self.uniform_chunks.get((chunk_x, chunk_y))
+            if uniform is None:
+                yield 0, chunk_x, chunk_y, self.__finalize(self.__store_read(chunk_x, chunk_y))
+            else:
+                yield 0, chunk_x, chunk_y, uniform
+            if progress is not None:
+                progress.update()
+
+        #   降采样的各层
+        for level in range(1, len(self.pyramid.levels)):
+            for tile_x, tile_y, tile in self.pyramid.tiles(level):
+                yield level, tile_x, tile_y, tile
+
+    #   使用ASAP的multiresolutionimageinterface生成tiff
+    def __finish_mir(self):
         import multiresolutionimageinterface as mir
         writer = mir.MultiResolutionImageWriter()
         writer.openFile(self.target_tiff)
@@ -214,20 +1158,23 @@ class Tiff_writer():
             spacing_vec.push_back(float(self.spacing))
             writer.setSpacing(spacing_vec)
 
-        print('start writing tiff file {} ...'.format(self.target_tiff))
-        print('   width: {}, height: {}, default value: {}'.format(self.tiff_width, self.tiff_height, self.default_val))
-        print('   write tile size: {}, chunk size: {}'.format(self.write_tile_size, self.chunk_size))
-        sys.stdout.flush()
+        self.__log('start writing tiff file {} ...'.format(self.target_tiff))
+        self.__log('   width: {}, height: {}, default value: {}'.format(self.tiff_width, self.tiff_height,
+                                                                       self.default_val))
+        self.__log('   write tile size: {}, chunk size: {}'.format(self.write_tile_size, self.chunk_size))
 
         #   新的程序
+        progress = self.__finish_progress()
         for chunk_x in range(self.horizontal_chunk_amount):
             for chunk_y in range(self.vertical_chunk_amount):
-                if not f['accessed'][chunk_y, chunk_x]:  # 注：在上面的设定中，accessed是矩阵形式的，它的x和y和坐标是反的
+                if not self.accessed[chunk_y, chunk_x]:  # 注：在上面的设定中，accessed是矩阵形式的，它的x和y和坐标是反的
                     continue
-                group_name = str(chunk_x) + '_' + str(chunk_y)
-                value = f[group_name]['value']
-                writer.writeBaseImagePartToLocation(np.array(value).flatten(), chunk_x * self.chunk_size,
-                                                    chunk_y * self.chunk_size)
+                value = self.__finalize(self.__store_read(chunk_x, chunk_y))
+                with self.recorder.timer('output_write'):
+                    writer.writeBaseImagePartToLocation(value.flatten(), chunk_x * self.chunk_size,
+                                                        chunk_y * self.chunk_size)
+                if progress is not None:
+                    progress.update()
 
         # #   以前的程序，适用于尺寸很正常的tiff
         # x_steps = int(self.tiff_width / self.write_tile_size)
@@ -258,17 +1205,20 @@ class Tiff_writer():
         #                           this_tile_x_lb:this_tile_x_lb + self.write_tile_size]
         #         #   准备数据
         #         writer.writeBaseImagePart(this_tile_value.flatten())
-        f.close()
-        writer.finishImage()
-        if free:
-            self.free()
+        with self.recorder.timer('output_write'):
+            writer.finishImage()
 
-    #   删除存储的中间hdf5文件
+    #   删除存储的中间暂存文件
     def free(self):
         try:
-            os.remove(self.hdf5name)
+            if self.store is not None:
+                self.store.free()
+            for store in self.shard_stores:
+                store.free()
+            if self.pyramid is not None:
+                self.pyramid.free()
         except:
-            print('error happen while cleaning intermedia hdf5 file')
+            print('error happen while cleaning intermedia staging file')
 
 
 '''
@@ -282,46 +1232,58 @@ class Tiff_writer():
 #       spacing: The spacing of generated tif, not important if you don't use spacing property of a slide
 #       assigned_height: The target height can be calculated by image.height * expand_rate, but you can set this manually in case of indivisible issue
 #       assigned_height: Similar as "assigned_height"
-#       show_process: Do you want to show a process bar in the terminal?
+#       show_process: Do you want to show a process bar in the terminal? (refreshed at most twice per second)
 #       tile_size: Just leave it as default.
+#       progress: progress(event) callback used instead of printing, see Tiff_writer
 
 def build_tif_from_image(image, target_tiff, expand_rate=1,
                          spacing=None, assigned_height=None, assigned_width=None,
-                         show_process=False, tile_size=512):
+                         show_process=False, tile_size=512, progress=None):
     expand_rate = int(expand_rate)
     from .anything import anything_as_ndarray
-    from .imgprocessing.basic import imsqueeze, imrescale
+    from .imgprocessing.basic import imsqueeze
     data = imsqueeze(anything_as_ndarray(image))
     image_height, image_width = data.shape
     target_height = int(image_height * expand_rate) if assigned_height is None else assigned_height
     target_width = int(image_width * expand_rate) if assigned_width is None else assigned_width
-    writer = Tiff_writer(target_tiff, target_width, target_height, spacing=spacing, write_tile_size=tile_size)
-    writer_tile_size = writer.write_tile_size
-    image_step_size = int(
-        max(int(np.round(writer_tile_size / expand_rate)), 1))  # 在原图像上每次移动的距离，256对应Tiff_writer里的write_tile_size
-    #   例如，每次移动32，放大8倍，就成了256的大小了
-    #   这里的坐标是在最终的大tiff上的
-    print('writing image data ...')
-    sys.stdout.flush()
-    current = 0
-    total = target_height * target_width / (writer_tile_size ** 2)
-
-    from .monitor import terminal_viewer
-    for y in range(0, target_height, writer_tile_size):
-        for x in range(0, target_width, writer_tile_size):
-            current += 1
-            if show_process:
-                terminal_viewer(current, total)
-            #   首先回溯到原来的小图上
-            x_small = int(x / expand_rate)
-            y_small = int(y / expand_rate)
-            #   截出所需要的大小
-            y_ub = min(y_small + image_step_size, image_height)
-            x_ub = min(x_small + image_step_size, image_width)
-            patch = data[y_small:y_ub, x_small:x_ub].astype(np.uint8)
-            if not np.any(patch):
+    writer = Tiff_writer(target_tiff, target_width, target_height, spacing=spacing, write_tile_size=tile_size,
+                         streaming=True, progress=progress)  # 下面是按行优先的顺序写入的，可以直接流式输出
+    chunk_size = writer.chunk_size
+    #   每次处理大tiff上的一个chunk，对应原图上的[y_small, y_small_ub)行、[x_small, x_small_ub)列，
+    #   按整数倍放大(广播成(h, expand_rate, w, expand_rate)后reshape，只拷贝一次)，
+    #   再去掉chunk边界没有对齐到expand_rate带来的多余部分
+    total = writer.horizontal_chunk_amount * writer.vertical_chunk_amount
+    #   进度条限速刷新，不再每个chunk都重写一次终端
+    from .monitor import Progress_reporter
+    reporter = Progress_reporter(progress, total, stage='build') if show_process or progress is not None else None
+    if progress is not None:
+        reporter.message('writing image data ...')
+    else:
+        print('writing image data ...')
+        sys.stdout.flush()
+    for y in range(0, target_height, chunk_size):
+        y_small = y // expand_rate
+        y_small_ub = min(-(-min(y + chunk_size, target_height) // expand_rate), image_height)
+        #   这一行chunk对应的原图各列是否有非零像素的前缀和，用于O(1)判断每个chunk是否全为0(全0的chunk不用写)，
+        #   只占一行原图宽度的内存，而不是整张原图大小的二维前缀和
+        occupancy = np.zeros(image_width + 1, dtype=np.int32)
+        if y_small < y_small_ub:
+            np.cumsum(data[y_small:y_small_ub].any(axis=0), out=occupancy[1:])
+        for x in range(0, target_width, chunk_size):
+            if reporter is not None:
+                reporter.update()
+            x_small = x // expand_rate
+            x_small_ub = min(-(-min(x + chunk_size, target_width) // expand_rate), image_width)
+            if y_small >= y_small_ub or x_small >= x_small_ub:
+                continue
+            if occupancy[x_small_ub] == occupancy[x_small]:
                 continue
-            patch_expand = imrescale(patch, scale=expand_rate, hard=True)
-            writer.write(x, y, patch_expand)
+            patch = data[y_small:y_small_ub, x_small:x_small_ub].astype(np.uint8)
+            patch_expand = np.broadcast_to(patch[:, None, :, None],
+                                           (patch.shape[0], expand_rate, patch.shape[1], expand_rate))
+            patch_expand = patch_expand.reshape(patch.shape[0] * expand_rate, patch.shape[1] * expand_rate)
+            y_offset = y - y_small * expand_rate
+            x_offset = x - x_small * expand_rate
+            writer.write(x, y, patch_expand[y_offset:y_offset + chunk_size, x_offset:x_offset + chunk_size])
     writer.finish()
     pass